@@ -5,74 +5,120 @@ This Flask application provides endpoints for managing books, including storing
 
 Endpoints:
 
-/store_openlib_books: Stores books from OpenLibrary.
-/books: Retrieves all books from the database.
-/books/search: Searches books based on specified criteria (author, work, number of pages).
+/store_openlib_books: Stores books from OpenLibrary (large batches in a background import job).
+/imports/<job_id>: Returns (or streams) the progress of an import job.
+/books: Retrieves all books from the database (optionally paginated with a cursor or streamed).
+/books/search: Searches, sorts, pages and counts books based on specified criteria (author, work, page range, ids).
+/books/changes: Returns (long-polls or streams) the changes of the catalog after a sequence number.
 /books: Creates a new book entry.
+/books/bulk: Creates a batch of book entries in a single transaction.
+/books: Deletes a batch of books in a single transaction.
+/books:batch: Creates (POST) or deletes (DELETE) a large batch of books in chunked transactions, or atomically.
 /books/<book_id>: Deletes a book.
+/openlib/stats: Returns the OpenLibrary client and cache counters for monitoring.
+/cache/stats: Returns the response cache counters and the catalog snapshot size for monitoring.
+/metrics: Exports the request, connection pool, OpenLibrary and cache metrics in the Prometheus text format.
+
+The routes live in the api blueprint. create_app(config_overrides) builds an application with them, and the module
+level app is the one served by gunicorn in production (see gunicorn.conf.py). Creating the application doesn't
+connect to the database, run `flask --app app init-db` to create and migrate its schema first.
+
+Every response carries a Server-Timing header with the time spent in SQL, ORM hydration, JSON serialization,
+compression and OpenLibrary requests (see utils/instrumentation.py). The JSON responses are compressed with the
+encoding negotiated from Accept-Encoding (see utils/compression.py).
 """
 
-from flask import Flask, jsonify, request
+import logging
+import time
+import click
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    current_app,
+    json,
+    jsonify,
+    request,
+    stream_with_context,
+    url_for,
+)
 from db import db
 import db_operations
-from utils.app_utils import fetch_data, validate_create_book_req_data
+from migrations import init_database, run_migrations
+from import_workers import ImportWorkerPool, notify_import_workers, start_import_workers
+from dump_loader import load_dumps
+from utils.app_utils import (
+    BookJSONProvider,
+    fetch_openlib_books,
+    book_validation_error,
+    summarize_import,
+    stream_json_array,
+    validate_create_book_req_data,
+)
+from utils.openlib_client import get_client
+from utils.openlib_cache import get_cache
+from utils.response_cache import cached_response, get_response_cache, mark_cacheable
+from utils.catalog_snapshot import get_catalog_snapshot, start_catalog_snapshot
+from utils.change_log import start_change_log_compaction
+from utils.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, collect_metrics
+from utils.instrumentation import init_instrumentation
+from utils.compression import init_compression
 from config.config import config
 
-app = Flask(__name__)
-app.config.update(config)
-db.init_app(app)
+# The routes and CLI commands, registered on the application by create_app
+# (cli_group=None keeps the commands at the top level, e.g. `flask migrate`)
+api = Blueprint("api", __name__, cli_group=None)
+
+
+@api.before_app_request
+def start_background_workers():
+    # Process the queued and interrupted import jobs in the background. The workers start with the
+    # first request, so CLI commands such as `flask import-worker` don't run those of the web process,
+    # and under gunicorn every worker process starts its own after the fork.
+    start_import_workers(current_app._get_current_object())
+    # Same for the build of the catalog snapshot, when enabled
+    start_catalog_snapshot(current_app._get_current_object())
+    # And the compaction of the change log
+    start_change_log_compaction(current_app._get_current_object())
 
 
-@app.route("/store_openlib_books", methods=["POST"])
+@api.route("/store_openlib_books", methods=["POST"])
 def store_openlib_books():
     """
     Endpoint handler for storing books from OpenLibrary.
+        -Batches over IMPORT_ASYNC_THRESHOLD codes, or with "async": true, are enqueued as an
+         import job and answered right away with 202 and the URL of the job status
     """
 
     # Get the book data from the request
     data = request.get_json()
 
     if "codes" in data:
-        skipped_books = []  # List to store skipped books
-        added_books = []  # List to store successfully added books
-
-        for code in data["codes"]:
-            try:
-                # Fetch data for the book using the provided code
-                book = fetch_data("/books/" + code)
-
-                if "authors" in book and "works" in book:
-                    authors = []
-                    # Fetch data for each author associated with the book
-                    for i in range(0, len(book["authors"])):
-                        author = fetch_data(book["authors"][i]["key"])
-                        authors.append(author)
-
-                    works = []
-                    # Fetch data for each work associated with the book
-                    for i in range(0, len(book["works"])):
-                        work = fetch_data(book["works"][i]["key"])
-                        works.append(work)
-
-                    # Update the book data with the fetched author and work data
-                    book["authors"] = authors
-                    book["works"] = works
-
-                    # Store the book in the database
-                    msg = db_operations.store_book(book, from_openlib=True)
-
-                    if "error" in msg:
-                        skipped_books.append(
-                            {code: "Skipped because of: {}".format(msg["error"])}
-                        )
-                    else:
-                        added_books.append(code)
-
-                else:
-                    skipped_books.append({code: "Skipped because of: Missing fields"})
-
-            except Exception as e:
-                skipped_books.append({code: "Skipped because of: {}".format(e)})
+        if data.get("async") or len(data["codes"]) > current_app.config["IMPORT_ASYNC_THRESHOLD"]:
+            # Import the books in the background
+            job_id = db_operations.enqueue_import_job(data["codes"])
+            notify_import_workers()
+            status_url = url_for("api.get_import_job", job_id=job_id)
+            return (
+                jsonify({"job_id": job_id, "status_url": status_url}),
+                202,
+                {"Location": status_url},
+            )
+
+        # Fetch all the books, authors and works concurrently
+        # (authors and works already in the database are not requested again)
+        books = fetch_openlib_books(
+            data["codes"],
+            max_workers=current_app.config["OPENLIB_MAX_WORKERS"],
+            lookup_known=db_operations.retrieve_known_openlib_documents,
+        )
+
+        # Store all the fetched books in a single batch
+        fetched_codes = [code for code in data["codes"] if isinstance(books[code], dict)]
+        messages = db_operations.store_books(
+            [books[code] for code in fetched_codes], from_openlib=True
+        )
+        added_books, skipped_books = summarize_import(data["codes"], books, messages)
 
         return (
             jsonify({"added_books": added_books, "skipped_books": skipped_books}),
@@ -82,40 +128,236 @@ def store_openlib_books():
         return jsonify({"error": "Invalid code list provided."}, 400)
 
 
-@app.route("/books", methods=["GET"])
+@api.route("/imports/<job_id>", methods=["GET"])
+def get_import_job(job_id):
+    """
+    Endpoint handler for retrieving the progress of an import job.
+        -?details=true: includes the added and skipped books
+        -?stream=true: streams the progress as server-sent events until the job completes
+    """
+    details = request.args.get("details") == "true"
+
+    if request.args.get("stream") == "true":
+        if db_operations.retrieve_import_job(job_id) is None:
+            return jsonify({"error": "Import job not found."}), 404
+
+        def events():
+            last = None
+            while True:
+                job = db_operations.retrieve_import_job(job_id, details)
+                # End the read transaction, so it doesn't hold back the workers
+                db.session.rollback()
+                if job != last:
+                    yield "data: {}\n\n".format(json.dumps(job))
+                    last = job
+                if job["status"] == "completed":
+                    return
+                time.sleep(current_app.config["IMPORT_POLL_INTERVAL"])
+
+        return Response(stream_with_context(events()), mimetype="text/event-stream")
+
+    job = db_operations.retrieve_import_job(job_id, details)
+    if job is None:
+        return jsonify({"error": "Import job not found."}), 404
+
+    return jsonify(job), 200
+
+
+@api.route("/books", methods=["GET"])
+@cached_response
 def get_all_books():
     """
     Endpoint handler for retrieving all books from the database.
+        -?limit=<n>&cursor=<id>: returns a page of books and the cursor of the next page
+        -?stream=ndjson|json: streams all the books as NDJSON or as a chunked JSON array
     """
+    stream = request.args.get("stream")
+    limit = request.args.get("limit")
+
+    if stream:
+        if stream not in ("ndjson", "json"):
+            return jsonify({"error": "Invalid stream format."}), 400
+
+        # Stream the books straight from a server-side cursor
+        books = db_operations.iterate_all_books(current_app.config["BOOKS_STREAM_BATCH_SIZE"])
+
+        if stream == "ndjson":
+            # Compact like the pre-rendered documents of the read model, which are written as they are
+            body = (json.dumps(book, separators=(",", ":")) + "\n" for book in books)
+            mimetype = "application/x-ndjson"
+        else:
+            body = stream_json_array("books", books)
+            mimetype = "application/json"
+
+        return Response(stream_with_context(body), mimetype=mimetype)
+
+    if limit is not None:
+        if not limit.isdigit() or not 0 < int(limit) <= current_app.config["BOOKS_MAX_PAGE_SIZE"]:
+            return jsonify({"error": "Invalid limit provided."}), 400
+
+        # Retrieve a single page of books after the cursor
+        books, next_cursor = db_operations.retrieve_books_page(
+            int(limit), request.args.get("cursor")
+        )
+        mark_cacheable()
+
+        return jsonify({"books": books, "next_cursor": next_cursor}), 200
+
     # Retrieve all books from the database
     books = db_operations.retrieve_all_books()
+    mark_cacheable()
 
     return jsonify({"books": books}, 200)
 
 
-@app.route("/books/search", methods=["GET"])
+@api.route("/books/search", methods=["GET"])
+@cached_response
 def search_books():
     """
     Endpoint handler for searching books based on specified criteria:
-        -(author or/and work or/and number of pages)
+        -(author or/and work or/and number of pages or/and ids)
+        -?sort=relevance|id|title|-title|pages|-pages: sorts the books in the database
+        -?limit=<n>&offset=<n>: returns a page of books and the offset of the next page
+        -?count=true: returns only the number of matching books
     """
 
     # Get the query parameters from the request
     author_name = request.args.get("author")
     work_title = request.args.get("work")
-    min_pages = request.args.get("min_pages")
+    book_ids = request.args.getlist("id")
+    author_ids = request.args.getlist("author_id")
+    work_ids = request.args.getlist("work_id")
+    sort = request.args.get("sort")
+    limit = request.args.get("limit")
+    offset = request.args.get("offset", "0")
+    count = request.args.get("count") == "true"
+
+    pages = {}
+    for name in ["min_pages", "max_pages"]:
+        value = request.args.get(name)
+        if value:
+            if not value.isdigit():
+                return jsonify({"error": "Invalid {} provided.".format(name)}), 400
+            pages[name] = int(value)
 
     # Check if at least one query parameter is provided
-    if not author_name and not work_title and not min_pages:
+    if not (author_name or work_title or pages or book_ids or author_ids or work_ids):
         return jsonify({"error": "At least one query parameter is required."}, 400)
 
+    if sort is not None and sort not in db_operations.SEARCH_SORTS:
+        return jsonify({"error": "Invalid sort provided."}), 400
+    if limit is not None and (
+        not limit.isdigit() or not 0 < int(limit) <= current_app.config["BOOKS_MAX_PAGE_SIZE"]
+    ):
+        return jsonify({"error": "Invalid limit provided."}), 400
+    if not offset.isdigit():
+        return jsonify({"error": "Invalid offset provided."}), 400
+
+    criteria = dict(
+        author_name=author_name,
+        work_title=work_title,
+        min_pages=pages.get("min_pages"),
+        max_pages=pages.get("max_pages"),
+        book_ids=book_ids,
+        author_ids=author_ids,
+        work_ids=work_ids,
+    )
+
+    if count:
+        # Count the matching books in the database, without loading them
+        mark_cacheable()
+        return jsonify({"count": db_operations.count_books_by_criteria(**criteria)}), 200
+
+    if limit is not None:
+        # Fetch one extra book to find out if there is a next page
+        limit, offset = int(limit), int(offset)
+        books = db_operations.retrieve_books_by_criteria(
+            **criteria, sort=sort, limit=limit + 1, offset=offset
+        )
+        next_offset = offset + limit if len(books) > limit else None
+        mark_cacheable()
+
+        return jsonify({"books": books[:limit], "next_offset": next_offset}), 200
+
     # Retrieve books based on the specified criteria
-    books = db_operations.retrieve_books_by_criteria(author_name, work_title, min_pages)
+    books = db_operations.retrieve_books_by_criteria(**criteria, sort=sort, offset=int(offset))
+    mark_cacheable()
 
     return jsonify({"books": books})
 
 
-@app.route("/books", methods=["POST"])
+@api.route("/books/changes", methods=["GET"])
+def get_book_changes():
+    """
+    Endpoint handler for retrieving the changes of the catalog after a sequence number.
+        -?since=<seq>&limit=<n>: returns a page of changes and the sequence number to resume after them
+        -?wait=<seconds>: waits up to the given time (at most CHANGES_MAX_WAIT) for a change when there is none
+        -?stream=true: streams the changes as server-sent events, resuming after the Last-Event-ID header
+        -410 when changes after the sequence number were compacted: resync with GET /books and resume after 'latest'
+    """
+    stream = request.args.get("stream") == "true"
+    since = request.headers.get("Last-Event-ID") if stream else None
+    since = since or request.args.get("since", "0")
+    limit = request.args.get("limit", "1000")
+    wait = request.args.get("wait", "0")
+
+    if not since.isdigit():
+        return jsonify({"error": "Invalid since provided."}), 400
+    if not limit.isdigit() or not 0 < int(limit) <= current_app.config["BOOKS_MAX_PAGE_SIZE"]:
+        return jsonify({"error": "Invalid limit provided."}), 400
+    try:
+        wait = max(0.0, min(float(wait), current_app.config["CHANGES_MAX_WAIT"]))
+    except ValueError:
+        return jsonify({"error": "Invalid wait provided."}), 400
+
+    since, limit = int(since), int(limit)
+    poll_interval = current_app.config["CHANGES_POLL_INTERVAL"]
+
+    def compacted(latest):
+        return {"error": "Changes after this sequence number were compacted, resync.", "latest": latest}
+
+    if stream:
+        if db_operations.retrieve_book_changes(since, 1) is None:
+            return jsonify(compacted(db_operations.retrieve_latest_change())), 410
+
+        def events(since):
+            idle = 0
+            while True:
+                page = db_operations.retrieve_book_changes(since, limit)
+                # End the read transaction, so it doesn't hold back the writers
+                db.session.rollback()
+                if page is None:
+                    # The consumer fell behind the compaction while streaming
+                    yield "event: resync\ndata: {}\n\n".format(json.dumps(compacted(db_operations.retrieve_latest_change())))
+                    db.session.rollback()
+                    return
+                for change in page["changes"]:
+                    yield "id: {}\ndata: {}\n\n".format(change["seq"], json.dumps(change))
+                if page["changes"]:
+                    since, idle = page["next_since"], 0
+                    continue
+                # Keep idle connections open through the proxies
+                idle += poll_interval
+                if idle >= 15:
+                    yield ": heartbeat\n\n"
+                    idle = 0
+                time.sleep(poll_interval)
+
+        return Response(stream_with_context(events(since)), mimetype="text/event-stream")
+
+    deadline = time.monotonic() + wait
+    while True:
+        page = db_operations.retrieve_book_changes(since, limit)
+        if page is None:
+            return jsonify(compacted(db_operations.retrieve_latest_change())), 410
+        if page["changes"] or time.monotonic() >= deadline:
+            return jsonify(page), 200
+        # Long-poll: end the read transaction, so the next read sees the new commits
+        db.session.rollback()
+        time.sleep(min(poll_interval, max(0, deadline - time.monotonic())))
+
+
+@api.route("/books", methods=["POST"])
 def create_book():
     """
     Endpoint handler for creating a new book entry.
@@ -137,7 +379,191 @@ def create_book():
         return jsonify({"error": "Missing required fields in the request data."}, 400)
 
 
-@app.route("/books/<book_id>", methods=["DELETE"])
+@api.route("/books/bulk", methods=["POST"])
+def create_books_bulk():
+    """
+    Endpoint handler for creating a batch of book entries in a single transaction.
+    """
+    # Get the book data from the request
+    data = request.get_json()
+
+    if "books" not in data or not isinstance(data["books"], list):
+        return jsonify({"error": "Invalid book list provided."}), 400
+
+    skipped_books = []  # List to store skipped books
+    added_books = []  # List to store successfully added books
+
+    # Check the required fields of every book before storing the valid ones
+    valid = [validate_create_book_req_data(book) for book in data["books"]]
+    messages = iter(
+        db_operations.store_books(
+            [book for book, is_valid in zip(data["books"], valid) if is_valid],
+            from_openlib=False,
+        )
+    )
+
+    for book, is_valid in zip(data["books"], valid):
+        book_id = book.get("id") if isinstance(book, dict) else None
+
+        if not is_valid:
+            skipped_books.append(
+                {book_id: "Skipped because of: Missing required fields"}
+            )
+            continue
+
+        msg = next(messages)
+
+        if "error" in msg:
+            skipped_books.append({book_id: "Skipped because of: {}".format(msg["error"])})
+        else:
+            added_books.append(book_id)
+
+    return (
+        jsonify({"added_books": added_books, "skipped_books": skipped_books}),
+        200,
+    )
+
+
+@api.route("/books:batch", methods=["POST"])
+def create_books_batch():
+    """
+    Endpoint handler for creating a large batch of book entries.
+        -Every book is validated up front, the invalid ones are skipped
+        -The books are stored in chunks of BOOKS_BATCH_CHUNK_SIZE, each in its own transaction,
+         and a failing book only skips itself
+        -"atomic": true stores all the books in a single transaction or none of them
+         (400 if a book is invalid, 409 if one can't be stored)
+    """
+    # Get the book data from the request
+    data = request.get_json()
+
+    if not isinstance(data, dict) or not isinstance(data.get("books"), list):
+        return jsonify({"error": "Invalid book list provided."}), 400
+    if len(data["books"]) > current_app.config["BOOKS_BATCH_MAX_SIZE"]:
+        return jsonify({"error": "Too many books provided."}), 413
+
+    atomic = bool(data.get("atomic"))
+    books = data["books"]
+
+    # Validate every book before storing any
+    errors = [book_validation_error(book) for book in books]
+    valid = [book for book, error in zip(books, errors) if error is None]
+    if atomic and len(valid) < len(books):
+        messages = iter([{"error": db_operations.BATCH_ABORTED}] * len(valid))
+    else:
+        messages = iter(
+            db_operations.store_books_batch(
+                valid, current_app.config["BOOKS_BATCH_CHUNK_SIZE"], atomic
+            )
+        )
+
+    skipped_books = []  # List to store skipped books
+    added_books = []  # List to store successfully added books
+
+    for book, error in zip(books, errors):
+        book_id = book.get("id") if isinstance(book, dict) else None
+        if error is None:
+            error = next(messages).get("error")
+
+        if error:
+            skipped_books.append({book_id: "Skipped because of: {}".format(error)})
+        else:
+            added_books.append(book_id)
+
+    status = 200
+    if atomic and skipped_books:
+        status = 400 if len(valid) < len(books) else 409
+
+    return (
+        jsonify({"added_books": added_books, "skipped_books": skipped_books}),
+        status,
+    )
+
+
+@api.route("/books:batch", methods=["DELETE"])
+def delete_books_batch():
+    """
+    Endpoint handler for deleting a large batch of books.
+        -The books are deleted in chunks of BOOKS_BATCH_CHUNK_SIZE, each in its own transaction,
+         and a failing book only skips itself
+        -"atomic": true deletes all the books in a single transaction or none of them
+         (400 if an id is invalid, 409 if a book is missing or can't be deleted)
+    """
+    # Get the book ids from the request
+    data = request.get_json()
+
+    if not isinstance(data, dict) or not isinstance(data.get("ids"), list):
+        return jsonify({"error": "Invalid id list provided."}), 400
+    if len(data["ids"]) > current_app.config["BOOKS_BATCH_MAX_SIZE"]:
+        return jsonify({"error": "Too many ids provided."}), 413
+
+    atomic = bool(data.get("atomic"))
+    ids = data["ids"]
+
+    # Validate every id before deleting any
+    errors = [None if isinstance(book_id, str) and book_id else "Invalid id" for book_id in ids]
+    valid = [book_id for book_id, error in zip(ids, errors) if error is None]
+    if atomic and len(valid) < len(ids):
+        messages = iter([{"error": db_operations.BATCH_ABORTED}] * len(valid))
+    else:
+        messages = iter(
+            db_operations.remove_books_batch(
+                valid, current_app.config["BOOKS_BATCH_CHUNK_SIZE"], atomic
+            )
+        )
+
+    skipped_books = []  # List to store skipped books
+    deleted_books = []  # List to store successfully deleted books
+
+    for book_id, error in zip(ids, errors):
+        if error is None:
+            error = next(messages).get("error")
+
+        if error:
+            skipped_books.append({book_id: "Skipped because of: {}".format(error)})
+        else:
+            deleted_books.append(book_id)
+
+    status = 200
+    if atomic and skipped_books:
+        status = 400 if len(valid) < len(ids) else 409
+
+    return (
+        jsonify({"deleted_books": deleted_books, "skipped_books": skipped_books}),
+        status,
+    )
+
+
+@api.route("/books", methods=["DELETE"])
+def delete_books():
+    """
+    Endpoint handler for deleting a batch of books in a single transaction.
+    """
+    # Get the book ids from the request
+    data = request.get_json()
+
+    if "ids" not in data or not isinstance(data["ids"], list):
+        return jsonify({"error": "Invalid id list provided."}), 400
+
+    skipped_books = []  # List to store skipped books
+    deleted_books = []  # List to store successfully deleted books
+
+    # Remove all the books from the database at once
+    messages = db_operations.remove_books(data["ids"])
+
+    for book_id, msg in zip(data["ids"], messages):
+        if msg.get("error"):
+            skipped_books.append({book_id: "Skipped because of: {}".format(msg["error"])})
+        else:
+            deleted_books.append(book_id)
+
+    return (
+        jsonify({"deleted_books": deleted_books, "skipped_books": skipped_books}),
+        200,
+    )
+
+
+@api.route("/books/<book_id>", methods=["DELETE"])
 def delete_book(book_id):
     """
     Endpoint handler for deleting a book.
@@ -155,9 +581,155 @@ def delete_book(book_id):
         return jsonify(msg, 200)
 
 
-# Create the database tables if they do not exist
-with app.app_context():
-    db.create_all()
+@api.route("/openlib/stats", methods=["GET"])
+def get_openlib_stats():
+    """
+    Endpoint handler for retrieving the OpenLibrary client and cache counters.
+    """
+    return jsonify({"client": get_client().stats(), "cache": get_cache().stats()}), 200
+
+
+@api.route("/cache/stats", methods=["GET"])
+def get_response_cache_stats():
+    """
+    Endpoint handler for retrieving the response cache counters.
+    """
+    cache = get_response_cache()
+    snapshot = get_catalog_snapshot()
+    return (
+        jsonify(
+            {
+                "response_cache": cache.stats() if cache else None,
+                "catalog_snapshot": snapshot.stats() if snapshot else None,
+            }
+        ),
+        200,
+    )
+
+
+@api.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Endpoint handler for exporting the application metrics in the Prometheus text format.
+        -Request latency histograms, phase timings, query and ORM row counts per endpoint
+    """
+    return Response(collect_metrics(db.engine), mimetype=METRICS_CONTENT_TYPE)
+
+
+@api.cli.command("init-db")
+def init_db():
+    """Creates the missing tables, applies the pending migrations and creates the search indexes."""
+    applied = init_database(db.engine)
+    print("Database initialized, applied migrations: {}".format(", ".join(applied) or "none"))
+
+
+@api.cli.command("migrate")
+def migrate():
+    """Applies the pending schema migrations to the existing tables."""
+    applied = run_migrations(db.engine)
+    print("Applied migrations: {}".format(", ".join(applied) or "none"))
+
+
+@api.cli.command("compact-changes")
+@click.option("--retention", type=int, default=None, help="Seconds of changes kept (defaults to CHANGE_LOG_RETENTION).")
+def compact_changes(retention):
+    """Deletes the changes older than the retention window from the change log."""
+    if retention is None:
+        retention = current_app.config["CHANGE_LOG_RETENTION"]
+    deleted = db_operations.compact_book_changes(retention)
+    print("Deleted {} changes".format(deleted))
+
+
+@api.cli.command("import-worker")
+@click.option("--workers", type=int, default=None, help="Worker threads (defaults to IMPORT_WORKERS).")
+def import_worker(workers):
+    """Processes the queued import jobs until interrupted."""
+    pool = ImportWorkerPool(
+        current_app._get_current_object(),
+        workers or current_app.config["IMPORT_WORKERS"] or 1,
+        batch_size=current_app.config["IMPORT_BATCH_SIZE"],
+        lease_seconds=current_app.config["IMPORT_LEASE_SECONDS"],
+        max_attempts=current_app.config["IMPORT_MAX_ATTEMPTS"],
+        poll_interval=current_app.config["IMPORT_POLL_INTERVAL"],
+    )
+    pool.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+@api.cli.command("load-dump")
+@click.option("--editions", type=click.Path(exists=True, dir_okay=False), required=True, help="Editions dump.")
+@click.option("--authors", type=click.Path(exists=True, dir_okay=False), required=True, help="Authors dump.")
+@click.option("--works", type=click.Path(exists=True, dir_okay=False), required=True, help="Works dump.")
+@click.option("--limit", type=int, default=None, help="Maximum number of editions to load.")
+@click.option("--language", "languages", multiple=True, help="Only load editions in this language (e.g. eng).")
+@click.option("--min-pages", type=int, default=None, help="Only load editions with at least this many pages.")
+@click.option("--batch-size", type=int, default=10000, help="Records staged per transaction.")
+@click.option("--restart", is_flag=True, help="Discard the progress of an interrupted load.")
+def load_dump(editions, authors, works, limit, languages, min_pages, batch_size, restart):
+    """Bulk loads the OpenLibrary editions, authors and works dumps."""
+    # Report the progress of the staging on the terminal
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    dump_logger = logging.getLogger("dump_loader")
+    dump_logger.addHandler(handler)
+    dump_logger.setLevel(logging.INFO)
+    try:
+        stats = load_dumps(
+            db.engine,
+            editions,
+            authors,
+            works,
+            limit=limit,
+            languages=languages,
+            min_pages=min_pages,
+            batch_size=batch_size,
+            restart=restart,
+            progress=True,
+        )
+    finally:
+        dump_logger.removeHandler(handler)
+    for name in ["editions", "authors", "works"]:
+        stage = stats[name]
+        print(
+            "Staged {} {} in {:.1f}s ({:.0f} records/s)".format(
+                stage["rows"], name, stage["seconds"], stage["rows"] / stage["seconds"] if stage["seconds"] else 0
+            )
+        )
+    for table, count in stats["inserted"].items():
+        print("Inserted {} rows into {}".format(count, table))
+
+
+def create_app(config_overrides=None):
+    """Creates and sets up the application.
+
+    Args:
+        config_overrides (dict, optional): Settings overriding those of config/config.py. Defaults to None.
+
+    Returns:
+        Flask: The application. Creating it doesn't connect to the database, whose schema is created
+        and migrated beforehand with `flask init-db`.
+    """
+    app = Flask(__name__)
+    # Writes the pre-rendered documents of the read model into the responses as they are
+    app.json = BookJSONProvider(app)
+    app.config.update(config)
+    app.config.update(config_overrides or {})
+    db.init_app(app)
+    init_instrumentation(app)
+    # Registered after the instrumentation, so its after_request hook runs first and is timed
+    init_compression(app)
+    app.register_blueprint(api)
+
+    return app
+
+
+# The application served by the development server, gunicorn (see gunicorn.conf.py) and the flask CLI
+app = create_app()
 
 if __name__ == "__main__":
+    # Development server only, run `gunicorn -c gunicorn.conf.py` in production
     app.run(host="0.0.0.0")
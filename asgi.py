@@ -0,0 +1,219 @@
+"""
+Async serving mode of the Book API.
+
+An ASGI application (Starlette, served by uvicorn) for the I/O-bound endpoints, where a thread per request is the
+bottleneck of the sync app: the OpenLibrary imports, which wait on remote requests, and the import progress streams,
+which stay open until their job completes. They run on an asyncio event loop with SQLAlchemy's AsyncSession
+(aiosqlite or asyncpg) and an httpx client, and answer with the same JSON contract as app.py. Every other route is
+the Flask application itself, mounted through a WSGI adapter, so the reads keep their response cache, compression,
+ETags and catalog snapshot and there is a single implementation of each endpoint.
+
+The async routes run the same session-taking functions of db_operations and utils/db_utils through
+AsyncSession.run_sync, so the database logic is shared with the sync app rather than duplicated.
+
+Native async endpoints:
+
+/store_openlib_books: Stores books from OpenLibrary (large batches in a background import job).
+/imports/<job_id>: Returns (or streams) the progress of an import job.
+
+Run with `uvicorn asgi:asgi_app` after installing requirements-async.txt.
+
+- async_database_uri(db_uri): Returns the URI of a database with its asyncio driver.
+- create_asgi_app(flask_app): Creates the ASGI application around a Flask application.
+- asgi_app: The ASGI application around the module level app of app.py.
+"""
+
+import asyncio
+import contextlib
+import json
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+import db_operations
+from app import app
+from config.config import async_engine_options
+from import_workers import notify_import_workers, start_import_workers, stop_import_workers
+from utils.async_openlib_client import create_async_client, fetch_openlib_books_async
+from utils.app_utils import summarize_import
+from utils.catalog_snapshot import start_catalog_snapshot
+from utils.db_utils import insert_books_to_db
+from utils.openlib_cache import get_cache
+from utils.openlib_client import get_client
+
+try:
+    from starlette.applications import Starlette
+    from starlette.responses import Response, StreamingResponse
+    from starlette.routing import Mount, Route
+except ImportError:  # pragma: no cover - optional dependency
+    Starlette = None
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:  # pragma: no cover - optional dependency
+    WSGIMiddleware = None
+
+# asyncio drivers of the database backends
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def async_database_uri(db_uri):
+    url = make_url(db_uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError("No asyncio driver for the '{}' database backend.".format(backend))
+    return url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+
+def create_asgi_app(flask_app):
+    """Creates the ASGI application around a Flask application.
+
+    Args:
+        flask_app (Flask): The application serving every route without an async implementation, whose
+            configuration and database the async routes share.
+
+    Returns:
+        Starlette: The ASGI application.
+    """
+    if Starlette is None or WSGIMiddleware is None:
+        raise RuntimeError("The async serving mode requires the packages of requirements-async.txt.")
+
+    settings = flask_app.config
+    state = {}  # Engine, session factory and OpenLibrary client of the running event loop
+
+    def json_response(obj, status_code=200, headers=None):
+        # Same body as jsonify (compact, sorted keys, trailing newline)
+        body = flask_app.json.dumps(obj, separators=(",", ":")) + "\n"
+        return Response(body, status_code, headers, media_type="application/json")
+
+    @contextlib.asynccontextmanager
+    async def lifespan(_):
+        uri = settings["SQLALCHEMY_DATABASE_URI"]
+        state["engine"] = create_async_engine(async_database_uri(uri), **async_engine_options(uri))
+        state["sessions"] = async_sessionmaker(state["engine"], expire_on_commit=False)
+        # The shared sync client and document cache of the process take the settings of the wrapped application
+        with flask_app.app_context():
+            get_client()
+            get_cache()
+        state["client"] = create_async_client(settings)
+        # The background import workers and the catalog snapshot of the process, as in the sync app
+        start_import_workers(flask_app)
+        start_catalog_snapshot(flask_app)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(stop_import_workers)
+            await state["client"].aclose()
+            await state["engine"].dispose()
+
+    async def read_json(request):
+        # The request.get_json() of Flask: 415 without a JSON body, 400 when it can't be decoded
+        if request.headers.get("content-type", "").split(";")[0].strip() != "application/json":
+            return None, Response("Unsupported Media Type", 415)
+        try:
+            return json.loads(await request.body()), None
+        except ValueError:
+            return None, Response("Bad Request", 400)
+
+    async def store_openlib_books(request):
+        data, error = await read_json(request)
+        if error is not None:
+            return error
+
+        if not isinstance(data, dict) or "codes" not in data:
+            # Same (status 200) body as the sync app
+            return json_response([{"error": "Invalid code list provided."}, 400])
+
+        codes = data["codes"]
+        if data.get("async") or len(codes) > settings["IMPORT_ASYNC_THRESHOLD"]:
+            # Import the books in the background
+            async with state["sessions"]() as session:
+                job_id = await session.run_sync(
+                    lambda sync_session: db_operations.enqueue_import_job(codes, sync_session)
+                )
+            notify_import_workers()
+            status_url = str(request.app.url_path_for("get_import_job", job_id=job_id))
+            return json_response(
+                {"job_id": job_id, "status_url": status_url}, 202, {"Location": status_url}
+            )
+
+        async def lookup_known(keys):
+            # The books look their keys up concurrently, each in its own short session, so no
+            # session is shared between tasks and no connection is held while waiting on OpenLibrary
+            async with state["sessions"]() as session:
+                return await session.run_sync(
+                    lambda sync_session: db_operations.retrieve_known_openlib_documents(keys, sync_session)
+                )
+
+        # Fetch all the books, authors and works concurrently
+        # (authors and works already in the database are not requested again)
+        books = await fetch_openlib_books_async(
+            state["client"],
+            codes,
+            max_concurrency=settings["OPENLIB_MAX_WORKERS"],
+            lookup_known=lookup_known,
+        )
+
+        # Store all the fetched books in a single batch, in a session of its own
+        books_data = [books[code] for code in codes if isinstance(books[code], dict)]
+        async with state["sessions"]() as session:
+            try:
+                results = await session.run_sync(insert_books_to_db, books_data, from_openlib=True)
+            except Exception as e:
+                # Roll back the whole batch in case of an exception
+                await session.rollback()
+                messages = [{"error": str(e)} for _ in books_data]
+            else:
+                db_operations.invalidate_cached_responses()
+                messages = db_operations.store_results(books_data, results, from_openlib=True)
+
+        added_books, skipped_books = summarize_import(codes, books, messages)
+        return json_response({"added_books": added_books, "skipped_books": skipped_books})
+
+    async def get_import_job(request):
+        job_id = request.path_params["job_id"]
+        details = request.query_params.get("details") == "true"
+
+        async def retrieve(with_details=details):
+            async with state["sessions"]() as session:
+                return await session.run_sync(
+                    lambda sync_session: db_operations.retrieve_import_job(
+                        job_id, with_details, sync_session
+                    )
+                )
+
+        if request.query_params.get("stream") == "true":
+            if await retrieve(False) is None:
+                return json_response({"error": "Import job not found."}, 404)
+
+            async def events():
+                # A coroutine per open stream instead of a thread, each read in a short session
+                last = None
+                while True:
+                    job = await retrieve()
+                    if job != last:
+                        yield "data: {}\n\n".format(flask_app.json.dumps(job))
+                        last = job
+                    if job["status"] == "completed":
+                        return
+                    await asyncio.sleep(settings["IMPORT_POLL_INTERVAL"])
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        job = await retrieve()
+        if job is None:
+            return json_response({"error": "Import job not found."}, 404)
+
+        return json_response(job)
+
+    return Starlette(
+        routes=[
+            Route("/store_openlib_books", store_openlib_books, methods=["POST"]),
+            Route("/imports/{job_id}", get_import_job, methods=["GET"], name="get_import_job"),
+            # Every other route is served by the Flask application, in a thread pool
+            Mount("/", WSGIMiddleware(flask_app)),
+        ],
+        lifespan=lifespan,
+    )
+
+
+# The application served by `uvicorn asgi:asgi_app`
+asgi_app = create_asgi_app(app) if Starlette is not None and WSGIMiddleware is not None else None
@@ -0,0 +1,202 @@
+"""
+Sync vs async serving mode benchmark.
+
+Starts the sync app (gunicorn, see gunicorn.conf.py) and the async serving mode (uvicorn, see asgi.py) one after
+the other on the same freshly initialized database, with OPENLIB_URL_BASE pointing at a stub OpenLibrary server
+with a fixed latency. Every server is then driven at increasing concurrency levels, for a fixed duration each,
+with a scenario of the request mix:
+
+- import: POST /store_openlib_books with a few synthetic codes (fetched inline, waiting on the stub);
+- search: GET /books/search by author (served by the Flask routes in both modes).
+
+It reports the throughput, the p50/p95/p99 latency and the errors per level, plus the threads and resident memory
+of the server processes at the end of each level. Requires the packages of requirements-async.txt.
+
+Usage:
+    python benchmarks/bench_async.py --levels 1,10,100,1000 --duration 20 --latency 0.05 --output async.json
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import ROOT, latency_stats, write_results
+from benchmarks.datagen import LAST_NAMES
+from benchmarks.stub_openlib import StubOpenLibraryServer
+
+
+def server_command(mode, port, workers, threads):
+    if mode == "sync":
+        return [
+            sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+            "--bind", "127.0.0.1:{}".format(port), "--workers", str(workers), "--threads", str(threads),
+        ]
+    return [
+        sys.executable, "-m", "uvicorn", "asgi:asgi_app",
+        "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--no-access-log",
+    ]
+
+
+def process_usage(pid):
+    # Threads and resident memory of a server process and its workers (Linux only)
+    usage = {"threads": 0, "rss_bytes": 0}
+    pids = [pid]
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as f:
+            pids += [int(child) for child in f.read().split()]
+        for p in pids:
+            with open("/proc/{}/status".format(p)) as f:
+                for line in f:
+                    if line.startswith("Threads:"):
+                        usage["threads"] += int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        usage["rss_bytes"] += int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return usage
+
+
+async def wait_until_up(url, timeout=30):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.perf_counter() < deadline:
+            try:
+                await client.get(url + "/cache/stats")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError("The server at {} did not start.".format(url))
+
+
+async def drive(url, scenario, concurrency, duration, codes_per_import):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+
+        async def worker(seed):
+            nonlocal errors
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    if scenario == "import":
+                        codes = [
+                            "SYN{:08d}M".format(rng.randrange(10_000_000)) for _ in range(codes_per_import)
+                        ]
+                        response = await client.post("/store_openlib_books", json={"codes": codes})
+                    else:
+                        params = {"author": rng.choice(LAST_NAMES)}
+                        response = await client.get("/books/search", params=params)
+                    ok = response.status_code < 500
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append(time.perf_counter() - start)
+                errors += not ok
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(seed) for seed in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    stats = latency_stats(latencies)
+    stats["throughput"] = len(latencies) / elapsed
+    stats["errors"] = errors
+    return stats
+
+
+def run_mode(mode, args, stub, port):
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_async.db")
+    env = dict(
+        os.environ,
+        DB_URI="sqlite:///{}".format(db_path),
+        OPENLIB_URL_BASE=stub.url_base,
+        OPENLIB_CACHE_PATH="",
+        IMPORT_WORKERS="0",
+    )
+    subprocess.run([sys.executable, "-m", "flask", "--app", "app", "init-db"], cwd=ROOT, env=env, check=True)
+
+    url = "http://127.0.0.1:{}".format(port)
+    server = subprocess.Popen(
+        server_command(mode, port, args.workers, args.threads),
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    results = {}
+    try:
+        asyncio.run(wait_until_up(url))
+        for scenario in args.scenarios.split(","):
+            for level in (int(level) for level in args.levels.split(",")):
+                stats = asyncio.run(drive(url, scenario, level, args.duration, args.codes))
+                stats["process"] = process_usage(server.pid)
+                results["{}/{}/c{}".format(mode, scenario, level)] = stats
+                print(
+                    "{:<6} {:<7} {:>5} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7}".format(
+                        mode,
+                        scenario,
+                        level,
+                        stats["throughput"],
+                        stats["p50"] * 1000,
+                        stats["p95"] * 1000,
+                        stats["p99"] * 1000,
+                        stats["errors"],
+                    )
+                )
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the sync and async serving modes under concurrency.")
+    parser.add_argument("--levels", default="1,10,100,1000", help="Comma separated concurrency levels")
+    parser.add_argument("--scenarios", default="import,search", help="Comma separated scenarios")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per level")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds of the stub OpenLibrary responses")
+    parser.add_argument("--codes", type=int, default=5, help="Codes per import request")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes of both modes")
+    parser.add_argument("--threads", type=int, default=4, help="Threads per gunicorn worker")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--modes", default="sync,async")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    stub = StubOpenLibraryServer(latency=args.latency).start()
+    print("{:<6} {:<7} {:>5} {:>8} {:>9} {:>9} {:>9} {:>7}".format(
+        "mode", "scenario", "conc", "req/s", "p50 (ms)", "p95 (ms)", "p99 (ms)", "errors"
+    ))
+    results = {}
+    try:
+        for mode in args.modes.split(","):
+            results.update(run_mode(mode, args, stub, args.port))
+    finally:
+        stub.stop()
+
+    if args.output:
+        write_results(
+            args.output,
+            "bench_async",
+            results,
+            levels=args.levels,
+            duration=args.duration,
+            stub_latency=args.latency,
+            workers=args.workers,
+            threads=args.threads,
+        )
+
+
+if __name__ == "__main__":
+    main()
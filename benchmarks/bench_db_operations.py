@@ -0,0 +1,162 @@
+"""
+Micro benchmarks of the database operations.
+
+Seeds a synthetic catalog, then times the functions of db_operations with pytest-benchmark style statistics
+(min, max, mean, stddev, median, iqr, ops). Writes are measured on fresh books that are cleaned up outside of
+the timed section.
+
+Usage:
+    python benchmarks/bench_db_operations.py --db-uri sqlite:///bench.db --books 10000 --output db_ops.json
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import bench_stats, write_results
+
+
+def run_benchmark(fn, rounds, warmup=1, setup=None, teardown=None):
+    timings = []
+    for i in range(warmup + rounds):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        if teardown:
+            teardown(result, *args)
+        if i >= warmup:
+            timings.append(elapsed)
+    return bench_stats(timings)
+
+
+def benchmarks(db_operations, books, batch_size):
+    from benchmarks.datagen import synthetic_author
+
+    rng = random.Random(1)
+    counter = iter(range(10**9))
+
+    def new_book():
+        i = next(counter)
+        return {
+            "id": "BENCH{:08d}M".format(i),
+            "title": "Benchmark Book {}".format(i),
+            "number_of_pages": 300,
+            # Link the new books to a prolific author, the worst case for orphan cleanup
+            "authors": [synthetic_author(0), {"id": "BENCH{:08d}A".format(i), "name": "Bench"}],
+            "works": [{"id": "BENCH{:08d}W".format(i), "title": "Benchmark Work"}],
+        }
+
+    def stored(count):
+        new_books = [new_book() for _ in range(count)]
+        db_operations.store_books(new_books)
+        return [book["id"] for book in new_books]
+
+    prolific_author = synthetic_author(0)["name"]
+    return {
+        "retrieve_all_books": (lambda: db_operations.retrieve_all_books(), None, None),
+        "retrieve_books_page": (
+            lambda cursor: db_operations.retrieve_books_page(100, cursor),
+            lambda: ("SYN{:08d}M".format(rng.randrange(books)),),
+            None,
+        ),
+        "search_prolific_author": (
+            lambda: db_operations.retrieve_books_by_criteria(prolific_author, None, None),
+            None,
+            None,
+        ),
+        "count_prolific_author": (
+            lambda: db_operations.count_books_by_criteria(prolific_author, None, None),
+            None,
+            None,
+        ),
+        "search_work_and_min_pages": (
+            lambda: db_operations.retrieve_books_by_criteria(None, "Shining Misery", 1000),
+            None,
+            None,
+        ),
+        "store_book": (
+            lambda book: db_operations.store_book(book),
+            lambda: (new_book(),),
+            lambda result, book: db_operations.remove_book(book["id"]),
+        ),
+        "store_books_batch": (
+            lambda new_books: db_operations.store_books(new_books),
+            lambda: ([new_book() for _ in range(batch_size)],),
+            lambda result, new_books: db_operations.remove_books([b["id"] for b in new_books]),
+        ),
+        "remove_book": (
+            lambda book_id: db_operations.remove_book(book_id),
+            lambda: (stored(1)[0],),
+            None,
+        ),
+        "remove_books_batch": (
+            lambda book_ids: db_operations.remove_books(book_ids),
+            lambda: (stored(batch_size),),
+            None,
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmarks of db_operations.")
+    parser.add_argument("--db-uri", help="Database to use (defaults to a temporary SQLite file)")
+    parser.add_argument("--books", type=int, default=10000, help="Size of the synthetic catalog")
+    parser.add_argument("--no-seed", action="store_true", help="Use the already seeded catalog")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--only", nargs="*", help="Names of the benchmarks to run")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.TemporaryDirectory()
+    db_uri = args.db_uri or "sqlite:///" + os.path.join(tmpdir.name, "bench.db")
+
+    # The application reads its configuration at import time
+    os.environ["DB_URI"] = db_uri
+    os.environ.setdefault("OPENLIB_CACHE_PATH", "")
+    os.environ.setdefault("RESPONSE_CACHE_BACKEND", "none")
+
+    from benchmarks.datagen import seed_catalog
+    from app import app
+    from db import db
+    import db_operations
+
+    with app.app_context():
+        if not args.no_seed:
+            seed_catalog(db.engine, args.books)
+
+        results = {}
+        print("{:<28} {:>10} {:>10} {:>10} {:>10}".format("benchmark", "min (ms)", "mean (ms)", "max (ms)", "ops/s"))
+        for name, (fn, setup, teardown) in benchmarks(db_operations, args.books, args.batch_size).items():
+            if args.only and name not in args.only:
+                continue
+            # Full scans get fewer rounds
+            rounds = max(3, args.rounds // 5) if name == "retrieve_all_books" else args.rounds
+            stats = run_benchmark(fn, rounds, setup=setup, teardown=teardown)
+            results[name] = stats
+            print(
+                "{:<28} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.1f}".format(
+                    name, stats["min"] * 1000, stats["mean"] * 1000, stats["max"] * 1000, stats["ops"]
+                )
+            )
+
+    if args.output:
+        write_results(
+            args.output,
+            "db_operations",
+            results,
+            books=args.books,
+            dialect=db_uri.split(":")[0],
+        )
+
+    tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Benchmark of the association table keys and indexes.
+
+Seeds a database with the legacy schema (association tables without primary keys or indexes, no
+index on books.number_of_pages) with a synthetic catalog, times the joins and filters used by the
+API, applies the schema migrations and times them again.
+
+Usage:
+    python benchmarks/bench_indexes.py [--books 200000] [--db-uri sqlite:///bench.db] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+from migrations import run_migrations
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE books (id VARCHAR PRIMARY KEY, title VARCHAR NOT NULL, number_of_pages INTEGER)",
+    "CREATE TABLE authors (id VARCHAR PRIMARY KEY, name VARCHAR NOT NULL)",
+    "CREATE TABLE works (id VARCHAR PRIMARY KEY, title VARCHAR NOT NULL)",
+    "CREATE TABLE book_author_association (book_id VARCHAR REFERENCES books (id), "
+    "author_id VARCHAR REFERENCES authors (id))",
+    "CREATE TABLE book_work_association (book_id VARCHAR REFERENCES books (id), "
+    "work_id VARCHAR REFERENCES works (id))",
+]
+
+# Queries issued by the API, with a function drawing their parameters
+QUERIES = {
+    "author_books_join": (
+        "SELECT books.id, books.title FROM books JOIN book_author_association "
+        "ON book_author_association.book_id = books.id "
+        "WHERE book_author_association.author_id = :id",
+        lambda n: {"id": "A{}".format(random.randrange(n // 5))},
+    ),
+    "work_books_join": (
+        "SELECT books.id, books.title FROM books JOIN book_work_association "
+        "ON book_work_association.book_id = books.id "
+        "WHERE book_work_association.work_id = :id",
+        lambda n: {"id": "W{}".format(random.randrange(n // 2))},
+    ),
+    "book_authors_load": (
+        "SELECT authors.id, authors.name FROM authors JOIN book_author_association "
+        "ON book_author_association.author_id = authors.id "
+        "WHERE book_author_association.book_id = :id",
+        lambda n: {"id": "B{}".format(random.randrange(n))},
+    ),
+    "min_pages_filter": (
+        "SELECT books.id FROM books WHERE books.number_of_pages >= :pages",
+        lambda n: {"pages": random.randint(1990, 2000)},
+    ),
+}
+
+
+def seed(engine, books):
+    rng = random.Random(42)
+    with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.execute(text(statement))
+
+        conn.execute(
+            text("INSERT INTO authors (id, name) VALUES (:id, :name)"),
+            [{"id": "A{}".format(i), "name": "Author {}".format(i)} for i in range(books // 5)],
+        )
+        conn.execute(
+            text("INSERT INTO works (id, title) VALUES (:id, :title)"),
+            [{"id": "W{}".format(i), "title": "Work {}".format(i)} for i in range(books // 2)],
+        )
+        conn.execute(
+            text("INSERT INTO books (id, title, number_of_pages) VALUES (:id, :title, :pages)"),
+            [
+                {"id": "B{}".format(i), "title": "Book {}".format(i), "pages": rng.randint(1, 2000)}
+                for i in range(books)
+            ],
+        )
+        conn.execute(
+            text("INSERT INTO book_author_association (book_id, author_id) VALUES (:b, :a)"),
+            [
+                {"b": "B{}".format(i), "a": "A{}".format(rng.randrange(books // 5))}
+                for i in range(books)
+                for _ in range(rng.randint(1, 2))
+            ],
+        )
+        conn.execute(
+            text("INSERT INTO book_work_association (book_id, work_id) VALUES (:b, :w)"),
+            [{"b": "B{}".format(i), "w": "W{}".format(i // 2)} for i in range(books)],
+        )
+
+
+def time_queries(engine, books, repeat):
+    results = {}
+    with engine.connect() as conn:
+        for name, (sql, params) in QUERIES.items():
+            random.seed(7)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(text(sql), params(books)).all()
+            results[name] = (time.perf_counter() - start) / repeat * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--books", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--db-uri", help="Empty database to use (defaults to a temporary SQLite file)")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.TemporaryDirectory()
+    db_uri = args.db_uri or "sqlite:///" + os.path.join(tmpdir.name, "bench.db")
+    engine = create_engine(db_uri)
+
+    print("Seeding {} books...".format(args.books))
+    seed(engine, args.books)
+
+    before = time_queries(engine, args.books, args.repeat)
+    start = time.perf_counter()
+    run_migrations(engine)
+    migration_seconds = time.perf_counter() - start
+    after = time_queries(engine, args.books, args.repeat)
+
+    print("Migration took {:.2f}s".format(migration_seconds))
+    print("{:<20} {:>12} {:>12} {:>9}".format("query", "before (ms)", "after (ms)", "speedup"))
+    for name in QUERIES:
+        print(
+            "{:<20} {:>12.3f} {:>12.3f} {:>8.1f}x".format(
+                name, before[name], after[name], before[name] / after[name]
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "books": args.books,
+                    "dialect": engine.dialect.name,
+                    "migration_seconds": migration_seconds,
+                    "before_ms": before,
+                    "after_ms": after,
+                },
+                f,
+                indent=2,
+            )
+
+    engine.dispose()
+    tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
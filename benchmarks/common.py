@@ -0,0 +1,83 @@
+"""
+Shared helpers of the benchmarks.
+
+- bench_stats(timings): Summarizes a list of timings in seconds (pytest-benchmark style statistics).
+- latency_stats(latencies): Summarizes request latencies with their p50/p95/p99 percentiles.
+- machine_info(): Describes the machine, interpreter and commit the benchmark ran on.
+- write_results(path, kind, results, **extra): Writes the results of a run as machine-readable JSON.
+"""
+
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile of already sorted values
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(q / 100 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+def bench_stats(timings):
+    timings = sorted(timings)
+    quartiles = statistics.quantiles(timings, n=4) if len(timings) > 1 else [timings[0]] * 3
+    mean = statistics.fmean(timings)
+    return {
+        "rounds": len(timings),
+        "min": timings[0],
+        "max": timings[-1],
+        "mean": mean,
+        "stddev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        "median": statistics.median(timings),
+        "iqr": quartiles[2] - quartiles[0],
+        "ops": 1 / mean if mean else 0.0,
+    }
+
+
+def latency_stats(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "mean": statistics.fmean(latencies) if latencies else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else 0.0,
+    }
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "commit": commit or None,
+    }
+
+
+def write_results(path, kind, results, **extra):
+    document = {
+        "kind": kind,
+        "datetime": datetime.now(timezone.utc).isoformat(),
+        "machine_info": machine_info(),
+        **extra,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
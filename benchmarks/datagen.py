@@ -0,0 +1,157 @@
+"""
+Synthetic catalog generator.
+
+Seeds a database with a deterministic synthetic catalog of books, authors and works, streaming the rows in batches
+so that memory stays flat from 10k to 10M books. Author popularity follows a power law, so a few prolific authors
+have thousands of books, like on OpenLibrary.
+
+- synthetic_book(i, authors, works): Builds the data of the i-th synthetic book in the format of POST /books.
+- seed_catalog(engine, books, batch_size): Creates the schema and inserts the synthetic catalog.
+
+Usage:
+    python benchmarks/datagen.py --db-uri sqlite:///bench.db --books 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from migrations import init_database
+from models.Book import Book
+from models.Author import Author
+from models.Work import Work
+from models.associations.book_author_association import book_author_assoc_table
+from models.associations.book_work_association import book_work_assoc_table
+from utils.db_utils import insert_ignore_conflicts, sync_book_documents
+
+FIRST_NAMES = ["Stephen", "Jane", "George", "Ursula", "Terry", "Agatha", "Isaac", "Mary", "Neil", "Octavia"]
+LAST_NAMES = ["King", "Austen", "Martin", "Le Guin", "Pratchett", "Christie", "Asimov", "Shelley", "Gaiman", "Butler"]
+WORDS = ["Shining", "Misery", "Dragon", "Night", "Empire", "Garden", "Winter", "Stone", "River", "Crown", "Shadow", "Glass"]
+
+
+def author_count(books):
+    return max(1, books // 5)
+
+
+def work_count(books):
+    return max(1, books // 2)
+
+
+def synthetic_author(i):
+    rng = random.Random(i)
+    return {
+        "id": "SYN{:08d}A".format(i),
+        "name": "{} {} {}".format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), i),
+    }
+
+
+def synthetic_work(i):
+    rng = random.Random(-i - 1)
+    return {
+        "id": "SYN{:08d}W".format(i),
+        "title": "The {} {} {}".format(rng.choice(WORDS), rng.choice(WORDS), i),
+    }
+
+
+def synthetic_book(i, authors, works):
+    rng = random.Random(i)
+    # Power-law popularity: low author ids get most of the books
+    author_ids = {int(authors * rng.random() ** 3) for _ in range(rng.choice([1, 1, 1, 2, 3]))}
+    book = {
+        "id": "SYN{:08d}M".format(i),
+        "title": synthetic_work(i % works)["title"],
+        "authors": [synthetic_author(a) for a in sorted(author_ids)],
+        "works": [synthetic_work(i % works)],
+    }
+    if rng.random() < 0.9:
+        book["number_of_pages"] = rng.randint(20, 1500)
+    return book
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed_catalog(engine, books, batch_size=10000, progress=True):
+    # Create the schema the same way the application does
+    init_database(engine)
+
+    authors = author_count(books)
+    works = work_count(books)
+    start = time.perf_counter()
+
+    with Session(engine) as session:
+        for table, rows in [
+            (Author.__table__, (synthetic_author(i) for i in range(authors))),
+            (Work.__table__, (synthetic_work(i) for i in range(works))),
+        ]:
+            for batch in _batches(rows, batch_size):
+                insert_ignore_conflicts(session, table, batch)
+                session.commit()
+
+        inserted = 0
+        for batch in _batches((synthetic_book(i, authors, works) for i in range(books)), batch_size):
+            insert_ignore_conflicts(
+                session,
+                Book.__table__,
+                [
+                    {"id": b["id"], "title": b["title"], "number_of_pages": b.get("number_of_pages")}
+                    for b in batch
+                ],
+            )
+            insert_ignore_conflicts(
+                session,
+                book_author_assoc_table,
+                [{"book_id": b["id"], "author_id": a["id"]} for b in batch for a in b["authors"]],
+            )
+            insert_ignore_conflicts(
+                session,
+                book_work_assoc_table,
+                [{"book_id": b["id"], "work_id": w["id"]} for b in batch for w in b["works"]],
+            )
+            # Render the read model like the application write paths
+            sync_book_documents(session, [b["id"] for b in batch])
+            session.commit()
+
+            inserted += len(batch)
+            if progress:
+                elapsed = time.perf_counter() - start
+                print(
+                    "\r{}/{} books ({:.0f} books/s)".format(inserted, books, inserted / elapsed),
+                    end="",
+                    flush=True,
+                )
+
+    if progress:
+        print()
+    return {"books": books, "authors": authors, "works": works, "seconds": time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a database with a synthetic catalog.")
+    parser.add_argument("--db-uri", default=os.getenv("DB_URI"), required=os.getenv("DB_URI") is None)
+    parser.add_argument("--books", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    engine = create_engine(args.db_uri)
+    result = seed_catalog(engine, args.books, args.batch_size)
+    print("Seeded {books} books, {authors} authors and {works} works in {seconds:.1f}s".format(**result))
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Concurrent HTTP load driver.
+
+Sends a weighted mix of requests to every endpoint of a running API from many threads for a fixed duration and
+reports the p50/p95/p99 latency, throughput and errors per endpoint.
+
+The write scenarios create and delete their own BENCH* books. The import scenario requests synthetic codes, so
+the API must point at the stub server (OPENLIB_URL_BASE, see benchmarks/stub_openlib.py), and the catalog should
+be seeded with benchmarks/datagen.py.
+
+Usage:
+    python benchmarks/load_test.py --url http://localhost:5000 --concurrency 32 --duration 30 --output load.json
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import latency_stats, write_results
+
+# Scenario name -> relative weight in the request mix
+DEFAULT_MIX = {
+    "list_page": 30,
+    "list_all": 1,
+    "search_author": 25,
+    "search_work_min_pages": 15,
+    "create_book": 10,
+    "delete_book": 10,
+    "store_openlib_books": 2,
+}
+
+
+class LoadDriver:
+    def __init__(self, url, books, mix):
+        self.url = url.rstrip("/")
+        self.books = books
+        self.scenarios = list(mix)
+        self.weights = [mix[name] for name in self.scenarios]
+        self.ids = itertools.count()
+        self.created = []  # Book ids available to the delete scenario
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def request(self, session, rng, scenario):
+        if scenario == "list_page":
+            cursor = "SYN{:08d}M".format(rng.randrange(self.books))
+            return session.get(self.url + "/books", params={"limit": 100, "cursor": cursor})
+        if scenario == "list_all":
+            return session.get(self.url + "/books")
+        if scenario == "search_author":
+            return session.get(self.url + "/books/search", params={"author": rng.choice(["King", "Austen", "Le Guin"])})
+        if scenario == "search_work_min_pages":
+            return session.get(
+                self.url + "/books/search", params={"work": rng.choice(["Shining", "Stone"]), "min_pages": 1000}
+            )
+        if scenario == "create_book":
+            i = next(self.ids)
+            book_id = "BENCHLOAD{}P{}M".format(os.getpid(), i)
+            response = session.post(
+                self.url + "/books",
+                json={
+                    "id": book_id,
+                    "title": "Load Book",
+                    "number_of_pages": 100,
+                    "authors": [{"id": "BENCHLOADA", "name": "Load Author"}],
+                    "works": [{"id": "BENCHLOADW", "title": "Load Work"}],
+                },
+            )
+            with self.lock:
+                self.created.append(book_id)
+            return response
+        if scenario == "delete_book":
+            with self.lock:
+                book_id = self.created.pop() if self.created else "BENCHMISSINGM"
+            return session.delete(self.url + "/books/" + book_id)
+        if scenario == "store_openlib_books":
+            codes = ["SYN{:08d}M".format(rng.randrange(10_000_000)) for _ in range(10)]
+            return session.post(self.url + "/store_openlib_books", json={"codes": codes})
+        raise ValueError(scenario)
+
+    def worker(self, seed, deadline):
+        rng = random.Random(seed)
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(self.scenarios, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                response = self.request(session, rng, scenario)
+                ok = response.status_code < 500
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.latencies[scenario].append(elapsed)
+                if not ok:
+                    self.errors[scenario] += 1
+
+    def run(self, concurrency, duration):
+        deadline = time.perf_counter() + duration
+        threads = [
+            threading.Thread(target=self.worker, args=(seed, deadline)) for seed in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        # Clean up the books created by the run
+        if self.created:
+            requests.delete(self.url + "/books", json={"ids": self.created})
+
+        results = {}
+        for scenario, latencies in self.latencies.items():
+            stats = latency_stats(latencies)
+            stats["throughput"] = len(latencies) / elapsed
+            stats["errors"] = self.errors[scenario]
+            results[scenario] = stats
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return results, {"requests": total, "seconds": elapsed, "throughput": total / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent HTTP load test of the API.")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="Seconds")
+    parser.add_argument("--books", type=int, default=10000, help="Size of the seeded synthetic catalog")
+    parser.add_argument(
+        "--mix",
+        help="Comma separated scenario=weight pairs (default: {})".format(
+            ",".join("{}={}".format(k, v) for k, v in DEFAULT_MIX.items())
+        ),
+    )
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    mix = DEFAULT_MIX
+    if args.mix:
+        mix = {name: float(weight) for name, weight in (pair.split("=") for pair in args.mix.split(","))}
+
+    driver = LoadDriver(args.url, args.books, mix)
+    results, summary = driver.run(args.concurrency, args.duration)
+
+    print("{:<24} {:>8} {:>9} {:>9} {:>9} {:>9} {:>7}".format("endpoint", "requests", "p50 (ms)", "p95 (ms)", "p99 (ms)", "req/s", "errors"))
+    for scenario, stats in sorted(results.items()):
+        print(
+            "{:<24} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7}".format(
+                scenario,
+                stats["count"],
+                stats["p50"] * 1000,
+                stats["p95"] * 1000,
+                stats["p99"] * 1000,
+                stats["throughput"],
+                stats["errors"],
+            )
+        )
+    print("Total: {requests} requests in {seconds:.1f}s ({throughput:.1f} req/s)".format(**summary))
+
+    if args.output:
+        write_results(
+            args.output,
+            "load_test",
+            results,
+            summary=summary,
+            url=args.url,
+            concurrency=args.concurrency,
+            duration=args.duration,
+            mix=mix,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Stub OpenLibrary server.
+
+Serves deterministic synthetic OpenLibrary documents for the codes generated by benchmarks/datagen.py, with a
+configurable latency, so that imports can be benchmarked without hitting the real API.
+
+- StubOpenLibraryServer(port, latency): A threaded HTTP server answering /books/<code>.json, /authors/<key>.json
+  and /works/<key>.json.
+
+Usage:
+    python benchmarks/stub_openlib.py --port 8081 --latency 0.05
+    OPENLIB_URL_BASE=http://127.0.0.1:8081 flask --app app run
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.datagen import synthetic_author, synthetic_book, synthetic_work
+
+# Size of the catalog the synthetic codes refer to
+STUB_CATALOG_SIZE = 10_000_000
+
+PATH_PATTERN = re.compile(r"^/(books|authors|works)/SYN(\d{8})[MAW]\.json$")
+
+
+class StubOpenLibraryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+    latency = 0.0
+
+    def document(self, kind, i):
+        if kind == "authors":
+            author = synthetic_author(i)
+            return {"key": "/authors/" + author["id"], "name": author["name"]}
+        if kind == "works":
+            work = synthetic_work(i)
+            return {"key": "/works/" + work["id"], "title": work["title"]}
+
+        book = synthetic_book(
+            i, max(1, STUB_CATALOG_SIZE // 5), max(1, STUB_CATALOG_SIZE // 2)
+        )
+        document = {
+            "key": "/books/" + book["id"],
+            "title": book["title"],
+            "authors": [{"key": "/authors/" + a["id"]} for a in book["authors"]],
+            "works": [{"key": "/works/" + w["id"]} for w in book["works"]],
+        }
+        if "number_of_pages" in book:
+            document["number_of_pages"] = book["number_of_pages"]
+        return document
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        match = PATH_PATTERN.match(self.path)
+        if match is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = json.dumps(self.document(match.group(1), int(match.group(2)))).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubOpenLibraryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0):
+        handler = type("Handler", (StubOpenLibraryHandler,), {"latency": latency})
+        super().__init__(("127.0.0.1", port), handler)
+
+    @property
+    def url_base(self):
+        return "http://127.0.0.1:{}".format(self.server_port)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic OpenLibrary documents.")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every response")
+    args = parser.parse_args()
+
+    server = StubOpenLibraryServer(args.port, args.latency)
+    print("Serving stub OpenLibrary on {}".format(server.url_base))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
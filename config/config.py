@@ -1,15 +1,185 @@
 """
 Configuration module for loading environment variables and setting up the application.
 
-- config: A dictionary containing configuration options, including the SQLAlchemy database URI.
+- engine_options(db_uri): Builds the SQLAlchemy engine options (connection pool, timeouts, server-side cursors)
+  from the DB_* environment variables and the DB_PROFILE defaults.
+- async_engine_options(db_uri): Builds the options of the asyncio engine of the async serving mode (asgi.py).
+- config: A dictionary containing configuration options, including the SQLAlchemy database URI and engine options
+  and the OpenLibrary fetch settings.
 """
 
 from dotenv import load_dotenv
 import os
+from utils.pool_metrics import InstrumentedQueuePool
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Engine defaults of every DB_PROFILE, overridable by the matching DB_* variables
+DB_PROFILES = {
+    "default": {},
+    "production": {
+        "DB_POOL_SIZE": 10,
+        "DB_MAX_OVERFLOW": 10,
+        "DB_POOL_TIMEOUT": 10,
+        "DB_POOL_RECYCLE": 1800,
+        "DB_POOL_PRE_PING": "true",
+        "DB_POOL_USE_LIFO": "true",
+        "DB_STATEMENT_TIMEOUT_MS": 30000,
+    },
+}
+
+
+# Connection pool settings: variable, engine option and type
+POOL_SETTINGS = [
+    ("DB_POOL_SIZE", "pool_size", int),
+    ("DB_MAX_OVERFLOW", "max_overflow", int),
+    ("DB_POOL_TIMEOUT", "pool_timeout", float),
+    ("DB_POOL_RECYCLE", "pool_recycle", int),
+    ("DB_POOL_PRE_PING", "pool_pre_ping", bool),
+    ("DB_POOL_USE_LIFO", "pool_use_lifo", bool),
+]
+
+
+def setting(name, cast):
+    # A DB_* variable, or its default in the DB_PROFILE
+    value = os.getenv(name, DB_PROFILES[os.getenv("DB_PROFILE", "default")].get(name))
+    if value is None or value == "":
+        return None
+    if cast is bool:
+        return str(value).lower() in ("1", "true", "yes")
+    return cast(value)
+
+
+def engine_options(db_uri):
+    options = {}
+    db_uri = db_uri or ""
+
+    # In-memory SQLite databases live in a single connection, so they keep their own pool
+    if ":memory:" not in db_uri and "mode=memory" not in db_uri:
+        # Queue pool measuring checkout waits, overflow usage and connection churn
+        options["poolclass"] = InstrumentedQueuePool
+        for name, option, cast in POOL_SETTINGS:
+            value = setting(name, cast)
+            if value is not None:
+                options[option] = value
+
+    if db_uri.startswith("postgresql"):
+        # Abort statements running longer than the timeout on the server
+        statement_timeout = setting("DB_STATEMENT_TIMEOUT_MS", int)
+        if statement_timeout:
+            options["connect_args"] = {
+                "options": "-c statement_timeout={}".format(statement_timeout)
+            }
+
+        # Stream every result through psycopg2 server-side cursors
+        if setting("DB_SERVER_SIDE_CURSORS", bool):
+            options["execution_options"] = {"stream_results": True}
+
+    return options
+
+
+def async_engine_options(db_uri):
+    options = {}
+    db_uri = db_uri or ""
+
+    # The default asyncio queue pool, sized like the pool of the sync engine
+    if ":memory:" not in db_uri and "mode=memory" not in db_uri:
+        for name, option, cast in POOL_SETTINGS:
+            value = setting(name, cast)
+            if value is not None:
+                options[option] = value
+
+    if db_uri.startswith("postgresql"):
+        # asyncpg takes the statement timeout as a server setting
+        statement_timeout = setting("DB_STATEMENT_TIMEOUT_MS", int)
+        if statement_timeout:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(statement_timeout)}}
+
+    return options
+
+
 config = {
     "SQLALCHEMY_DATABASE_URI": os.getenv("DB_URI"),
+    "SQLALCHEMY_ENGINE_OPTIONS": engine_options(os.getenv("DB_URI")),
+    # Maximum page size of GET /books and number of rows fetched per batch when streaming it
+    "BOOKS_MAX_PAGE_SIZE": int(os.getenv("BOOKS_MAX_PAGE_SIZE", 1000)),
+    "BOOKS_STREAM_BATCH_SIZE": int(os.getenv("BOOKS_STREAM_BATCH_SIZE", 500)),
+    # Maximum number of items of a POST/DELETE /books:batch request and number of items per transaction
+    "BOOKS_BATCH_MAX_SIZE": int(os.getenv("BOOKS_BATCH_MAX_SIZE", 10000)),
+    "BOOKS_BATCH_CHUNK_SIZE": int(os.getenv("BOOKS_BATCH_CHUNK_SIZE", 500)),
+    # Read the listing/search endpoints with Core queries instead of hydrating ORM objects
+    "BOOKS_FAST_READ": os.getenv("BOOKS_FAST_READ", "true").lower() in ("1", "true", "yes"),
+    # Serve the listing/search endpoints from the denormalized book_documents table
+    "BOOKS_READ_MODEL": os.getenv("BOOKS_READ_MODEL", "true").lower() in ("1", "true", "yes"),
+    # In-process columnar snapshot of the catalog serving the searches (built in the background after the
+    # first request, uses about 500 bytes per book, catches up with the writes of every process from the change
+    # log) and its maximum age in seconds before it is rebuilt, to drop the removed books (0 never rebuilds it)
+    "CATALOG_SNAPSHOT_ENABLED": os.getenv("CATALOG_SNAPSHOT_ENABLED", "false").lower() in ("1", "true", "yes"),
+    "CATALOG_SNAPSHOT_MAX_AGE": int(os.getenv("CATALOG_SNAPSHOT_MAX_AGE", 300)),
+    # Compression of the responses (gzip, and br/zstd with the optional brotli/zstandard packages)
+    # and the minimum size in bytes of the bodies worth compressing
+    "COMPRESSION_ENABLED": os.getenv("COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes"),
+    "COMPRESSION_MIN_SIZE": int(os.getenv("COMPRESSION_MIN_SIZE", 1024)),
+    # Seconds the catalog version of the ETags is reused before reading it again, which bounds how long
+    # the writes of the other worker processes can go unnoticed by the conditional requests
+    "CATALOG_VERSION_TTL": float(os.getenv("CATALOG_VERSION_TTL", 1)),
+    # Response cache of the listing/search endpoints: backend ("memory", "redis" or "none"),
+    # Redis URL, entry TTL in seconds and maximum number of in-process entries. The entries are tied to
+    # the shared catalog version, so every backend serves the writes of the other worker processes
+    # within CATALOG_VERSION_TTL
+    "RESPONSE_CACHE_BACKEND": os.getenv("RESPONSE_CACHE_BACKEND", "memory"),
+    "RESPONSE_CACHE_URL": os.getenv("RESPONSE_CACHE_URL", "redis://localhost:6379/0"),
+    "RESPONSE_CACHE_TTL": int(os.getenv("RESPONSE_CACHE_TTL", 60)),
+    "RESPONSE_CACHE_MAX_ENTRIES": int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024)),
+    # Base URL of the OpenLibrary API (overridable to point at a local stub server)
+    "OPENLIB_URL_BASE": os.getenv("OPENLIB_URL_BASE", "https://openlibrary.org"),
+    # Maximum number of concurrent OpenLibrary requests per import
+    "OPENLIB_MAX_WORKERS": int(os.getenv("OPENLIB_MAX_WORKERS", 8)),
+    # Maximum number of pooled keep-alive connections per OpenLibrary host
+    "OPENLIB_POOL_MAXSIZE": int(os.getenv("OPENLIB_POOL_MAXSIZE", 10)),
+    # Maximum number of OpenLibrary connections of the async serving mode, shared by all its requests
+    "OPENLIB_ASYNC_MAX_CONNECTIONS": int(os.getenv("OPENLIB_ASYNC_MAX_CONNECTIONS", 100)),
+    # Connect and read timeouts (in seconds) of every OpenLibrary request
+    "OPENLIB_CONNECT_TIMEOUT": float(os.getenv("OPENLIB_CONNECT_TIMEOUT", 3.05)),
+    "OPENLIB_READ_TIMEOUT": float(os.getenv("OPENLIB_READ_TIMEOUT", 10)),
+    # Retries with exponential backoff on connection errors and 429/5xx responses
+    "OPENLIB_MAX_RETRIES": int(os.getenv("OPENLIB_MAX_RETRIES", 3)),
+    "OPENLIB_BACKOFF_FACTOR": float(os.getenv("OPENLIB_BACKOFF_FACTOR", 0.5)),
+    # Token-bucket rate limit in requests per second (0 disables it) and burst size
+    "OPENLIB_RATE_LIMIT": float(os.getenv("OPENLIB_RATE_LIMIT", 0)),
+    "OPENLIB_RATE_BURST": int(os.getenv("OPENLIB_RATE_BURST", 1)),
+    # Author/work document cache: SQLite file (relative to the instance folder of the application, empty keeps
+    # only the in-process tier), entry TTL in seconds and the maximum number of entries of each tier
+    "OPENLIB_CACHE_PATH": os.getenv("OPENLIB_CACHE_PATH", "openlib_cache.db"),
+    "OPENLIB_CACHE_TTL": int(os.getenv("OPENLIB_CACHE_TTL", 7 * 24 * 3600)),
+    "OPENLIB_CACHE_MAX_ENTRIES": int(os.getenv("OPENLIB_CACHE_MAX_ENTRIES", 100000)),
+    "OPENLIB_CACHE_HOT_ENTRIES": int(os.getenv("OPENLIB_CACHE_HOT_ENTRIES", 1000)),
+    # Seconds after which the fetch lock of a key held by a worker process sharing the cache file is
+    # taken over by the others waiting for its document (e.g. after the worker crashed). 0 derives it from
+    # the worst-case fetch of the client: every attempt timing out, after the longest backoffs (142 s by default)
+    "OPENLIB_FETCH_LOCK_TIMEOUT": float(os.getenv("OPENLIB_FETCH_LOCK_TIMEOUT", 0)),
+    # Background import jobs: worker threads of the web process (0 leaves the jobs to `flask import-worker`),
+    # codes leased per batch, lease duration and maximum claims of an item (in seconds), idle poll interval
+    # in seconds, and number of codes above which POST /store_openlib_books enqueues a job
+    "IMPORT_WORKERS": int(os.getenv("IMPORT_WORKERS", 2)),
+    "IMPORT_BATCH_SIZE": int(os.getenv("IMPORT_BATCH_SIZE", 50)),
+    "IMPORT_LEASE_SECONDS": float(os.getenv("IMPORT_LEASE_SECONDS", 300)),
+    "IMPORT_MAX_ATTEMPTS": int(os.getenv("IMPORT_MAX_ATTEMPTS", 3)),
+    "IMPORT_POLL_INTERVAL": float(os.getenv("IMPORT_POLL_INTERVAL", 1)),
+    "IMPORT_ASYNC_THRESHOLD": int(os.getenv("IMPORT_ASYNC_THRESHOLD", 100)),
+    # Change feed of GET /books/changes: retention of the change log in seconds, interval in seconds of its
+    # background compaction (0 leaves it to `flask compact-changes`), maximum long-poll wait and poll interval
+    "CHANGE_LOG_RETENTION": int(os.getenv("CHANGE_LOG_RETENTION", 7 * 24 * 3600)),
+    "CHANGE_LOG_COMPACT_INTERVAL": float(os.getenv("CHANGE_LOG_COMPACT_INTERVAL", 3600)),
+    "CHANGES_MAX_WAIT": float(os.getenv("CHANGES_MAX_WAIT", 30)),
+    "CHANGES_POLL_INTERVAL": float(os.getenv("CHANGES_POLL_INTERVAL", 1)),
+    # Per-request phase timings (Server-Timing header and request metrics)
+    "INSTRUMENTATION_ENABLED": os.getenv("INSTRUMENTATION_ENABLED", "true").lower() in ("1", "true", "yes"),
+    # Opt-in sampling profiler: requests slower than the threshold are written as folded stacks
+    # (flamegraph.pl/speedscope input) to the output directory, sampling every interval
+    "PROFILER_ENABLED": os.getenv("PROFILER_ENABLED", "false").lower() in ("1", "true", "yes"),
+    "PROFILER_THRESHOLD_MS": float(os.getenv("PROFILER_THRESHOLD_MS", 500)),
+    "PROFILER_INTERVAL_MS": float(os.getenv("PROFILER_INTERVAL_MS", 5)),
+    "PROFILER_OUTPUT_DIR": os.getenv("PROFILER_OUTPUT_DIR", "profiles"),
 }
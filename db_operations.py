@@ -1,13 +1,59 @@
 """
-Database operations for storing, retrieving, and removing books.
+Database operations for storing, retrieving, and removing books, for the change feed of the catalog and for the queue of
+the import jobs.
 """
 
+import uuid
+from datetime import timedelta
 from db import db
 from models.Book import Book
 from models.Author import Author
 from models.Work import Work
-from utils.db_utils import insert_book_to_db, get_instance, create_book_list_from_query
-from sqlalchemy.orm import joinedload
+from models.BookDocument import BookDocument
+from models.BookChange import BookChange
+from models.CatalogVersion import CatalogVersion
+from models.ImportJob import ImportJob
+from models.ImportJobItem import ImportJobItem
+from models.associations.book_author_association import book_author_assoc_table
+from models.associations.book_work_association import book_work_assoc_table
+from utils.search_utils import is_indexed, like_filter, match_authors, match_works
+from utils.response_cache import expire_catalog_version
+from utils.catalog_snapshot import get_catalog_snapshot
+from utils.db_utils import (
+    insert_book_to_db,
+    insert_books_to_db,
+    delete_books_from_db,
+    openlib_id,
+    parse_book_data,
+    create_book_list_from_query,
+    iterate_book_documents,
+    RenderedBook,
+    delete_book_changes_before,
+    read_catalog_version,
+    record_book_changes,
+    _utcnow,
+    IN_QUERY_CHUNK_SIZE,
+)
+from utils.instrumentation import phase
+from config.config import config
+from sqlalchemy import and_, bindparam, exists, func, insert, or_, select, update
+from sqlalchemy.orm import Session, selectinload
+
+# Columns of the books read by the Core read path
+BOOK_COLUMNS = (Book.id, Book.title, Book.number_of_pages)
+
+# Error of the books of an atomic batch that were not stored because other books of the batch failed
+BATCH_ABORTED = "The atomic batch was not stored"
+
+# Orders of the search results: relevance, then id, title and number of pages (- for descending)
+SEARCH_SORTS = ("relevance", "id", "title", "-title", "pages", "-pages")
+
+def invalidate_cached_responses():
+    """Makes a committed write visible to the cached responses and the catalog snapshot of the process."""
+    # The write bumped the catalog version, which retires the cached responses and makes the snapshot catch
+    # up with the change log: the next request reads it
+    expire_catalog_version()
+
 
 def store_book(book_data, from_openlib=False):
     """Stores a book in the database.
@@ -25,23 +71,219 @@ def store_book(book_data, from_openlib=False):
     try:
         if from_openlib:
             # Extract the book id from the openlib book data
-            book_id = book_data["key"].split("/")[-1]
+            book_id = openlib_id(book_data["key"])
         else:
             # Get the book id from the book data
             book_id = book_data.get("id")
 
         # Insert the book into the database
-        if insert_book_to_db(
+        inserted = insert_book_to_db(
             session=db.session, book_data=book_data, from_openlib=from_openlib
-        ):
-            return {"success": "Book {} was inserted successfully.".format(book_id)}
-        else:
-            return {"error": "Book {} already in the database".format(book_id)}
+        )
     except Exception as e:
         # Roll back the database session in case of an exception
         db.session.rollback()
         return {"error": str(e)}
 
+    if inserted:
+        # Committed, whatever happens to the caches
+        invalidate_cached_responses()
+        return {"success": "Book {} was inserted successfully.".format(book_id)}
+    else:
+        return {"error": "Book {} already in the database".format(book_id)}
+
+
+def store_books(books_data, from_openlib=False):
+    """Stores a batch of books in the database in a single transaction.
+
+    Existing books, authors and works are resolved with one query per table and
+    the missing rows are inserted in bulk.
+
+    Args:
+        books_data (list): The data of the books to be stored.
+        from_openlib (bool, optional): Indicates if the book data is from OpenLib. Defaults to False.
+
+    Returns:
+        list: One dictionary per book, in the same order and format as the result of store_book.
+    """
+    try:
+        results = insert_books_to_db(
+            session=db.session, books_data=books_data, from_openlib=from_openlib
+        )
+    except Exception as e:
+        # Roll back the whole batch in case of an exception
+        db.session.rollback()
+        return [{"error": str(e)} for _ in books_data]
+
+    invalidate_cached_responses()
+    return store_results(books_data, results, from_openlib)
+
+
+def store_results(books_data, results, from_openlib=False):
+    """Turns the results of insert_books_to_db into the messages of store_books.
+
+    Args:
+        books_data (list): The data of the books.
+        results (list): The result of insert_books_to_db for every book.
+        from_openlib (bool, optional): Indicates if the book data is from OpenLib. Defaults to False.
+
+    Returns:
+        list: One dictionary per book, in the same order and format as the result of store_book.
+    """
+    messages = []
+    for book_data, result in zip(books_data, results):
+        if isinstance(result, Exception):
+            messages.append({"error": str(result)})
+            continue
+
+        book_id = parse_book_data(book_data, from_openlib)[0]
+        if result:
+            messages.append({"success": "Book {} was inserted successfully.".format(book_id)})
+        else:
+            messages.append({"error": "Book {} already in the database".format(book_id)})
+
+    return messages
+
+
+def _insert_with_savepoints(books_data):
+    # Insert a chunk of books in a savepoint. If the chunk fails, insert its books one by one,
+    # each in its own savepoint, so only the failing books are skipped. The changes are recorded
+    # by the caller once for the whole chunk, so the catalog version isn't locked until the commit.
+    try:
+        with db.session.begin_nested():
+            return insert_books_to_db(
+                session=db.session, books_data=books_data, commit=False, record_changes=False
+            )
+    except Exception:
+        pass
+
+    results = []
+    for book_data in books_data:
+        try:
+            with db.session.begin_nested():
+                results += insert_books_to_db(
+                    session=db.session, books_data=[book_data], commit=False, record_changes=False
+                )
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def store_books_batch(books_data, chunk_size=500, atomic=False):
+    """Stores a large batch of books, in chunked transactions or in a single one.
+
+    By default every chunk of books is committed in its own transaction, so a large batch doesn't hold
+    the database locks until its end, and a failing chunk is retried one book at a time in savepoints,
+    so a failing book only skips itself. An atomic batch is stored in a single transaction, which is
+    rolled back unless every book is inserted.
+
+    Args:
+        books_data (list): The data of the books to be stored.
+        chunk_size (int, optional): The number of books per transaction. Defaults to 500.
+        atomic (bool, optional): Store all the books or none of them. Defaults to False.
+
+    Returns:
+        list: One dictionary per book, in the same order and format as the result of store_book. The
+            books of a rolled back atomic batch that didn't fail themselves get the BATCH_ABORTED error.
+    """
+    if atomic:
+        try:
+            results = insert_books_to_db(session=db.session, books_data=books_data, commit=False)
+        except Exception as e:
+            db.session.rollback()
+            return [{"error": str(e)} for _ in books_data]
+
+        if all(result is True for result in results):
+            db.session.commit()
+            invalidate_cached_responses()
+            return store_results(books_data, results)
+
+        db.session.rollback()
+        return [
+            {"error": BATCH_ABORTED} if result is True else message
+            for result, message in zip(results, store_results(books_data, results))
+        ]
+
+    messages = []
+    for i in range(0, len(books_data), chunk_size):
+        chunk = books_data[i : i + chunk_size]
+        results = _insert_with_savepoints(chunk)
+        try:
+            inserted = [
+                parse_book_data(book_data)[0] for book_data, result in zip(chunk, results) if result is True
+            ]
+            if inserted:
+                record_book_changes(db.session, inserted=inserted)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            results = [e if result is True else result for result in results]
+
+        invalidate_cached_responses()
+        messages += store_results(chunk, results)
+
+    return messages
+
+
+def _select_books():
+    """Starts a select of the books, from the read model or from the books table.
+
+    Returns:
+        tuple: The select, and the book id, title and number of pages columns to filter and order it by.
+    """
+    if config["BOOKS_READ_MODEL"]:
+        return (
+            select(BookDocument),
+            BookDocument.book_id,
+            BookDocument.title,
+            BookDocument.number_of_pages,
+        )
+    return select(Book), Book.id, Book.title, Book.number_of_pages
+
+
+def _load_books(statement, batch_size=None):
+    """Loads the books selected by a statement of _select_books as dictionaries.
+
+    Args:
+        statement (Select): The select of the books, in the order of the result.
+        batch_size (int, optional): Stream the books from a server-side cursor in batches of this size.
+            Defaults to None, which returns a list of all the books.
+
+    Returns:
+        list or generator: The books, including the related authors and works.
+    """
+    if config["BOOKS_READ_MODEL"]:
+        # The pre-rendered documents of the books, without joining their authors and works. They are
+        # written into the responses as they are, without being decoded and encoded again
+        statement = statement.with_only_columns(BookDocument.book_id, BookDocument.document)
+        if batch_size:
+            rows = db.session.execute(statement.execution_options(yield_per=batch_size))
+            return (RenderedBook(book_id, document) for book_id, document in rows)
+        rows = db.session.execute(statement)
+        with phase("hydrate", exclude_db=True):
+            return [RenderedBook(book_id, document) for book_id, document in rows]
+
+    if config["BOOKS_FAST_READ"]:
+        # Plain rows with the authors and works grouped per book, without ORM objects
+        books = iterate_book_documents(
+            db.session, statement.with_only_columns(*BOOK_COLUMNS), batch_size
+        )
+        if batch_size:
+            return books
+        with phase("hydrate", exclude_db=True):
+            return list(books)
+
+    # Load the related authors and works with one extra query per table (per batch when streaming)
+    statement = statement.options(
+        selectinload(Book.authors).load_only(Author.id, Author.name),
+        selectinload(Book.works).load_only(Work.id, Work.title),
+    )
+    if batch_size:
+        # yield_per streams the rows instead of buffering the whole result
+        books = db.session.execute(statement.execution_options(yield_per=batch_size)).scalars()
+        return (create_book_list_from_query([book])[0] for book in books)
+    return create_book_list_from_query(db.session.execute(statement).scalars())
+
 
 def retrieve_all_books():
     """Retrieves all books from the database.
@@ -50,51 +292,371 @@ def retrieve_all_books():
         list: A list of books, including the related authors and works.
     """
     # Query all books from the database and include the related authors and works
-    query = db.session.query(Book).options(
-        joinedload(Book.authors).load_only(Author.id, Author.name),
-        joinedload(Book.works).load_only(Work.id, Work.title),
+    statement, book_id, _, _ = _select_books()
+    return _load_books(statement.order_by(book_id))
+
+
+def retrieve_books_page(limit, cursor=None):
+    """Retrieves a page of books using keyset pagination on the book id.
+
+    Args:
+        limit (int): The maximum number of books in the page.
+        cursor (str, optional): The id of the last book of the previous page. Defaults to None.
+
+    Returns:
+        tuple: A list of books, including the related authors and works, and the cursor of
+            the next page (None if this is the last page).
+    """
+    statement, book_id, _, _ = _select_books()
+    statement = statement.order_by(book_id)
+    if cursor:
+        # Continue right after the last book of the previous page
+        statement = statement.where(book_id > cursor)
+
+    # Fetch one extra book to find out if there is a next page
+    books = _load_books(statement.limit(limit + 1))
+    next_cursor = books[limit - 1]["id"] if len(books) > limit else None
+
+    return books[:limit], next_cursor
+
+
+def iterate_all_books(batch_size=500):
+    """Yields all books from a server-side cursor, one batch of rows at a time.
+
+    Args:
+        batch_size (int, optional): The number of books fetched per batch. Defaults to 500.
+
+    Yields:
+        dict: A book, including the related authors and works.
+    """
+    statement, book_id, _, _ = _select_books()
+    yield from _load_books(statement.order_by(book_id), batch_size)
+
+
+def _text_match(session, term, match, assoc_column, document_column, book_id):
+    """Builds the filter of the books linked to an author or work whose name or title contains a term.
+
+    Returns:
+        ColumnElement: A semi-join filter, which never duplicates the books linked to several matches.
+    """
+    if config["BOOKS_READ_MODEL"] and not is_indexed(session, term):
+        # Without a text index, scan the author/work text of the documents instead
+        return like_filter(document_column, term)
+    matches = match(session, term).subquery()
+    return _linked_to(book_id, assoc_column, select(matches.c.id))
+
+
+def _linked_to(book_id, assoc_column, ids):
+    # Semi-join on the association table. PostgreSQL plans it like EXISTS, and unlike a correlated
+    # EXISTS, SQLite drives it from the index of the author/work ids instead of scanning every book
+    return book_id.in_(select(assoc_column.table.c.book_id).where(assoc_column.in_(ids)))
+
+
+def _text_scores(session, term, match, assoc_column, document_column, book_id):
+    """Builds the best relevance score of the matching authors or works of every book.
+
+    Returns:
+        tuple: The subquery of the (book_id, score) of every matching book, grouped per book so joining it
+            never duplicates a book, or None with an unindexed term of the read model, whose matches all
+            score the same, and the filter to use instead.
+    """
+    if config["BOOKS_READ_MODEL"] and not is_indexed(session, term):
+        return None, like_filter(document_column, term)
+    matches = match(session, term).subquery()
+    scores = (
+        select(assoc_column.table.c.book_id, func.max(matches.c.score).label("score"))
+        .join(matches, matches.c.id == assoc_column)
+        .group_by(assoc_column.table.c.book_id)
+        .subquery()
     )
-    # Create and return a list of books from the query results
-    return create_book_list_from_query(query)
+    return scores, None
+
 
+def _select_books_by_criteria(
+    author_name=None,
+    work_title=None,
+    min_pages=None,
+    max_pages=None,
+    book_ids=None,
+    author_ids=None,
+    work_ids=None,
+    ranked=False,
+):
+    """Builds the select of the books matching the search criteria.
 
-def retrieve_books_by_criteria(author_name, work_title, min_pages):
+    The criteria are semi-join and column filters, so a book is selected once however many of its
+    authors or works match. Only when ranked are the text matches joined, grouped per book, for their scores.
+
+    Returns:
+        tuple: The select, its book id, title and number of pages columns, and the relevance scores.
+    """
+    statement, book_id, title, number_of_pages = _select_books()
+    relevance = []  # Relevance score of every ranked text criterion
+
+    text_criteria = [
+        (author_name, match_authors, book_author_assoc_table.c.author_id, BookDocument.author_names),
+        (work_title, match_works, book_work_assoc_table.c.work_id, BookDocument.work_titles),
+    ]
+    for term, match, assoc_column, document_column in text_criteria:
+        if not term:
+            continue
+        if ranked:
+            scores, condition = _text_scores(
+                db.session, term, match, assoc_column, document_column, book_id
+            )
+            if scores is None:
+                statement = statement.where(condition)
+            else:
+                statement = statement.join(scores, scores.c.book_id == book_id)
+                relevance.append(scores.c.score)
+        else:
+            statement = statement.where(
+                _text_match(db.session, term, match, assoc_column, document_column, book_id)
+            )
+
+    # Exact ids of the books, and of their authors and works
+    if book_ids:
+        statement = statement.where(book_id.in_(book_ids))
+    for ids, assoc_column in [
+        (author_ids, book_author_assoc_table.c.author_id),
+        (work_ids, book_work_assoc_table.c.work_id),
+    ]:
+        if ids:
+            statement = statement.where(_linked_to(book_id, assoc_column, ids))
+
+    # Page range, served by the number_of_pages index
+    if min_pages is not None:
+        statement = statement.where(number_of_pages >= int(min_pages))
+    if max_pages is not None:
+        statement = statement.where(number_of_pages <= int(max_pages))
+
+    return statement, book_id, title, number_of_pages, relevance
+
+
+def retrieve_books_by_criteria(
+    author_name,
+    work_title,
+    min_pages,
+    max_pages=None,
+    book_ids=None,
+    author_ids=None,
+    work_ids=None,
+    sort=None,
+    limit=None,
+    offset=0,
+):
     """Retrieves books from the database based on specified criteria.
 
     Args:
         author_name (str): The name of the author to filter the books by.
         work_title (str): The title of the work to filter the books by.
         min_pages (int): The minimum number of pages a book should have.
+        max_pages (int, optional): The maximum number of pages a book should have. Defaults to None.
+        book_ids (list, optional): Only return the books with these IDs. Defaults to None.
+        author_ids (list, optional): Only return the books of one of these authors. Defaults to None.
+        work_ids (list, optional): Only return the books of one of these works. Defaults to None.
+        sort (str, optional): One of SEARCH_SORTS. Defaults to None, which ranks the most relevant
+            books first when searching by author or work, and sorts them by id otherwise.
+        limit (int, optional): The maximum number of books to return. Defaults to None (all).
+        offset (int, optional): The number of books to skip. Defaults to 0.
+
+    Returns:
+        list: A list of books that match the specified criteria, in the requested order.
+    """
+    if sort is None or (sort == "relevance" and not (author_name or work_title)):
+        sort = "relevance" if author_name or work_title else "id"
+
+    # Served from the in-process snapshot when enabled, except the relevance ranking of the text search
+    snapshot = get_catalog_snapshot()
+    if snapshot is not None and sort != "relevance":
+        return snapshot.search(
+            author_name, work_title, min_pages, max_pages, book_ids, author_ids, work_ids,
+            sort=sort, limit=limit, offset=offset,
+        )
+
+    statement, book_id, title, number_of_pages, relevance = _select_books_by_criteria(
+        author_name,
+        work_title,
+        min_pages,
+        max_pages,
+        book_ids,
+        author_ids,
+        work_ids,
+        ranked=sort == "relevance",
+    )
+
+    # Sort in the database, by id among equals so pages are stable
+    if sort == "relevance":
+        if relevance:
+            statement = statement.order_by(sum(relevance).desc())
+    elif sort in ("title", "-title"):
+        statement = statement.order_by(title.desc() if sort == "-title" else title.asc())
+    elif sort in ("pages", "-pages"):
+        # Books without a number of pages come last
+        statement = statement.order_by(
+            (number_of_pages.desc() if sort == "-pages" else number_of_pages.asc()).nulls_last()
+        )
+    statement = statement.order_by(book_id)
+
+    if offset:
+        statement = statement.offset(offset)
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    # Execute the query and return the results as a list of books
+    return _load_books(statement)
+
+
+def count_books_by_criteria(
+    author_name,
+    work_title,
+    min_pages,
+    max_pages=None,
+    book_ids=None,
+    author_ids=None,
+    work_ids=None,
+):
+    """Counts the books matching the criteria of retrieve_books_by_criteria, without loading them.
 
     Returns:
-        list: A list of books that match the specified criteria.
+        int: The number of matching books.
     """
-    # Start with a query for all books
-    query = db.session.query(Book)
+    snapshot = get_catalog_snapshot()
+    if snapshot is not None:
+        return snapshot.count(
+            author_name, work_title, min_pages, max_pages, book_ids, author_ids, work_ids
+        )
+
+    statement, book_id, _, _, _ = _select_books_by_criteria(
+        author_name, work_title, min_pages, max_pages, book_ids, author_ids, work_ids
+    )
+    return db.session.execute(statement.with_only_columns(func.count(book_id))).scalar()
 
-    # Add filters based on the query parameters
-    if author_name:
-        # Join the authors table and filter by author name
-        query = query.join(Book.authors).filter(Author.name.ilike(f"%{author_name}%"))
 
-    if work_title:
-        # Join the works table and filter by work title
-        query = query.join(Book.works).filter(Work.title.ilike(f"%{work_title}%"))
+def retrieve_book_changes(since, limit=1000):
+    """Retrieves the changes of the catalog after a sequence number, in commit order.
 
-    if min_pages:
-        # Filter by minimum number of pages
-        query = query.filter(Book.number_of_pages >= int(min_pages))
+    The changes of a write share its sequence number and are never split between two pages, so a
+    page may hold more than the limit.
 
-    # Execute the query and retrieve the results
-    books_query = query.all()
+    Args:
+        since (int): The sequence number of the last change already applied (0 to start from the beginning).
+        limit (int, optional): The number of changes per page. Defaults to 1000.
+
+    Returns:
+        None: If changes after the sequence number were compacted, so the consumer must resync with a full read.
+
+        dict: The 'changes' (sequence number, operation, book id and the current document of the book, or None
+            if it no longer exists), the 'next_since' to resume after them and the 'latest' sequence number.
+    """
+    table = BookChange.__table__
+    columns = (table.c.seq, table.c.op, table.c.book_id)
+    rows = db.session.execute(
+        select(*columns).where(table.c.seq > since).order_by(table.c.seq, table.c.book_id).limit(limit)
+    ).all()
+    if len(rows) == limit:
+        # Complete the changes of the last write of the page
+        last = rows[-1]
+        rows += db.session.execute(
+            select(*columns)
+            .where(table.c.seq == last.seq, table.c.book_id > last.book_id)
+            .order_by(table.c.book_id)
+        ).all()
+
+    # Read after the changes, so a compaction that removed some of them meanwhile is noticed
+    state = db.session.execute(
+        select(CatalogVersion.version, CatalogVersion.compacted_seq).where(CatalogVersion.id == 1)
+    ).first()
+    latest, compacted_seq = state if state is not None else (0, 0)
+    if since < compacted_seq:
+        return None
 
-    # Convert and the query results to a list of books and return the results
-    return create_book_list_from_query(books_query)
+    # The current documents of the changed books
+    ids = list({row.book_id for row in rows})
+    statement, book_id, _, _ = _select_books()
+    documents = {
+        book["id"]: book
+        for i in range(0, len(ids), IN_QUERY_CHUNK_SIZE)
+        for book in _load_books(statement.where(book_id.in_(ids[i : i + IN_QUERY_CHUNK_SIZE])))
+    }
+
+    return {
+        "changes": [
+            {"seq": row.seq, "op": row.op, "book_id": row.book_id, "book": documents.get(row.book_id)}
+            for row in rows
+        ],
+        "next_since": rows[-1].seq if rows else since,
+        "latest": max(latest, rows[-1].seq if rows else 0),
+    }
+
+
+def retrieve_latest_change():
+    """Retrieves the sequence number of the latest change of the catalog.
+
+    Returns:
+        int: The sequence number, where a consumer resyncing with a full read resumes.
+    """
+    return read_catalog_version(db.session)
+
+
+def compact_book_changes(retention_seconds):
+    """Deletes the changes older than the retention window from the change log.
+
+    Args:
+        retention_seconds (float): The retention window in seconds.
+
+    Returns:
+        int: The number of deleted changes.
+    """
+    return delete_book_changes_before(db.session, _utcnow() - timedelta(seconds=retention_seconds))
+
+
+def retrieve_known_openlib_documents(keys, session=None):
+    """Builds OpenLibrary author/work documents from the authors and works already stored.
+
+    The imports look the keys up between their OpenLibrary requests, so without a session the lookup runs in a
+    short-lived session of its own, closed before returning: the connection doesn't stay in a transaction
+    while the requests are in flight.
+
+    Args:
+        keys (list): OpenLibrary keys such as '/authors/OL1A' or '/works/OL1W'.
+        session (Session, optional): The database session. Defaults to a new session, closed after the lookup.
+
+    Returns:
+        dict: A dictionary mapping the keys found in the database to minimal OpenLibrary
+            documents ('key' and 'name' for authors, 'key' and 'title' for works).
+    """
+    if session is None:
+        with Session(db.engine) as session:
+            return retrieve_known_openlib_documents(keys, session)
+
+    documents = {}
+
+    # Map the stored ids back to the OpenLibrary keys they were extracted from
+    author_keys = {openlib_id(key): key for key in keys if key.startswith("/authors/")}
+    work_keys = {openlib_id(key): key for key in keys if key.startswith("/works/")}
+
+    if author_keys:
+        for author_id, name in session.query(Author.id, Author.name).filter(
+            Author.id.in_(author_keys)
+        ):
+            documents[author_keys[author_id]] = {"key": author_keys[author_id], "name": name}
+
+    if work_keys:
+        for work_id, title in session.query(Work.id, Work.title).filter(
+            Work.id.in_(work_keys)
+        ):
+            documents[work_keys[work_id]] = {"key": work_keys[work_id], "title": title}
+
+    return documents
 
 
 def remove_book(book_id):
     """Removes a book from the database.
 
+    The links of the book are deleted with set-based SQL and only the authors and works
+    that are left without books are deleted, all in one transaction.
+
     Args:
         book_id (int): The ID of the book to be removed.
 
@@ -106,40 +668,399 @@ def remove_book(book_id):
         If the book doesn't exist or an error occurs, it contains an 'error' key
         with an error message.
     """
+    try:
+        # Delete the book, its links and its orphaned authors and works
+        deleted = delete_books_from_db(session=db.session, book_ids=[book_id])
+    except Exception as e:
+        # Roll back the database session in case of an exception
+        db.session.rollback()
+        return {"error": "Book was not deleted. Reason: {}.".format(e)}
 
-    # Retrieve the book instance from the database
-    book = get_instance(db.session, Book, id=book_id)
     # If the book doesn't exist, return None
-
-    if not book:
+    if not deleted:
         return None
 
+    invalidate_cached_responses()
+
+    return {"success": "Book {} was deleted successfully.".format(book_id)}
+
+
+def remove_books(book_ids):
+    """Removes a batch of books from the database in a single transaction.
+
+    Args:
+        book_ids (list): The IDs of the books to be removed.
+
+    Returns:
+        list: One dictionary per book ID, in the same order. It contains a 'success' key if
+            the book was deleted, or an 'error' key if the book was not found or an error occurred.
+    """
+    try:
+        deleted = delete_books_from_db(session=db.session, book_ids=book_ids)
+    except Exception as e:
+        # Roll back the whole batch in case of an exception
+        db.session.rollback()
+        return [
+            {"error": "Book was not deleted. Reason: {}.".format(e)} for _ in book_ids
+        ]
+
+    invalidate_cached_responses()
+    return _removal_messages(book_ids, deleted)
+
+
+def _removal_messages(book_ids, deleted):
+    # One message per book id, in the format of remove_books
+    deleted = set(deleted)
+    messages = []
+    for book_id in book_ids:
+        if book_id in deleted:
+            messages.append({"success": "Book {} was deleted successfully.".format(book_id)})
+            # A repeated id is reported as not found
+            deleted.discard(book_id)
+        else:
+            messages.append({"error": "Book not found."})
+
+    return messages
+
+
+def _delete_with_savepoints(book_ids):
+    # Delete a chunk of books in a savepoint. If the chunk fails, delete its books one by one,
+    # each in its own savepoint, so only the failing books are skipped. Like _insert_with_savepoints,
+    # the changes are recorded by the caller once for the whole chunk.
+    try:
+        with db.session.begin_nested():
+            return delete_books_from_db(
+                session=db.session, book_ids=book_ids, commit=False, record_changes=False
+            ), {}
+    except Exception:
+        pass
+
+    deleted = set()
+    errors = {}
+    for book_id in book_ids:
+        try:
+            with db.session.begin_nested():
+                deleted |= delete_books_from_db(
+                    session=db.session, book_ids=[book_id], commit=False, record_changes=False
+                )
+        except Exception as e:
+            errors[book_id] = e
+    return deleted, errors
+
+
+def remove_books_batch(book_ids, chunk_size=500, atomic=False):
+    """Removes a large batch of books, in chunked transactions or in a single one.
+
+    Like store_books_batch, every chunk of books is committed in its own transaction and retried one book
+    at a time in savepoints if it fails, unless the batch is atomic: then it is removed in a single
+    transaction, which is rolled back unless every book is found and deleted.
+
+    Args:
+        book_ids (list): The IDs of the books to be removed.
+        chunk_size (int, optional): The number of books per transaction. Defaults to 500.
+        atomic (bool, optional): Remove all the books or none of them. Defaults to False.
+
+    Returns:
+        list: One dictionary per book ID, in the same order and format as the result of remove_books. The
+            books of a rolled back atomic batch that didn't fail themselves get the BATCH_ABORTED error.
+    """
+    if atomic:
+        try:
+            deleted = delete_books_from_db(session=db.session, book_ids=book_ids, commit=False)
+        except Exception as e:
+            db.session.rollback()
+            return [{"error": "Book was not deleted. Reason: {}.".format(e)} for _ in book_ids]
+
+        messages = _removal_messages(book_ids, deleted)
+        if all("success" in message for message in messages):
+            db.session.commit()
+            invalidate_cached_responses()
+            return messages
+
+        db.session.rollback()
+        return [{"error": BATCH_ABORTED} if "success" in message else message for message in messages]
+
+    messages = []
+    for i in range(0, len(book_ids), chunk_size):
+        chunk = book_ids[i : i + chunk_size]
+        deleted, errors = _delete_with_savepoints(chunk)
+        try:
+            if deleted:
+                record_book_changes(db.session, deleted=deleted)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            errors.update((book_id, e) for book_id in deleted)
+            deleted = set()
+
+        invalidate_cached_responses()
+        messages += [
+            {"error": "Book was not deleted. Reason: {}.".format(errors[book_id])}
+            if book_id in errors
+            else message
+            for book_id, message in zip(chunk, _removal_messages(chunk, deleted))
+        ]
+
+    return messages
+
+
+def enqueue_import_job(codes, session=None):
+    """Enqueues an import job with one item per OpenLibrary book code.
+
+    Args:
+        codes (list): The OpenLibrary book codes to import.
+        session (Session, optional): The database session. Defaults to db.session.
+
+    Returns:
+        str: The id of the job.
+    """
+    if session is None:
+        session = db.session
+
+    job_id = uuid.uuid4().hex
+    session.add(ImportJob(job_id, total=len(codes), created_at=_utcnow()))
+    session.flush()
+    if codes:
+        session.execute(
+            insert(ImportJobItem.__table__),
+            [{"job_id": job_id, "code": code, "status": "pending", "attempts": 0} for code in codes],
+        )
+    session.commit()
+    # A job without codes is complete right away
+    _finish_import_jobs([job_id], session)
+    session.commit()
+    return job_id
+
+
+def _finish_import_jobs(job_ids, session=None):
+    # Complete the jobs that have no pending items left
+    if session is None:
+        session = db.session
+    for job_id in job_ids:
+        session.execute(
+            update(ImportJob)
+            .where(
+                ImportJob.id == job_id,
+                ImportJob.status != "completed",
+                ~exists().where(
+                    ImportJobItem.job_id == job_id, ImportJobItem.status == "pending"
+                ),
+            )
+            .values(status="completed", finished_at=_utcnow())
+        )
+
+
+def claim_import_items(worker_id, limit, lease_seconds, max_attempts):
+    """Leases a batch of pending import items to a worker.
+
+    Items whose lease expired (their worker crashed or stalled) are claimed again. Items that
+    were already claimed max_attempts times are skipped instead, so a poison code cannot block a job.
+
+    Args:
+        worker_id (str): The unique id of the claiming worker.
+        limit (int): The maximum number of items to claim.
+        lease_seconds (float): How long the items stay leased to the worker.
+        max_attempts (int): The maximum number of times an item is claimed.
+
+    Returns:
+        list: The claimed (item id, job id, code) tuples, in enqueue order.
+    """
+    now = _utcnow()
+    claimable = and_(
+        ImportJobItem.status == "pending",
+        or_(ImportJobItem.lease_expires_at.is_(None), ImportJobItem.lease_expires_at < now),
+    )
+
+    # Give up on the items that failed too many times
+    exhausted = db.session.execute(
+        select(ImportJobItem.id, ImportJobItem.job_id).where(
+            claimable, ImportJobItem.attempts >= max_attempts
+        )
+    ).all()
+    if exhausted:
+        db.session.execute(
+            update(ImportJobItem)
+            .where(ImportJobItem.id.in_([item_id for item_id, _ in exhausted]), claimable)
+            .values(
+                status="skipped",
+                message="Skipped because of: Import failed {} times".format(max_attempts),
+                lease_owner=None,
+                lease_expires_at=None,
+            )
+        )
+        _finish_import_jobs({job_id for _, job_id in exhausted})
+        db.session.commit()
+
+    candidates = select(ImportJobItem.id).where(claimable).order_by(ImportJobItem.id).limit(limit)
+    if db.session.get_bind().dialect.name == "postgresql":
+        # Concurrent workers skip the rows another worker is claiming instead of waiting
+        candidates = candidates.with_for_update(skip_locked=True)
+    item_ids = db.session.execute(candidates).scalars().all()
+    if not item_ids:
+        db.session.rollback()
+        return []
+
+    # The claimable condition is checked again, so an item is never leased to two workers
+    db.session.execute(
+        update(ImportJobItem)
+        .where(ImportJobItem.id.in_(item_ids), claimable)
+        .values(
+            lease_owner=worker_id,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+            attempts=ImportJobItem.attempts + 1,
+        )
+    )
+    claimed = db.session.execute(
+        select(ImportJobItem.id, ImportJobItem.job_id, ImportJobItem.code)
+        .where(ImportJobItem.id.in_(item_ids), ImportJobItem.lease_owner == worker_id)
+        .order_by(ImportJobItem.id)
+    ).all()
+    db.session.execute(
+        update(ImportJob)
+        .where(ImportJob.id.in_({job_id for _, job_id, _ in claimed}), ImportJob.status == "queued")
+        .values(status="running")
+    )
+    db.session.commit()
+
+    return [tuple(item) for item in claimed]
+
+
+def store_import_items(worker_id, items, books):
+    """Stores the fetched books of claimed import items and records the outcome of every item.
+
+    The books and the outcome of their items are committed in a single transaction, which
+    first checks that the worker still holds the lease of every item. A worker that crashes
+    before the commit leaves the items pending, and a worker whose lease expired stores
+    nothing, so every book is stored exactly once.
+
+    Args:
+        worker_id (str): The id of the worker holding the lease of the items.
+        items (list): The claimed (item id, job id, code) tuples.
+        books (dict): The result of fetch_openlib_books for the codes of the items.
+
+    Returns:
+        bool: True if the items were stored, False if the worker lost the lease of some items.
+    """
+    item_ids = [item_id for item_id, _, _ in items]
     try:
-        # Get the associated authors and works of the book
-        authors = [author for author in book.authors]
-        works = [work for work in book.works]
+        # Lock the items, checking that they are still leased to this worker
+        locked = db.session.execute(
+            update(ImportJobItem)
+            .where(
+                ImportJobItem.id.in_(item_ids),
+                ImportJobItem.lease_owner == worker_id,
+                ImportJobItem.status == "pending",
+            )
+            .values(lease_owner=worker_id)
+        ).rowcount
+        if locked != len(item_ids):
+            db.session.rollback()
+            return False
 
-        # Remove the book from its associated authors
-        for author in authors:
-            author.books.remove(book)
+        fetched = [books[code] for _, _, code in items if isinstance(books[code], dict)]
+        results = iter(
+            insert_books_to_db(
+                session=db.session, books_data=fetched, from_openlib=True, commit=False, record_changes=False
+            )
+        )
 
-            # If an author has no more associated books, delete the author
-            if len(author.books) < 1:
-                db.session.delete(author)
+        outcomes = []
+        inserted = []
+        for item_id, _, code in items:
+            book = books[code]
+            status, message = "skipped", None
 
-        # Remove the book from its associated works
-        for work in works:
-            work.books.remove(book)
+            if isinstance(book, Exception):
+                message = "Skipped because of: {}".format(book)
+            elif book is None:
+                message = "Skipped because of: Missing fields"
+            else:
+                result = next(results)
+                if result is True:
+                    status = "added"
+                    inserted.append(parse_book_data(book, from_openlib=True)[0])
+                elif result is False:
+                    message = "Skipped because of: Book {} already in the database".format(
+                        parse_book_data(book, from_openlib=True)[0]
+                    )
+                else:
+                    message = "Skipped because of: {}".format(result)
 
-            # If a work has no more associated books, delete the work
-            if len(work.books) < 1:
-                db.session.delete(work)
+            outcomes.append({"item_id": item_id, "status": status, "message": message})
 
-        # Delete the book from the database
-        db.session.delete(book)
+        db.session.execute(
+            update(ImportJobItem.__table__)
+            .where(ImportJobItem.__table__.c.id == bindparam("item_id"))
+            .values(
+                status=bindparam("status"),
+                message=bindparam("message"),
+                lease_owner=None,
+                lease_expires_at=None,
+            ),
+            outcomes,
+        )
+        _finish_import_jobs({job_id for _, job_id, _ in items})
+        # Last, so the catalog version stays locked for the commit only
+        if inserted:
+            record_book_changes(db.session, inserted=inserted)
         db.session.commit()
-        return {"success": "Book {} was deleted successfully.".format(book_id)}
-    except Exception as e:
-        # Roll back the database session in case of an exception
+    except Exception:
+        # Leave the items pending, they are claimed again when their lease expires
         db.session.rollback()
-        return {"error": "Book was not deleted. Reason: {}.".format(e)}
+        raise
+
+    invalidate_cached_responses()
+    return True
+
+
+def retrieve_import_job(job_id, details=False, session=None):
+    """Retrieves the progress of an import job.
+
+    Args:
+        job_id (str): The id of the job.
+        details (bool, optional): Include the added and skipped books. Defaults to False.
+        session (Session, optional): The database session. Defaults to db.session.
+
+    Returns:
+        None: If no job was found, it returns None
+
+        dict: The status, counters and timestamps of the job. With details, it also contains
+            the added and skipped books in the same format as POST /store_openlib_books.
+    """
+    if session is None:
+        session = db.session
+
+    job = session.get(ImportJob, job_id)
+    if job is None:
+        return None
+
+    counts = dict(
+        session.execute(
+            select(ImportJobItem.status, func.count())
+            .where(ImportJobItem.job_id == job_id)
+            .group_by(ImportJobItem.status)
+        ).all()
+    )
+    result = {
+        "id": job.id,
+        "status": job.status,
+        "total": job.total,
+        "processed": counts.get("added", 0) + counts.get("skipped", 0),
+        "added": counts.get("added", 0),
+        "skipped": counts.get("skipped", 0),
+        "created_at": job.created_at.isoformat() + "Z",
+        "finished_at": job.finished_at.isoformat() + "Z" if job.finished_at else None,
+    }
+
+    if details:
+        items = session.execute(
+            select(ImportJobItem.code, ImportJobItem.status, ImportJobItem.message)
+            .where(ImportJobItem.job_id == job_id, ImportJobItem.status != "pending")
+            .order_by(ImportJobItem.id)
+        ).all()
+        result["added_books"] = [code for code, status, _ in items if status == "added"]
+        result["skipped_books"] = [
+            {code: message} for code, status, message in items if status == "skipped"
+        ]
+
+    return result
@@ -0,0 +1,440 @@
+"""
+Offline bulk loader of the OpenLibrary data dumps.
+
+OpenLibrary publishes gzipped TSV dumps of its editions, authors and works (https://openlibrary.org/developers/dumps),
+with one record per line: type, key, revision, last modified and the JSON document. The dumps are streamed through
+a generator pipeline (lines -> records -> filtered rows -> batches), so no file is ever loaded into memory.
+
+Every dump is first copied into staging tables, with PostgreSQL COPY or a batched executemany elsewhere. Every batch
+is committed together with a checkpoint of the dump lines consumed, so an interrupted load resumes where it stopped.
+The staged rows are then merged into the books, authors, works and association tables with INSERT ... SELECT,
+keeping only the authors and works referenced by the new books and skipping the rows that already exist.
+Like the API imports, books that already exist are left untouched. The ids of the books the merge actually inserts
+are recorded in a staging table, and their links, change log rows and book_documents read model are keyed on them.
+The staging and checkpoint tables are dropped in the same transaction.
+
+- read_dump(path, skip): Yields the (line number, type, key, JSON) fields of the lines of a dump.
+- edition_rows(records, languages, min_pages): Maps edition records to the rows of the staged books and links.
+- load_dumps(engine, editions_path, authors_path, works_path, ...): Loads the dumps into the database.
+"""
+
+import gzip
+import io
+import itertools
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from sqlalchemy import Boolean, Column, Integer, MetaData, String, Table, delete, distinct, exists, func, insert, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from models.Book import Book
+from models.Author import Author
+from models.Work import Work
+from models.BookDocument import BookDocument
+from models.BookChange import BookChange
+from models.associations.book_author_association import book_author_assoc_table
+from models.associations.book_work_association import book_work_assoc_table
+from utils.db_utils import IN_QUERY_CHUNK_SIZE, bump_catalog_version, openlib_id, sync_book_documents
+
+logger = logging.getLogger(__name__)
+
+# Referenced author/work ids are filtered in memory while staging up to this many ids, and only
+# while merging beyond that
+MAX_REFERENCED_IDS_IN_MEMORY = 2_000_000
+
+# The staging and checkpoint tables are not part of the application schema
+staging_metadata = MetaData()
+
+dump_books_table = Table(
+    "dump_books",
+    staging_metadata,
+    Column("id", String),
+    Column("title", String),
+    Column("number_of_pages", Integer),
+)
+dump_book_authors_table = Table(
+    "dump_book_authors", staging_metadata, Column("book_id", String), Column("author_id", String)
+)
+dump_book_works_table = Table(
+    "dump_book_works", staging_metadata, Column("book_id", String), Column("work_id", String)
+)
+dump_authors_table = Table(
+    "dump_authors", staging_metadata, Column("id", String), Column("name", String)
+)
+dump_works_table = Table("dump_works", staging_metadata, Column("id", String), Column("title", String))
+# The ids of the books inserted by the merge
+dump_new_books_table = Table("dump_new_books", staging_metadata, Column("id", String, primary_key=True))
+dump_checkpoints_table = Table(
+    "dump_load_checkpoints",
+    staging_metadata,
+    Column("name", String, primary_key=True),
+    Column("lines", Integer, nullable=False),
+    Column("rows", Integer, nullable=False),
+    Column("completed", Boolean, nullable=False),
+)
+
+STAGING_TABLES = [
+    dump_books_table,
+    dump_book_authors_table,
+    dump_book_works_table,
+    dump_authors_table,
+    dump_works_table,
+]
+
+
+def read_dump(path, skip=0):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        # Skip the lines consumed by a previous run without parsing them
+        for line_number, line in enumerate(itertools.islice(f, skip, None), start=skip + 1):
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 5:
+                yield line_number, fields[0], fields[1], fields[4]
+
+
+def _records(lines, record_type):
+    # Parse the JSON of the records of the wanted type only
+    for line_number, type_, key, document in lines:
+        if type_ == record_type:
+            yield line_number, json.loads(document)
+
+
+def edition_rows(records, languages=None, min_pages=None):
+    for line_number, edition in records:
+        # Like the OpenLibrary import, skip the editions without authors or works
+        if not edition.get("title") or "authors" not in edition or "works" not in edition:
+            continue
+        if languages and not {
+            openlib_id(language["key"]) for language in edition.get("languages", [])
+        } & set(languages):
+            continue
+        number_of_pages = edition.get("number_of_pages")
+        if not isinstance(number_of_pages, int):
+            number_of_pages = None
+        if min_pages and (number_of_pages is None or number_of_pages < min_pages):
+            continue
+
+        book_id = openlib_id(edition["key"])
+        yield line_number, {
+            dump_books_table: [(book_id, edition["title"], number_of_pages)],
+            dump_book_authors_table: [
+                (book_id, openlib_id(author["key"])) for author in edition["authors"] if "key" in author
+            ],
+            dump_book_works_table: [
+                (book_id, openlib_id(work["key"])) for work in edition["works"] if "key" in work
+            ],
+        }
+
+
+def _named_rows(records, table, name_field, referenced):
+    for line_number, record in records:
+        record_id = openlib_id(record["key"])
+        if record.get(name_field) and (referenced is None or record_id in referenced):
+            yield line_number, {table: [(record_id, record[name_field])]}
+
+
+def _batches(items, batch_size):
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    # Escape the characters of the COPY text format
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _write_rows(conn, table, rows):
+    if not rows:
+        return
+    columns = [column.name for column in table.columns]
+
+    if conn.dialect.name == "postgresql":
+        # Stream the batch through COPY, the fastest way into PostgreSQL
+        data = io.StringIO(
+            "".join("\t".join(_copy_value(value) for value in row) + "\n" for row in rows)
+        )
+        with conn.connection.cursor() as cursor:
+            cursor.copy_expert(
+                "COPY {} ({}) FROM STDIN".format(table.name, ", ".join(columns)), data
+            )
+    else:
+        conn.execute(insert(table), [dict(zip(columns, row)) for row in rows])
+
+
+def _checkpoint(conn, name):
+    return conn.execute(
+        select(dump_checkpoints_table).where(dump_checkpoints_table.c.name == name)
+    ).first()
+
+
+def _save_checkpoint(conn, name, lines, rows, completed=False):
+    conn.execute(delete(dump_checkpoints_table).where(dump_checkpoints_table.c.name == name))
+    conn.execute(
+        insert(dump_checkpoints_table).values(name=name, lines=lines, rows=rows, completed=completed)
+    )
+
+
+def _stage(engine, name, path, to_rows, batch_size, limit=None, progress=False):
+    """Copies the rows of a dump into the staging tables, one committed batch at a time.
+
+    Returns:
+        dict: The number of rows staged by this run and the time it took.
+    """
+    with engine.connect() as conn:
+        checkpoint = _checkpoint(conn, name)
+    if checkpoint is not None and checkpoint.completed:
+        return {"rows": 0, "seconds": 0.0, "resumed": True}
+
+    lines_done = checkpoint.lines if checkpoint else 0
+    rows_done = checkpoint.rows if checkpoint else 0
+    rows = to_rows(read_dump(path, skip=lines_done))
+    if limit is not None:
+        rows = itertools.islice(rows, max(0, limit - rows_done))
+
+    start = time.perf_counter()
+    staged = 0
+    for batch in _batches(rows, batch_size):
+        with engine.begin() as conn:
+            for table in STAGING_TABLES:
+                _write_rows(conn, table, [row for _, tables in batch for row in tables.get(table, ())])
+            lines_done = batch[-1][0]
+            rows_done += len(batch)
+            _save_checkpoint(conn, name, lines_done, rows_done)
+
+        staged += len(batch)
+        if progress:
+            elapsed = time.perf_counter() - start
+            logger.info(
+                "%s: %d records staged, %d lines read (%.0f records/s)",
+                name,
+                rows_done,
+                lines_done,
+                staged / elapsed if elapsed else 0,
+            )
+
+    with engine.begin() as conn:
+        _save_checkpoint(conn, name, lines_done, rows_done, completed=True)
+    return {"rows": staged, "seconds": time.perf_counter() - start, "resumed": checkpoint is not None}
+
+
+def _referenced_ids(engine, column):
+    # The ids referenced by the staged books, if they fit in memory
+    with engine.connect() as conn:
+        count = conn.execute(select(func.count(distinct(column)))).scalar()
+        if count > MAX_REFERENCED_IDS_IN_MEMORY:
+            return None
+        return set(conn.execute(select(distinct(column))).scalars())
+
+
+def _insert_ignore(conn, table):
+    if conn.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def _insert_new_books(conn):
+    # Insert the staged books, skipping the existing ones, and record the ids of the books actually inserted
+    columns = ["id", "title", "number_of_pages"]
+    staged = select(dump_books_table).where(dump_books_table.c.id.is_not(None))
+    if conn.dialect.name == "postgresql":
+        inserted = (
+            postgresql.insert(Book.__table__)
+            .from_select(columns, staged)
+            .on_conflict_do_nothing()
+            .returning(Book.__table__.c.id)
+            .cte("inserted")
+        )
+        conn.execute(insert(dump_new_books_table).from_select(["id"], select(inserted.c.id)).add_cte(inserted))
+    else:
+        # The transaction holds the write lock of the SQLite database from its first write on, so the books
+        # missing before the insert are the ones it inserts
+        conn.execute(
+            insert(dump_new_books_table).from_select(
+                ["id"],
+                select(distinct(dump_books_table.c.id)).where(
+                    dump_books_table.c.id.is_not(None),
+                    ~exists().where(Book.__table__.c.id == dump_books_table.c.id),
+                ),
+            )
+        )
+        conn.execute(
+            sqlite.insert(Book.__table__)
+            .from_select(columns, staged.where(dump_books_table.c.id.in_(select(dump_new_books_table.c.id))))
+            .on_conflict_do_nothing()
+        )
+    return conn.execute(select(func.count()).select_from(dump_new_books_table)).scalar()
+
+
+def _merge(conn):
+    counts = {Book.__tablename__: _insert_new_books(conn)}
+    new_ids = select(dump_new_books_table.c.id)
+
+    # SQLite needs a WHERE clause to tell the ON CONFLICT of an upsert from the ON of a join
+    statements = [
+        (
+            Author.__table__,
+            ["id", "name"],
+            select(dump_authors_table).where(
+                dump_authors_table.c.id.in_(
+                    select(dump_book_authors_table.c.author_id).where(
+                        dump_book_authors_table.c.book_id.in_(new_ids)
+                    )
+                )
+            ),
+        ),
+        (
+            Work.__table__,
+            ["id", "title"],
+            select(dump_works_table).where(
+                dump_works_table.c.id.in_(
+                    select(dump_book_works_table.c.work_id).where(dump_book_works_table.c.book_id.in_(new_ids))
+                )
+            ),
+        ),
+        # Only link the new books to the authors and works that exist (the authors and works of the skipped
+        # books are left out above, so none is stored without a book)
+        (
+            book_author_assoc_table,
+            ["book_id", "author_id"],
+            select(dump_book_authors_table)
+            .join(Author.__table__, Author.__table__.c.id == dump_book_authors_table.c.author_id)
+            .where(dump_book_authors_table.c.book_id.in_(new_ids)),
+        ),
+        (
+            book_work_assoc_table,
+            ["book_id", "work_id"],
+            select(dump_book_works_table)
+            .join(Work.__table__, Work.__table__.c.id == dump_book_works_table.c.work_id)
+            .where(dump_book_works_table.c.book_id.in_(new_ids)),
+        ),
+    ]
+    for table, columns, rows in statements:
+        result = conn.execute(
+            _insert_ignore(conn, table).from_select(columns, rows).on_conflict_do_nothing()
+        )
+        counts[table.name] = result.rowcount
+
+    with Session(bind=conn) as session:
+        # Render the documents of the new books
+        counts[BookDocument.__tablename__] = _render_new_books(session)
+
+        # Log the new books in the change log, under a single sequence number (0 before the catalog_version
+        # migration, which leaves the log empty). Last, so the catalog version is only locked until the commit
+        seq = bump_catalog_version(session) if counts[Book.__tablename__] else 0
+        if seq:
+            changed_at = datetime.now(timezone.utc).replace(tzinfo=None)
+            session.execute(
+                insert(BookChange.__table__).from_select(
+                    ["seq", "book_id", "op", "changed_at"],
+                    select(literal(seq), dump_new_books_table.c.id, literal("insert"), literal(changed_at)),
+                )
+            )
+    return counts
+
+
+def _render_new_books(session, batch_size=IN_QUERY_CHUNK_SIZE):
+    # Walk the new books in id order, so every batch resumes from an index seek
+    rendered = 0
+    last_id = None
+    while True:
+        statement = select(dump_new_books_table.c.id).order_by(dump_new_books_table.c.id).limit(batch_size)
+        if last_id is not None:
+            statement = statement.where(dump_new_books_table.c.id > last_id)
+        book_ids = session.execute(statement).scalars().all()
+        if not book_ids:
+            return rendered
+
+        sync_book_documents(session, book_ids)
+        rendered += len(book_ids)
+        last_id = book_ids[-1]
+
+
+def load_dumps(
+    engine,
+    editions_path,
+    authors_path,
+    works_path,
+    limit=None,
+    languages=None,
+    min_pages=None,
+    batch_size=10000,
+    restart=False,
+    progress=False,
+):
+    """Loads the OpenLibrary editions, authors and works dumps into the database.
+
+    Args:
+        engine (Engine): The engine of the application database, with the application schema created.
+        editions_path (str): The editions dump (gzipped or plain TSV).
+        authors_path (str): The authors dump.
+        works_path (str): The works dump.
+        limit (int, optional): The maximum number of editions to load. Defaults to None (all).
+        languages (list, optional): Only load the editions in these languages (e.g. ['eng']). Defaults to None.
+        min_pages (int, optional): Only load the editions with at least this many pages. Defaults to None.
+        batch_size (int, optional): The number of records staged per transaction. Defaults to 10000.
+        restart (bool, optional): Discard the progress of a previous run. Defaults to False.
+        progress (bool, optional): Log the progress and records/s of every staged batch (at the INFO level of
+            the dump_loader logger). Defaults to False.
+
+    Returns:
+        dict: The records staged from every dump, the rows inserted into every table and the timings.
+    """
+    if restart:
+        staging_metadata.drop_all(engine)
+    staging_metadata.create_all(engine)
+
+    stats = {}
+    stats["editions"] = _stage(
+        engine,
+        "editions",
+        editions_path,
+        lambda lines: edition_rows(_records(lines, "/type/edition"), languages, min_pages),
+        batch_size,
+        limit=limit,
+        progress=progress,
+    )
+    referenced_authors = _referenced_ids(engine, dump_book_authors_table.c.author_id)
+    stats["authors"] = _stage(
+        engine,
+        "authors",
+        authors_path,
+        lambda lines: _named_rows(
+            _records(lines, "/type/author"), dump_authors_table, "name", referenced_authors
+        ),
+        batch_size,
+        progress=progress,
+    )
+    referenced_works = _referenced_ids(engine, dump_book_works_table.c.work_id)
+    stats["works"] = _stage(
+        engine,
+        "works",
+        works_path,
+        lambda lines: _named_rows(
+            _records(lines, "/type/work"), dump_works_table, "title", referenced_works
+        ),
+        batch_size,
+        progress=progress,
+    )
+
+    # Merge the staged rows and drop the staging and checkpoint tables in a single transaction,
+    # so the next load starts from scratch with its own dumps (the merge bumps the catalog version last,
+    # and the drops after it only touch the schema of the tables no other write uses)
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        stats["inserted"] = _merge(conn)
+        staging_metadata.drop_all(conn)
+    stats["merge_seconds"] = time.perf_counter() - start
+
+    return stats
@@ -0,0 +1,93 @@
+"""
+Gunicorn configuration of the production server.
+
+Run it with `gunicorn -c gunicorn.conf.py`. Every setting can be overridden with the GUNICORN_* environment
+variables (or the matching command line options).
+
+- Worker processes and threads are sized from the CPUs available to the process: (2 x CPUs) + 1 gthread workers
+  with GUNICORN_THREADS threads each, so the requests waiting on the database or OpenLibrary overlap.
+- The application is loaded once in the master before forking (preload_app), so the workers share its memory
+  copy-on-write and a broken application fails at startup instead of in every worker.
+- Loading the application doesn't connect to the database (the schema is created by `flask init-db`), and
+  every worker still replaces the connection pool it inherits, so no connection is ever shared by two processes.
+- On SIGTERM the workers stop accepting connections, finish their requests within graceful_timeout, store the
+  import batches in progress, stop compacting the change log and close their connections.
+"""
+
+import os
+
+# The application of app.py (created by its create_app factory)
+wsgi_app = "app:app"
+
+
+def _cpu_count():
+    # The CPUs the process may run on (e.g. restricted by taskset or the container cpuset)
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Server socket
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+backlog = int(os.getenv("GUNICORN_BACKLOG", 2048))
+
+# Worker processes and threads. Every worker has its own connection pool, so keep
+# workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW) under the database connection limit,
+# and GUNICORN_THREADS + IMPORT_WORKERS under DB_POOL_SIZE + DB_MAX_OVERFLOW.
+workers = int(os.getenv("GUNICORN_WORKERS") or _cpu_count() * 2 + 1)
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+preload_app = True
+
+# Timeouts (in seconds) and worker recycling (restart a worker after about max_requests requests,
+# jittered so the workers don't all restart at once, 0 disables it)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+# Logging ("-" logs to stdout)
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def _dispose_engines(close):
+    from app import app
+    from db import db
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
+
+
+def when_ready(server):
+    # Close any connection opened while loading the application, before the workers are forked
+    _dispose_engines(close=True)
+
+    from config.config import config
+
+    if server.cfg.workers > 1 and config["RESPONSE_CACHE_BACKEND"] == "memory":
+        server.log.warning(
+            "Every worker has its own in-process response cache and only invalidates it on its own writes, "
+            "set RESPONSE_CACHE_BACKEND=redis to share it between the %s workers",
+            server.cfg.workers,
+        )
+
+
+def post_fork(server, worker):
+    # Start with an empty pool, without closing the connections of the parent (close=False),
+    # which would send a termination message on sockets the parent may still be using
+    _dispose_engines(close=False)
+
+
+def worker_exit(server, worker):
+    from import_workers import stop_import_workers
+    from utils.change_log import stop_change_log_compaction
+
+    # Store the import batches in progress, end the compaction of the change log and close the
+    # connections of the worker
+    stop_import_workers(timeout=graceful_timeout)
+    stop_change_log_compaction(timeout=graceful_timeout)
+    _dispose_engines(close=True)
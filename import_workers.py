@@ -0,0 +1,129 @@
+"""
+Background workers of the OpenLibrary import jobs.
+
+The queue lives in the import_jobs and import_job_items tables. Every worker repeatedly leases a batch of pending
+items, fetches their books from OpenLibrary and stores them together with the outcome of the items in one
+transaction. Leases expire, so the items of a crashed worker are picked up by another one.
+
+- ImportWorkerPool: A pool of worker threads processing the import items of the database queue.
+- start_import_workers(app): Starts the worker pool of the web process.
+- notify_import_workers(): Wakes up the idle workers of the web process after a job is enqueued.
+- stop_import_workers(timeout): Stops the worker pool of the web process, e.g. when a gunicorn worker exits.
+"""
+
+import os
+import socket
+import threading
+import uuid
+import db_operations
+from utils.app_utils import fetch_openlib_books
+
+
+class ImportWorkerPool:
+    def __init__(self, app, workers, batch_size=50, lease_seconds=300, max_attempts=3, poll_interval=1.0):
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def worker_id(self, index):
+        # Unique across hosts, processes and restarts, so a restarted worker never reuses a stale lease
+        return "{}:{}:{}:{}".format(socket.gethostname(), os.getpid(), index, uuid.uuid4().hex[:8])
+
+    def run_once(self, worker_id):
+        """Processes a single batch of import items.
+
+        Returns:
+            int: The number of items claimed by the worker.
+        """
+        with self.app.app_context():
+            items = db_operations.claim_import_items(
+                worker_id, self.batch_size, self.lease_seconds, self.max_attempts
+            )
+            if not items:
+                return 0
+
+            # Fetch the books, authors and works concurrently, like the synchronous import
+            books = fetch_openlib_books(
+                [code for _, _, code in items],
+                max_workers=self.app.config["OPENLIB_MAX_WORKERS"],
+                lookup_known=db_operations.retrieve_known_openlib_documents,
+            )
+            db_operations.store_import_items(worker_id, items, books)
+            return len(items)
+
+    def _run(self, index):
+        worker_id = self.worker_id(index)
+        while not self.stopping.is_set():
+            try:
+                processed = self.run_once(worker_id)
+            except Exception:
+                # The items stay leased to this worker and are retried after their lease expires
+                self.app.logger.exception("Import worker %s failed", worker_id)
+                processed = 0
+
+            if not processed:
+                # Sleep until a job is enqueued or the poll interval elapses
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, args=(index,), name="import-worker-{}".format(index), daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def notify(self):
+        self.wakeup.set()
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def start_import_workers(app):
+    global _pool
+    if _pool is not None or app.config["IMPORT_WORKERS"] <= 0:
+        return _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            return _pool
+        _pool = ImportWorkerPool(
+            app,
+            app.config["IMPORT_WORKERS"],
+            batch_size=app.config["IMPORT_BATCH_SIZE"],
+            lease_seconds=app.config["IMPORT_LEASE_SECONDS"],
+            max_attempts=app.config["IMPORT_MAX_ATTEMPTS"],
+            poll_interval=app.config["IMPORT_POLL_INTERVAL"],
+        )
+        _pool.start()
+        return _pool
+
+
+def notify_import_workers():
+    if _pool is not None:
+        _pool.notify()
+
+
+def stop_import_workers(timeout=None):
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        # Let the workers store the batch in progress, instead of leaving it to expire
+        pool.stop(timeout)
@@ -0,0 +1,193 @@
+"""
+Schema migrations.
+
+db.create_all() only creates missing tables, so changes to the existing tables are applied here.
+Every migration brings an existing database to the schema of the models and is idempotent, so it
+is also safe on a database freshly created by db.create_all().
+
+- MIGRATIONS: The ordered list of (version, migration) pairs.
+- run_migrations(engine): Applies the migrations that have not been applied yet, each in its own transaction,
+  and records them in the schema_migrations table.
+- init_database(engine): Creates the missing tables, applies the migrations and creates the search indexes
+  (run by `flask init-db` before starting the application, which doesn't touch the schema at startup).
+"""
+
+from datetime import datetime
+from sqlalchemy import inspect, select, text
+from sqlalchemy.orm import Session
+from db import db
+from models.Book import Book
+from models.BookDocument import BookDocument
+from models.CatalogVersion import CatalogVersion
+from models.BookChange import BookChange
+from models.associations.book_author_association import book_author_assoc_table
+from models.associations.book_work_association import book_work_assoc_table
+from utils.db_utils import IN_QUERY_CHUNK_SIZE, sync_book_documents
+from utils.search_utils import setup_search_indexes
+
+schema_migrations_table = db.Table(
+    "schema_migrations",
+    db.Column("version", db.String, primary_key=True),
+    db.Column("applied_at", db.DateTime, nullable=False),
+)
+
+
+def add_association_keys_and_indexes(conn):
+    inspector = inspect(conn)
+
+    for table in [book_author_assoc_table, book_work_assoc_table]:
+        # The column linking the association to the author or work
+        column = [c.name for c in table.columns if c.name != "book_id"][0]
+
+        if not inspector.get_pk_constraint(table.name)["constrained_columns"]:
+            # Keep a single copy of every complete link
+            conn.execute(
+                text(
+                    "CREATE TABLE {0}_distinct AS SELECT DISTINCT book_id, {1} FROM {0} "
+                    "WHERE book_id IS NOT NULL AND {1} IS NOT NULL".format(table.name, column)
+                )
+            )
+            if conn.dialect.name == "sqlite":
+                # SQLite can't add a primary key to an existing table, so recreate it
+                conn.execute(text("DROP TABLE {}".format(table.name)))
+                table.create(conn)
+            else:
+                conn.execute(text("DELETE FROM {}".format(table.name)))
+                conn.execute(
+                    text(
+                        "ALTER TABLE {0} ADD PRIMARY KEY (book_id, {1})".format(
+                            table.name, column
+                        )
+                    )
+                )
+            conn.execute(
+                text(
+                    "INSERT INTO {0} (book_id, {1}) SELECT book_id, {1} FROM {0}_distinct".format(
+                        table.name, column
+                    )
+                )
+            )
+            conn.execute(text("DROP TABLE {}_distinct".format(table.name)))
+
+        # Index the reverse direction of the association
+        conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON {0} ({1})".format(table.name, column)
+            )
+        )
+
+    conn.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_books_number_of_pages ON books (number_of_pages)")
+    )
+
+
+def add_book_documents(conn):
+    # The read model of the books stored before it existed is rendered by 0006_rerender_book_documents,
+    # which always runs after this migration
+    BookDocument.__table__.create(conn, checkfirst=True)
+
+
+def add_book_document_titles(conn):
+    # Sort key of the searches by title
+    columns = [column["name"] for column in inspect(conn).get_columns("book_documents")]
+    if "title" not in columns:
+        conn.execute(text("ALTER TABLE book_documents ADD COLUMN title VARCHAR"))
+        conn.execute(
+            text(
+                "UPDATE book_documents SET title = "
+                "(SELECT title FROM books WHERE books.id = book_documents.book_id)"
+            )
+        )
+    conn.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_book_documents_title ON book_documents (title)")
+    )
+
+
+def add_catalog_version(conn):
+    # The single row of the catalog version, counting the writes from now on
+    CatalogVersion.__table__.create(conn, checkfirst=True)
+    if conn.execute(CatalogVersion.__table__.select()).first() is None:
+        conn.execute(CatalogVersion.__table__.insert().values(id=1, version=1))
+
+
+def add_book_changes(conn):
+    # The change log of the catalog, logging the writes from now on
+    BookChange.__table__.create(conn, checkfirst=True)
+    columns = [column["name"] for column in inspect(conn).get_columns("catalog_version")]
+    if "compacted_seq" not in columns:
+        conn.execute(
+            text("ALTER TABLE catalog_version ADD COLUMN compacted_seq BIGINT NOT NULL DEFAULT 0")
+        )
+    # The books stored before the log aren't in it, so the consumers start with a full read
+    if conn.execute(Book.__table__.select().limit(1)).first() is not None:
+        conn.execute(text("UPDATE catalog_version SET compacted_seq = version"))
+
+
+def rerender_book_documents(conn, batch_size=IN_QUERY_CHUNK_SIZE):
+    # The documents are now written into the responses as they are, render them again like the responses.
+    # In place, so the reads keep finding the document of every book, and one committed batch at a time,
+    # so a large catalog isn't locked until the end (an interrupted run starts over)
+    conn.commit()  # The session then runs its own transactions on the connection, committed by session.commit()
+    with Session(bind=conn) as session:
+        last_id = None
+        while True:
+            # Walk the books in id order, so every batch resumes from an index seek
+            statement = select(Book.id).order_by(Book.id).limit(batch_size)
+            if last_id is not None:
+                statement = statement.where(Book.id > last_id)
+            book_ids = session.execute(statement).scalars().all()
+            if not book_ids:
+                return
+
+            sync_book_documents(session, book_ids)
+            session.commit()
+            last_id = book_ids[-1]
+
+
+MIGRATIONS = [
+    ("0001_association_keys_and_indexes", add_association_keys_and_indexes),
+    ("0002_book_documents", add_book_documents),
+    ("0003_book_document_titles", add_book_document_titles),
+    ("0004_catalog_version", add_catalog_version),
+    ("0005_book_changes", add_book_changes),
+    ("0006_rerender_book_documents", rerender_book_documents),
+]
+
+
+def run_migrations(engine):
+    applied_now = []
+
+    with engine.begin() as conn:
+        schema_migrations_table.create(conn, checkfirst=True)
+        applied = set(
+            conn.execute(schema_migrations_table.select().with_only_columns(
+                schema_migrations_table.c.version
+            )).scalars()
+        )
+
+    for version, migration in MIGRATIONS:
+        if version in applied:
+            continue
+
+        # Every migration is applied and recorded in a transaction of its own, which the long data
+        # migrations may commit in batches (they are idempotent, so an interrupted one is just run again)
+        with engine.connect() as conn:
+            migration(conn)
+            conn.execute(
+                schema_migrations_table.insert().values(
+                    version=version, applied_at=datetime.utcnow()
+                )
+            )
+            conn.commit()
+        applied_now.append(version)
+
+    return applied_now
+
+
+def init_database(engine):
+    # The tables of every model, then the changes to the existing ones and the search indexes
+    db.metadata.create_all(engine)
+    applied_now = run_migrations(engine)
+    setup_search_indexes(engine)
+
+    return applied_now
@@ -7,16 +7,18 @@ class Book(db.Model):
     __tablename__ = "books"
     id = db.Column(db.String, primary_key=True)
     title = db.Column(db.String, nullable=False)
-    number_of_pages = db.Column(db.Integer)
+    number_of_pages = db.Column(db.Integer, index=True)
     authors = db.relationship(
         "Author",
         secondary=book_author_assoc_table,
         back_populates="books",
+        order_by="Author.id",
     )
     works = db.relationship(
         "Work",
         back_populates="books",
         secondary=book_work_assoc_table,
+        order_by="Work.id",
     )
 
     def __init__(self, id, title, number_of_pages):
@@ -0,0 +1,22 @@
+from db import db
+
+
+class BookChange(db.Model):
+    # Append-only log of the changed books, written in the transaction of every write of the catalog
+    __tablename__ = "book_changes"
+    # Catalog version of the write, shared by the books of a batch, so the log follows the commit order
+    seq = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    book_id = db.Column(db.String, primary_key=True)
+    # "insert" or "delete"
+    op = db.Column(db.String, nullable=False)
+    # Compaction key of the retention window
+    changed_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__(self, seq, book_id, op, changed_at):
+        self.seq = seq
+        self.book_id = book_id
+        self.op = op
+        self.changed_at = changed_at
+
+    def __repr__(self):
+        return f"({self.seq}) {self.op} {self.book_id}"
@@ -0,0 +1,26 @@
+from db import db
+
+
+class BookDocument(db.Model):
+    # Denormalized read model of a book, written in the same transaction as the book and its links
+    __tablename__ = "book_documents"
+    book_id = db.Column(db.String, db.ForeignKey("books.id"), primary_key=True)
+    # The book with its authors and works, as returned by the API, serialized as JSON
+    document = db.Column(db.Text, nullable=False)
+    # Filter and sort keys of the searches
+    title = db.Column(db.String, index=True)
+    number_of_pages = db.Column(db.Integer, index=True)
+    # The names of the authors and titles of the works, one per line
+    author_names = db.Column(db.Text, nullable=False)
+    work_titles = db.Column(db.Text, nullable=False)
+
+    def __init__(self, book_id, document, title, number_of_pages, author_names, work_titles):
+        self.book_id = book_id
+        self.document = document
+        self.title = title
+        self.number_of_pages = number_of_pages
+        self.author_names = author_names
+        self.work_titles = work_titles
+
+    def __repr__(self):
+        return f"({self.book_id}) {self.number_of_pages}"
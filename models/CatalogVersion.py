@@ -0,0 +1,17 @@
+from db import db
+
+
+class CatalogVersion(db.Model):
+    # Single row counting the writes of the catalog, bumped in the transaction of every write
+    __tablename__ = "catalog_version"
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+    # Highest version whose changes are no longer in the book_changes log (compacted or written before it)
+    compacted_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+
+    def __init__(self, id, version):
+        self.id = id
+        self.version = version
+
+    def __repr__(self):
+        return f"({self.id}) {self.version}"
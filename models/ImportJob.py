@@ -0,0 +1,21 @@
+from db import db
+
+
+class ImportJob(db.Model):
+    __tablename__ = "import_jobs"
+    id = db.Column(db.String, primary_key=True)
+    # queued -> running -> completed
+    status = db.Column(db.String, nullable=False, default="queued")
+    total = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime)
+    items = db.relationship("ImportJobItem", back_populates="job")
+
+    def __init__(self, id, total, created_at):
+        self.id = id
+        self.status = "queued"
+        self.total = total
+        self.created_at = created_at
+
+    def __repr__(self):
+        return f"({self.id}) {self.status} {self.total}"
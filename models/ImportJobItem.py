@@ -0,0 +1,28 @@
+from db import db
+
+
+class ImportJobItem(db.Model):
+    __tablename__ = "import_job_items"
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String, db.ForeignKey("import_jobs.id"), nullable=False, index=True)
+    code = db.Column(db.String, nullable=False)
+    # pending -> added | skipped
+    status = db.Column(db.String, nullable=False, default="pending")
+    message = db.Column(db.String)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # Worker holding the item and the time its lease expires (the item is reclaimed after that)
+    lease_owner = db.Column(db.String)
+    lease_expires_at = db.Column(db.DateTime)
+    job = db.relationship("ImportJob", back_populates="items")
+
+    # Serves the claim query of the workers (pending items in enqueue order)
+    __table_args__ = (db.Index("ix_import_job_items_status_id", "status", "id"),)
+
+    def __init__(self, job_id, code):
+        self.job_id = job_id
+        self.code = code
+        self.status = "pending"
+        self.attempts = 0
+
+    def __repr__(self):
+        return f"({self.id}) {self.code} {self.status}"
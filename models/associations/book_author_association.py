@@ -1,6 +1,8 @@
 from db import db
 
 book_author_assoc_table = db.Table('book_author_association',
-    db.Column('book_id', db.String, db.ForeignKey('books.id')),
-    db.Column('author_id', db.String, db.ForeignKey('authors.id'))
+    db.Column('book_id', db.String, db.ForeignKey('books.id'), primary_key=True),
+    db.Column('author_id', db.String, db.ForeignKey('authors.id'), primary_key=True),
+    # The primary key serves book -> authors lookups, this index serves author -> books
+    db.Index('ix_book_author_association_author_id', 'author_id'),
 )
@@ -1,6 +1,8 @@
 from db import db
 
 book_work_assoc_table = db.Table('book_work_association',
-    db.Column('book_id', db.String, db.ForeignKey('books.id')),
-    db.Column('work_id', db.String, db.ForeignKey('works.id'))
+    db.Column('book_id', db.String, db.ForeignKey('books.id'), primary_key=True),
+    db.Column('work_id', db.String, db.ForeignKey('works.id'), primary_key=True),
+    # The primary key serves book -> works lookups, this index serves work -> books
+    db.Index('ix_book_work_association_work_id', 'work_id'),
 )
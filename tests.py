@@ -1,5 +1,89 @@
+import gzip
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
-from app import app
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import create_engine, inspect, select, text
+from sqlalchemy.orm import Session
+from app import app, create_app
+from db import db
+import db_operations
+from dump_loader import load_dumps
+from migrations import init_database, run_migrations
+from utils.openlib_client import OpenLibraryClient, get_client
+from utils.openlib_cache import OpenLibraryCache, get_cache
+from utils.instrumentation import SamplingProfiler, write_folded_stacks
+from utils.search_utils import match_authors, setup_search_indexes
+from utils.response_cache import expire_catalog_version, get_response_cache
+from utils.db_utils import delete_books_from_db, insert_books_to_db
+from utils import catalog_snapshot, openlib_cache, openlib_client, response_cache
+from utils.catalog_snapshot import CatalogSnapshot
+from import_workers import ImportWorkerPool
+from config.config import config
+
+# Keep the OpenLibrary cache of the tests in memory
+app.config["OPENLIB_CACHE_PATH"] = ""
+
+# The application doesn't touch the schema at startup, create it like `flask init-db`
+with app.app_context():
+    init_database(db.engine)
+
+
+class StubOpenLibraryHandler(BaseHTTPRequestHandler):
+    # OpenLibrary documents served by the stub, keyed by path without ".json"
+    documents = {
+        "/books/STUBBOOK1M": {
+            "key": "/books/STUBBOOK1M",
+            "title": "Stub Book One",
+            "number_of_pages": 120,
+            "authors": [{"key": "/authors/STUBAUTHOR1A"}],
+            "works": [{"key": "/works/STUBWORK1W"}],
+        },
+        "/books/STUBBOOK2M": {
+            "key": "/books/STUBBOOK2M",
+            "title": "Stub Book Two",
+            "authors": [{"key": "/authors/STUBAUTHOR1A"}],
+            "works": [{"key": "/works/STUBWORK2W"}],
+        },
+        "/books/STUBBOOK3M": {"key": "/books/STUBBOOK3M", "title": "No Works"},
+        "/books/STUBFLAKY5M": {"key": "/books/STUBFLAKY5M", "title": "Flaky"},
+        "/authors/STUBAUTHOR1A": {"key": "/authors/STUBAUTHOR1A", "name": "Stub Author"},
+        "/works/STUBWORK1W": {"key": "/works/STUBWORK1W", "title": "Stub Work One"},
+        "/works/STUBWORK2W": {"key": "/works/STUBWORK2W", "title": "Stub Work Two"},
+    }
+    delay = 0.2  # Seconds of simulated upstream latency per request
+    requested = []
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        path = self.path[: -len(".json")]
+        self.requested.append(path)
+        if path == "/books/STUBFLAKY5M" and self.requested.count(path) < 3:
+            # Fail twice before succeeding
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        document = self.documents.get(path)
+        if document is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(document).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
 
 
 class BookAPITestCase(unittest.TestCase):
@@ -36,6 +120,184 @@ class BookAPITestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         # Add more assertions to validate the response data
 
+    def test_get_books_paginated_and_streamed(self):
+        # Test paging through and streaming all books
+        book_ids = ["PAGEBOOK{}M".format(i) for i in range(5)]
+        books = [
+            {
+                "id": book_id,
+                "title": "Page Book",
+                "authors": [{"id": "PAGEAUTHOR1A", "name": "Page Author"}],
+                "works": [{"id": "PAGEWORK1W", "title": "Page Work"}],
+            }
+            for book_id in book_ids
+        ]
+        self.app.post("/books/bulk", json={"books": books})
+        try:
+            paged_ids = []
+            params = {"limit": 2}
+            while True:
+                response = self.app.get("/books", query_string=params)
+                self.assertEqual(response.status_code, 200)
+                page = response.get_json()
+                self.assertLessEqual(len(page["books"]), 2)
+                paged_ids += [book["id"] for book in page["books"]]
+                if page["next_cursor"] is None:
+                    break
+                params["cursor"] = page["next_cursor"]
+
+            ndjson = self.app.get("/books", query_string={"stream": "ndjson"})
+            ndjson_ids = [json.loads(line)["id"] for line in ndjson.data.splitlines()]
+            array = self.app.get("/books", query_string={"stream": "json"}).get_json()
+
+            self.assertEqual(paged_ids, sorted(paged_ids))
+            self.assertTrue(set(book_ids) <= set(paged_ids))
+            self.assertEqual(ndjson_ids, paged_ids)
+            self.assertEqual([book["id"] for book in array["books"]], paged_ids)
+            self.assertEqual(
+                self.app.get("/books", query_string={"limit": 0}).status_code, 400
+            )
+        finally:
+            with app.app_context():
+                for book_id in book_ids:
+                    db_operations.remove_book(book_id)
+
+    def test_cached_search_invalidation_and_etag(self):
+        # Test that cached searches are revalidated, and rebuilt after the writes of every process
+        def book(book_id, author_name):
+            return {
+                "id": book_id,
+                "title": "Cache Book",
+                "authors": [{"id": book_id + "A", "name": author_name}],
+                "works": [{"id": book_id + "W", "title": "Cache Work"}],
+            }
+
+        params = {"author": "Cachey"}
+        self.app.post("/books", json=book("CACHEBOOK1M", "Cachey McCache"))
+        try:
+            first = self.app.get("/books/search", query_string=params)
+            etag = first.headers["ETag"]
+            self.assertEqual(
+                [b["id"] for b in first.get_json()["books"]], ["CACHEBOOK1M"]
+            )
+
+            # An unchanged result is revalidated without a body
+            revalidated = self.app.get(
+                "/books/search", query_string=params, headers={"If-None-Match": etag}
+            )
+            self.assertEqual(revalidated.status_code, 304)
+
+            # Any write moves the catalog version, so the entry is rebuilt with a new ETag
+            self.app.post("/books", json=book("CACHEBOOK2M", "Someone Else"))
+            rebuilt = self.app.get("/books/search", query_string=params, headers={"If-None-Match": etag})
+            self.assertEqual(rebuilt.status_code, 200)
+            self.assertEqual(rebuilt.get_json(), first.get_json())
+            etag = rebuilt.headers["ETag"]
+
+            # A write of another worker process retires the entry once the catalog version is read again
+            with app.app_context():
+                insert_books_to_db(db.session, [book("CACHEBOOK4M", "Cachey Sr")])
+                expire_catalog_version()
+            self.assertEqual(
+                sorted(b["id"] for b in self.app.get("/books/search", query_string=params).get_json()["books"]),
+                ["CACHEBOOK1M", "CACHEBOOK4M"],
+            )
+
+            # A matching book is listed right away
+            self.app.post("/books", json=book("CACHEBOOK3M", "Cachey Jr"))
+            refreshed = self.app.get(
+                "/books/search", query_string=params, headers={"If-None-Match": etag}
+            )
+            self.assertEqual(refreshed.status_code, 200)
+            self.assertEqual(
+                sorted(b["id"] for b in refreshed.get_json()["books"]),
+                ["CACHEBOOK1M", "CACHEBOOK3M", "CACHEBOOK4M"],
+            )
+
+            # So is the removal of a listed book
+            self.app.delete("/books/CACHEBOOK1M")
+            self.assertEqual(
+                [
+                    b["id"]
+                    for b in self.app.get("/books/search", query_string=params).get_json()[
+                        "books"
+                    ]
+                ],
+                ["CACHEBOOK3M", "CACHEBOOK4M"],
+            )
+        finally:
+            with app.app_context():
+                db_operations.remove_books(["CACHEBOOK1M", "CACHEBOOK2M", "CACHEBOOK3M", "CACHEBOOK4M"])
+
+    def test_compression_and_catalog_version_etags(self):
+        # Test the negotiated compression and the 304s of the unchanged catalog
+        books = [
+            {
+                "id": "GZIPBOOK{}M".format(i),
+                "title": "Compressible Book " * 20,
+                "authors": [{"id": "GZIPAUTHOR1A", "name": "Gzip Author"}],
+                "works": [{"id": "GZIPWORK1W", "title": "Gzip Work"}],
+            }
+            for i in range(5)
+        ]
+        self.app.post("/books/bulk", json={"books": books})
+        gzip_header = {"Accept-Encoding": "br;q=0.5, gzip"}
+        try:
+            plain = self.app.get("/books/search?author=Gzip Author")
+            self.assertNotIn("Content-Encoding", plain.headers)
+            self.assertIn("Accept-Encoding", plain.headers["Vary"])
+
+            # The cached response and its precompressed variant
+            for _ in range(2):
+                compressed = self.app.get("/books/search?author=Gzip Author", headers=gzip_header)
+                self.assertEqual(compressed.headers["Content-Encoding"], "gzip")
+                self.assertEqual(gzip.decompress(compressed.data), plain.data)
+                self.assertLess(len(compressed.data), len(plain.data) / 4)
+            self.assertEqual(compressed.headers["ETag"], plain.headers["ETag"][:-1] + '-gzip"')
+
+            # Streams are compressed as they are sent, small bodies are not compressed
+            stream = self.app.get("/books?stream=ndjson", headers=gzip_header)
+            self.assertEqual(stream.headers["Content-Encoding"], "gzip")
+            self.assertIn(b"GZIPBOOK4M", gzip.decompress(stream.data))
+            small = self.app.get("/books/search?author=Gzip Author&count=true", headers=gzip_header)
+            self.assertNotIn("Content-Encoding", small.headers)
+
+            # Without any write, the ETag is answered without the cache or the database
+            with app.app_context():
+                cache = get_response_cache()
+                if cache:
+                    cache.clear()
+            etag = compressed.headers["ETag"]
+            revalidated = self.app.get(
+                "/books/search?author=Gzip Author", headers=dict(gzip_header, **{"If-None-Match": etag})
+            )
+            self.assertEqual(revalidated.status_code, 304)
+            self.assertEqual(revalidated.headers["ETag"], etag)
+
+            # A cached entry stops answering 304s once a write of another worker process, which doesn't
+            # evict the entries of this one, moved the catalog version
+            cached = self.app.get("/books/search?author=Gzip Author", headers=gzip_header)
+            with app.app_context():
+                delete_books_from_db(db.session, ["GZIPBOOK3M"])
+                expire_catalog_version()
+            stale = self.app.get(
+                "/books/search?author=Gzip Author",
+                headers=dict(gzip_header, **{"If-None-Match": cached.headers["ETag"]}),
+            )
+            self.assertEqual(stale.status_code, 200)
+            self.assertNotIn(b"GZIPBOOK3M", gzip.decompress(stale.data))
+            etag = stale.headers["ETag"]
+
+            # A write bumps the catalog version
+            self.app.delete("/books/GZIPBOOK4M")
+            changed = self.app.get(
+                "/books/search?author=Gzip Author", headers=dict(gzip_header, **{"If-None-Match": etag})
+            )
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed.headers["ETag"], etag)
+        finally:
+            self.app.delete("/books", json={"ids": [book["id"] for book in books]})
+
     def test_search_books(self):
         # Test searching books
         params = {"author": "Steph", "work": "Mis", "min_pages": 100}
@@ -43,6 +305,181 @@ class BookAPITestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         # Add more assertions to validate the response data
 
+    def test_search_filters_sort_and_count(self):
+        # Test the page range, id filters, sorting, paging and counting of the search
+        books = [
+            {
+                "id": "SORTBOOK{}M".format(i),
+                "title": title,
+                "number_of_pages": pages,
+                "authors": [
+                    {"id": "SORTAUTHOR1A", "name": "Sorty Author"},
+                    {"id": "SORTAUTHOR{}A".format(i + 2), "name": "Sorty Coauthor"},
+                ],
+                "works": [{"id": "SORTWORK{}W".format(i), "title": "Sort Work"}],
+            }
+            for i, (title, pages) in enumerate([("Charlie", 300), ("Alpha", 100), ("Bravo", None)])
+        ]
+        self.app.post("/books/bulk", json={"books": books})
+
+        def ids(params):
+            response = self.app.get("/books/search", query_string=params)
+            self.assertEqual(response.status_code, 200)
+            return [book["id"] for book in response.get_json()["books"]]
+
+        try:
+            # Books with several matching authors are listed once
+            self.assertEqual(ids({"author": "Sorty", "sort": "title"}), ["SORTBOOK1M", "SORTBOOK2M", "SORTBOOK0M"])
+            self.assertEqual(ids({"author": "Sorty", "sort": "-pages"}), ["SORTBOOK0M", "SORTBOOK1M", "SORTBOOK2M"])
+            self.assertEqual(ids({"author": "Sorty", "min_pages": 50, "max_pages": 200}), ["SORTBOOK1M"])
+            self.assertEqual(ids({"author_id": ["SORTAUTHOR3A", "SORTAUTHOR4A"]}), ["SORTBOOK1M", "SORTBOOK2M"])
+            self.assertEqual(ids({"work_id": "SORTWORK0W", "id": ["SORTBOOK0M", "SORTBOOK1M"]}), ["SORTBOOK0M"])
+
+            page = self.app.get(
+                "/books/search", query_string={"author_id": "SORTAUTHOR1A", "sort": "title", "limit": 1, "offset": 1}
+            ).get_json()
+            self.assertEqual([book["id"] for book in page["books"]], ["SORTBOOK2M"])
+            self.assertEqual(page["next_offset"], 2)
+
+            count = self.app.get("/books/search", query_string={"author": "Sorty", "count": "true"})
+            self.assertEqual(count.get_json(), {"count": 3})
+            self.assertEqual(
+                self.app.get("/books/search", query_string={"author": "Sorty", "sort": "pages!"}).status_code, 400
+            )
+
+            # Removing a book updates the cached count
+            self.app.delete("/books/SORTBOOK2M")
+            count = self.app.get("/books/search", query_string={"author": "Sorty", "count": "true"})
+            self.assertEqual(count.get_json(), {"count": 2})
+        finally:
+            self.app.delete("/books", json={"ids": [book["id"] for book in books]})
+
+    def test_fast_read_matches_orm_read(self):
+        # Test that the read model and the Core read path return the same bytes as the ORM read path
+        books = [
+            {
+                "id": "FASTBOOK{}M".format(i),
+                "title": "Fäst Böök {}".format(i),
+                "authors": [
+                    {"id": "FASTAUTHOR{}A".format(j), "name": "Fást Àuthor {}".format(j)}
+                    for j in (3 - i, 1)
+                ],
+                "works": [{"id": "FASTWORK{}W".format(i), "title": "Fast Work"}],
+            }
+            for i in range(3)
+        ]
+        books[0]["number_of_pages"] = 321
+        self.app.post("/books/bulk", json={"books": books})
+        urls = [
+            "/books",
+            "/books?limit=2&cursor=FASTBOOK0M",
+            "/books?stream=ndjson",
+            "/books/search?author=Fást Àuthor&work=Fast",
+            "/books/search?author=Fá&work=Fast",
+        ]
+        try:
+            with app.app_context():
+                cache = get_response_cache()
+                bodies = {}
+                for read_model, fast_read in [(True, True), (False, True), (False, False)]:
+                    config["BOOKS_READ_MODEL"] = read_model
+                    config["BOOKS_FAST_READ"] = fast_read
+                    if cache:
+                        cache.clear()
+                    bodies[read_model, fast_read] = [self.app.get(url).data for url in urls]
+            self.assertEqual(bodies[True, True], bodies[False, False])
+            self.assertEqual(bodies[False, True], bodies[False, False])
+            self.assertIn(b'"authors":[{"id":"FASTAUTHOR1A"', bodies[True, True][1])
+            self.assertIn(b"FASTBOOK2M", bodies[True, True][4])
+        finally:
+            config["BOOKS_READ_MODEL"] = True
+            config["BOOKS_FAST_READ"] = True
+            self.app.delete("/books", json={"ids": [book["id"] for book in books]})
+
+    def test_catalog_snapshot_matches_database(self):
+        # Test that the searches served by the catalog snapshot return the same bytes as the database
+        books = [
+            {
+                "id": "SNAPBOOK{}M".format(i),
+                "title": title,
+                "authors": [
+                    {"id": "SNAPAUTHOR1A", "name": "Snäp Author"},
+                    {"id": "SNAPAUTHOR{}A".format(i + 2), "name": "Snap Coauthor {}".format(i)},
+                ],
+                "works": [{"id": "SNAPWORK{}W".format(i % 2), "title": "Snap Work {}".format(i % 2)}],
+            }
+            for i, title in enumerate(["Zulu", "Yankee", "X-ray"])
+        ]
+        books[0]["number_of_pages"] = 120
+        books[1]["number_of_pages"] = 80
+        self.app.post("/books/bulk", json={"books": books})
+        urls = [
+            "/books/search?author=snäp&sort=title",
+            "/books/search?author=Coauthor&min_pages=100",
+            "/books/search?work=Snap Work 1&sort=id",
+            "/books/search?author_id=SNAPAUTHOR1A&sort=-pages&limit=2&offset=1",
+            "/books/search?author_id=SNAPAUTHOR1A&max_pages=100",
+            "/books/search?author=Snäp&count=true",
+            # Non-ASCII letters are folded alike by the index, the unindexed scan and the snapshot
+            "/books/search?author=SNÄP&sort=id",
+            "/books/search?author=ÄP&sort=id",
+        ]
+        try:
+            with app.app_context():
+                cache = get_response_cache()
+                if cache:
+                    cache.clear()
+                expected = [self.app.get(url).data for url in urls]
+                for body in expected[-2:]:
+                    self.assertEqual(len(json.loads(body)["books"]), 3)
+
+                catalog_snapshot._snapshot = CatalogSnapshot.build(db.session)
+                if cache:
+                    cache.clear()
+                self.assertEqual([self.app.get(url).data for url in urls], expected)
+
+                # Writes are applied to the snapshot
+                self.app.post("/books", json=dict(books[2], id="SNAPBOOK9M", title="Whiskey"))
+                self.app.delete("/books/SNAPBOOK0M")
+                response = self.app.get("/books/search?author_id=SNAPAUTHOR1A&sort=title")
+                self.assertEqual(
+                    [book["id"] for book in response.get_json()["books"]],
+                    ["SNAPBOOK9M", "SNAPBOOK2M", "SNAPBOOK1M"],
+                )
+                self.assertEqual(catalog_snapshot._snapshot.stats()["removed_books"], 1)
+                self.assertIsNotNone(self.app.get("/cache/stats").get_json()["catalog_snapshot"])
+
+                # The writes of the other processes are caught up with from the change log
+                insert_books_to_db(db.session, [dict(books[2], id="SNAPBOOK8M", title="Victor")])
+                expire_catalog_version()
+                response = self.app.get("/books/search?author_id=SNAPAUTHOR1A&sort=title")
+                self.assertEqual(
+                    [book["id"] for book in response.get_json()["books"]],
+                    ["SNAPBOOK8M", "SNAPBOOK9M", "SNAPBOOK2M", "SNAPBOOK1M"],
+                )
+
+                # A snapshot failing to catch up is bypassed, and the searches served by the database
+                def fail(session):
+                    raise RuntimeError("Snapshot failure")
+
+                snapshot = catalog_snapshot._snapshot
+                snapshot.catch_up = fail
+                self.app.delete("/books/SNAPBOOK8M")
+                response = self.app.get("/books/search?author_id=SNAPAUTHOR1A&sort=title")
+                self.assertEqual(
+                    [book["id"] for book in response.get_json()["books"]],
+                    ["SNAPBOOK9M", "SNAPBOOK2M", "SNAPBOOK1M"],
+                )
+                self.assertTrue(snapshot.stale)
+        finally:
+            # Let the rebuild of the stale snapshot finish before dropping it
+            while catalog_snapshot._building:
+                time.sleep(0.01)
+            catalog_snapshot._snapshot = None
+            self.app.delete(
+                "/books", json={"ids": [book["id"] for book in books] + ["SNAPBOOK8M", "SNAPBOOK9M"]}
+            )
+
     def test_create_book(self):
         # Test creating a new book entry
         data = {
@@ -62,6 +499,341 @@ class BookAPITestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         # Add more assertions to validate the response data
 
+    def test_create_books_bulk(self):
+        # Test creating a batch of book entries
+        author = {"id": "BULKAUTHOR1A", "name": "Bulk Author"}
+        data = {
+            "books": [
+                {
+                    "id": "BULKBOOK1M",
+                    "title": "Bulk Book One",
+                    "number_of_pages": 100,
+                    "authors": [author],
+                    "works": [{"id": "BULKWORK1W", "title": "Bulk Work"}],
+                },
+                {
+                    "id": "BULKBOOK2M",
+                    "title": "Bulk Book Two",
+                    "authors": [author],
+                    "works": [{"id": "BULKWORK1W", "title": "Bulk Work"}],
+                },
+                {"id": "BULKBOOK1M", "title": "Duplicate", "authors": [], "works": []},
+                {"id": "BULKBOOK3M", "title": "Missing authors and works"},
+            ]
+        }
+        try:
+            response = self.app.post("/books/bulk", json=data)
+            self.assertEqual(response.status_code, 200)
+            result = response.get_json()
+            self.assertEqual(result["added_books"], ["BULKBOOK1M", "BULKBOOK2M"])
+            self.assertEqual(
+                result["skipped_books"],
+                [
+                    {"BULKBOOK1M": "Skipped because of: Book BULKBOOK1M already in the database"},
+                    {"BULKBOOK3M": "Skipped because of: Missing required fields"},
+                ],
+            )
+        finally:
+            with app.app_context():
+                for book_id in ["BULKBOOK1M", "BULKBOOK2M"]:
+                    db_operations.remove_book(book_id)
+
+    def test_batch_endpoints(self):
+        # Test the chunked and atomic batch creation and deletion with per-item results
+        def book(i, **fields):
+            return dict(
+                {
+                    "id": "BATCHBOOK{}M".format(i),
+                    "title": "Batch Book",
+                    "authors": [{"id": "BATCHAUTHOR1A", "name": "Batch Author"}],
+                    "works": [{"id": "BATCHWORK1W", "title": "Batch Work"}],
+                },
+                **fields,
+            )
+
+        chunk_size = app.config["BOOKS_BATCH_CHUNK_SIZE"]
+        app.config["BOOKS_BATCH_CHUNK_SIZE"] = 2
+        try:
+            # A book failing in the database only skips itself, not its chunk
+            books = [book(1), book(2), "invalid", book(3, number_of_pages=2**70), book(1), book(4)]
+            response = self.app.post("/books:batch", json={"books": books})
+            self.assertEqual(response.status_code, 200)
+            result = response.get_json()
+            self.assertEqual(result["added_books"], ["BATCHBOOK1M", "BATCHBOOK2M", "BATCHBOOK4M"])
+            self.assertEqual(
+                [list(skipped)[0] for skipped in result["skipped_books"]],
+                ["null", "BATCHBOOK3M", "BATCHBOOK1M"],
+            )
+            self.assertEqual(
+                result["skipped_books"][0], {"null": "Skipped because of: Invalid book"}
+            )
+
+            # The books of a chunk retried in savepoints share a single catalog version
+            app.config["BOOKS_BATCH_CHUNK_SIZE"] = 3
+            since = self.app.get("/books/changes", query_string={"since": 0, "limit": 1}).get_json()["latest"]
+            response = self.app.post(
+                "/books:batch", json={"books": [book(6), book(3, number_of_pages=2**70), book(7)]}
+            )
+            self.assertEqual(response.get_json()["added_books"], ["BATCHBOOK6M", "BATCHBOOK7M"])
+            self.app.delete("/books:batch", json={"ids": ["BATCHBOOK6M", "BATCHBOOK7M"]})
+            changes = self.app.get("/books/changes", query_string={"since": since}).get_json()["changes"]
+            self.assertEqual(
+                [(change["seq"], change["op"], change["book_id"]) for change in changes],
+                [
+                    (since + 1, "insert", "BATCHBOOK6M"),
+                    (since + 1, "insert", "BATCHBOOK7M"),
+                    (since + 2, "delete", "BATCHBOOK6M"),
+                    (since + 2, "delete", "BATCHBOOK7M"),
+                ],
+            )
+            app.config["BOOKS_BATCH_CHUNK_SIZE"] = 2
+
+            # An atomic batch is stored entirely or not at all
+            response = self.app.post("/books:batch", json={"books": [book(5), book(1)], "atomic": True})
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(
+                response.get_json()["skipped_books"][0],
+                {"BATCHBOOK5M": "Skipped because of: The atomic batch was not stored"},
+            )
+            response = self.app.post("/books:batch", json={"books": [book(5), {"id": "X"}], "atomic": True})
+            self.assertEqual(response.status_code, 400)
+            response = self.app.delete("/books:batch", json={"ids": ["BATCHBOOK1M", "MISSINGM"], "atomic": True})
+            self.assertEqual(response.status_code, 409)
+
+            ids = ["BATCHBOOK1M", "MISSINGM", 5, "BATCHBOOK2M", "BATCHBOOK4M", "BATCHBOOK5M"]
+            response = self.app.delete("/books:batch", json={"ids": ids})
+            self.assertEqual(response.get_json()["deleted_books"], ["BATCHBOOK1M", "BATCHBOOK2M", "BATCHBOOK4M"])
+            self.assertEqual(
+                response.get_json()["skipped_books"],
+                [
+                    {"MISSINGM": "Skipped because of: Book not found."},
+                    {"5": "Skipped because of: Invalid id"},
+                    {"BATCHBOOK5M": "Skipped because of: Book not found."},
+                ],
+            )
+            self.assertEqual(
+                self.app.post("/books:batch", json={"books": "invalid"}).status_code, 400
+            )
+        finally:
+            app.config["BOOKS_BATCH_CHUNK_SIZE"] = chunk_size
+            with app.app_context():
+                db_operations.remove_books(["BATCHBOOK{}M".format(i) for i in range(1, 6)])
+
+    def test_book_changes_feed(self):
+        # Test following the inserts and deletes of the catalog in commit order, and the resync after a compaction
+        since = self.app.get("/books/changes", query_string={"since": 0, "limit": 1}).get_json()["latest"]
+        books = [
+            {
+                "id": "FEEDBOOK{}M".format(i),
+                "title": "Feed Book",
+                "authors": [{"id": "FEEDAUTHOR1A", "name": "Feed Author"}],
+                "works": [{"id": "FEEDWORK1W", "title": "Feed Work"}],
+            }
+            for i in range(3)
+        ]
+        self.app.post("/books/bulk", json={"books": books})
+        self.app.delete("/books/FEEDBOOK1M")
+
+        # The changes of a write share its sequence number and are never split between two pages
+        page = self.app.get("/books/changes", query_string={"since": since, "limit": 1}).get_json()
+        self.assertEqual([change["book_id"] for change in page["changes"]], ["FEEDBOOK0M", "FEEDBOOK1M", "FEEDBOOK2M"])
+        self.assertEqual({change["seq"] for change in page["changes"]}, {since + 1})
+        self.assertEqual(page["changes"][0]["book"]["authors"], [{"id": "FEEDAUTHOR1A", "name": "Feed Author"}])
+        self.assertIsNone(page["changes"][1]["book"])
+
+        page = self.app.get("/books/changes", query_string={"since": page["next_since"], "wait": 0.1}).get_json()
+        self.assertEqual(page["changes"], [{"seq": since + 2, "op": "delete", "book_id": "FEEDBOOK1M", "book": None}])
+        self.assertEqual(page["next_since"], page["latest"])
+        self.assertEqual(self.app.get("/books/changes", query_string={"since": "x"}).status_code, 400)
+
+        # The consumers behind the compacted changes must resync
+        result = app.test_cli_runner().invoke(args=["compact-changes", "--retention", "-1"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        response = self.app.get("/books/changes", query_string={"since": since})
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.get_json()["latest"], since + 2)
+        self.assertEqual(self.app.get("/books/changes", query_string={"since": since + 2}).status_code, 200)
+
+        with app.app_context():
+            db_operations.remove_books(["FEEDBOOK0M", "FEEDBOOK2M"])
+
+    def test_concurrent_overlapping_imports(self):
+        # Test that concurrent batches sharing books, authors and works neither conflict nor duplicate
+        def books(start):
+            return [
+                {
+                    "id": "RACEBOOK{}M".format(i),
+                    "title": "Race Book",
+                    "authors": [{"id": "RACEAUTHOR{}A".format(i % 3), "name": "Race Author"}],
+                    "works": [{"id": "RACEWORK{}W".format(i % 2), "title": "Race Work"}],
+                }
+                for i in range(start, start + 20)
+            ]
+
+        messages = []
+
+        def store(start):
+            with app.app_context():
+                messages.extend(db_operations.store_books(books(start)))
+
+        threads = [threading.Thread(target=store, args=(start,)) for start in (0, 10, 0, 10)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Every book is added by exactly one batch, the others report it as existing
+            added = sorted(m["success"].split()[1] for m in messages if "success" in m)
+            self.assertEqual(added, sorted("RACEBOOK{}M".format(i) for i in range(30)))
+            errors = [m["error"] for m in messages if "error" in m]
+            self.assertEqual(len(errors), 50)
+            self.assertTrue(all(error.endswith("already in the database") for error in errors))
+            with app.app_context():
+                result = db_operations.retrieve_books_by_criteria("Race Author", None, None)
+                self.assertEqual(len(result), 30)
+                self.assertTrue(all(len(book["authors"]) == 1 for book in result))
+        finally:
+            with app.app_context():
+                db_operations.remove_books(["RACEBOOK{}M".format(i) for i in range(30)])
+
+    def test_delete_books_bulk(self):
+        # Test deleting a batch of books and their orphaned authors and works
+        shared_author = {"id": "DELAUTHOR1A", "name": "Shared Author"}
+        books = [
+            {
+                "id": "DELBOOK{}M".format(i),
+                "title": "Delete Book",
+                "authors": [shared_author, {"id": "DELAUTHOR{}B".format(i), "name": "Own"}],
+                "works": [{"id": "DELWORK1W", "title": "Shared Work"}],
+            }
+            for i in range(3)
+        ]
+        self.app.post("/books/bulk", json={"books": books})
+
+        response = self.app.delete(
+            "/books", json={"ids": ["DELBOOK0M", "DELBOOK1M", "DELMISSINGM"]}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.get_json(),
+            {
+                "deleted_books": ["DELBOOK0M", "DELBOOK1M"],
+                "skipped_books": [{"DELMISSINGM": "Skipped because of: Book not found."}],
+            },
+        )
+
+        with app.app_context():
+            remaining = db_operations.retrieve_books_by_criteria("Own", None, None)
+            self.assertEqual([book["id"] for book in remaining], ["DELBOOK2M"])
+            # The shared author and work are kept for the remaining book
+            self.assertEqual(
+                sorted(author["id"] for author in remaining[0]["authors"]),
+                ["DELAUTHOR1A", "DELAUTHOR2B"],
+            )
+            self.assertEqual(
+                db_operations.retrieve_known_openlib_documents(
+                    ["/authors/DELAUTHOR0B", "/authors/DELAUTHOR1A", "/works/DELWORK1W"]
+                ).keys(),
+                {"/authors/DELAUTHOR1A", "/works/DELWORK1W"},
+            )
+            db_operations.remove_book("DELBOOK2M")
+            self.assertEqual(
+                db_operations.retrieve_known_openlib_documents(
+                    ["/authors/DELAUTHOR1A", "/works/DELWORK1W"]
+                ),
+                {},
+            )
+
+    def test_metrics(self):
+        # Test exporting the metrics in the Prometheus text format
+        self.app.get("/books")
+        response = self.app.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        body = response.data.decode("utf-8")
+        self.assertIn("books_db_pool_checkout_wait_seconds_count", body)
+        self.assertIn("books_db_pool_connects_total", body)
+        self.assertIn('books_openlib_cache_lookups_total{result="misses"}', body)
+        self.assertIn('books_http_request_duration_seconds_count{endpoint="/books",method="GET"}', body)
+        self.assertIn('phase="hydrate"', body)
+
+    def test_server_timing(self):
+        # Test the phase timings of a request in the Server-Timing header
+        response = self.app.get("/books/search?author=" + str(time.time()))
+        self.assertEqual(response.status_code, 200)
+        timing = response.headers["Server-Timing"]
+        for name in ["db", "hydrate", "serialize", "openlib", "total"]:
+            self.assertIn(name + ";dur=", timing)
+        self.assertNotIn('desc="0 queries"', timing)
+
+    def test_create_app(self):
+        # Test creating a separate application with its own settings
+        other = create_app({"INSTRUMENTATION_ENABLED": False, "BOOKS_MAX_PAGE_SIZE": 1})
+        self.assertIsNot(other, app)
+        client = other.test_client()
+        self.assertEqual(client.get("/books", query_string={"limit": 2}).status_code, 400)
+        response = client.get("/books", query_string={"limit": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Server-Timing", response.headers)
+
+        # The shared client and caches of the process take the settings of the application creating them
+        shared = openlib_client._client, openlib_cache._cache, response_cache._response_cache
+        openlib_client._client = openlib_cache._cache = response_cache._response_cache = None
+        try:
+            other = create_app(
+                {"OPENLIB_URL_BASE": "http://openlib.test", "OPENLIB_CACHE_TTL": 5, "RESPONSE_CACHE_MAX_ENTRIES": 7}
+            )
+            with tempfile.TemporaryDirectory() as tmpdir, other.app_context():
+                self.assertEqual(get_client().url_base, "http://openlib.test")
+                self.assertEqual(get_response_cache().backend.max_entries, 7)
+                # The cache file is in the instance folder of the application
+                other.instance_path = os.path.join(tmpdir, "instance")
+                cache = get_cache()
+                self.assertEqual(cache.ttl, 5)
+                self.assertTrue(os.path.exists(os.path.join(tmpdir, "instance", "openlib_cache.db")))
+                cache.conn.close()
+        finally:
+            openlib_client._client, openlib_cache._cache, response_cache._response_cache = shared
+
+    def test_init_db_command(self):
+        # Test that creating the application doesn't connect to the database, and `flask init-db` creates the schema
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "init.db")
+            other = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path, "SQLALCHEMY_ENGINE_OPTIONS": {}})
+            self.assertFalse(os.path.exists(path))
+
+            result = other.test_cli_runner().invoke(args=["init-db"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with other.app_context():
+                tables = inspect(db.engine).get_table_names()
+                db.engine.dispose()
+            for table in ["books", "authors", "works", "import_job_items", "schema_migrations", "authors_fts"]:
+                self.assertIn(table, tables)
+
+    def test_sampling_profiler(self):
+        # Test writing the stacks of the requests over the latency threshold
+        with tempfile.TemporaryDirectory() as tmpdir:
+            app.config.update(
+                PROFILER_ENABLED=True, PROFILER_THRESHOLD_MS=0, PROFILER_INTERVAL_MS=1, PROFILER_OUTPUT_DIR=tmpdir
+            )
+            try:
+                self.app.get("/books/search?author=" + str(time.time()))
+            finally:
+                app.config.update(PROFILER_ENABLED=False)
+            self.assertTrue(all(name.endswith(".folded") for name in os.listdir(tmpdir)))
+
+            # Sample a busy thread directly, so the test doesn't depend on the request latency
+            profiler = SamplingProfiler(interval=0.001)
+            profiler.start(threading.get_ident())
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+            path = write_folded_stacks(tmpdir, "busy", profiler.stop(threading.get_ident()))
+            with open(path) as f:
+                stack, count = f.readline().rsplit(" ", 1)
+            self.assertIn("test_sampling_profiler (tests.py:", stack)
+            self.assertGreater(int(count), 0)
+
     def test_delete_book(self):
         # Test deleting a book
         book_id = "OL10426195M"
@@ -70,5 +842,468 @@ class BookAPITestCase(unittest.TestCase):
         # Add more assertions to validate the response data
 
 
+class StubOpenLibraryTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Serve the OpenLibrary API from a local stub server
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenLibraryHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url_base = get_client().url_base
+        get_client().url_base = "http://127.0.0.1:{}".format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        get_client().url_base = cls.url_base
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        app.testing = True
+        self.app = app.test_client()
+        StubOpenLibraryHandler.requested.clear()
+        with app.app_context():
+            get_cache().clear()
+
+    def tearDown(self):
+        with app.app_context():
+            for book_id in ["STUBBOOK1M", "STUBBOOK2M"]:
+                db_operations.remove_book(book_id)
+
+    def test_store_openlib_books_concurrently(self):
+        codes = ["STUBBOOK1M", "STUBBOOK2M", "STUBBOOK3M", "STUBMISSING4M"]
+        start = time.perf_counter()
+        response = self.app.post("/store_openlib_books", json={"codes": codes})
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data["added_books"], ["STUBBOOK1M", "STUBBOOK2M"])
+        self.assertEqual(
+            [list(skipped)[0] for skipped in data["skipped_books"]],
+            ["STUBBOOK3M", "STUBMISSING4M"],
+        )
+        self.assertEqual(
+            data["skipped_books"][0]["STUBBOOK3M"], "Skipped because of: Missing fields"
+        )
+        # The shared author is fetched only once
+        self.assertEqual(StubOpenLibraryHandler.requested.count("/authors/STUBAUTHOR1A"), 1)
+        # 7 requests of 0.2s each, but only two round trips deep
+        self.assertLess(elapsed, 7 * StubOpenLibraryHandler.delay)
+
+    def test_client_retries_with_backoff(self):
+        client = OpenLibraryClient(
+            url_base=get_client().url_base, max_retries=2, backoff_factor=0.01
+        )
+        book = client.get_json("/books/STUBFLAKY5M")
+
+        self.assertEqual(book["title"], "Flaky")
+        stats = client.stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["failures"], 0)
+
+    def test_known_authors_and_works_skip_network(self):
+        self.app.post("/store_openlib_books", json={"codes": ["STUBBOOK1M"]})
+        get_cache().clear()
+        StubOpenLibraryHandler.requested.clear()
+
+        response = self.app.post("/store_openlib_books", json={"codes": ["STUBBOOK2M"]})
+
+        self.assertEqual(response.get_json()["added_books"], ["STUBBOOK2M"])
+        # The author is already stored, so only the book and its new work are requested
+        self.assertEqual(
+            sorted(StubOpenLibraryHandler.requested),
+            ["/books/STUBBOOK2M", "/works/STUBWORK2W"],
+        )
+        # The lookup runs in its own session, leaving no transaction open during the fetch
+        with app.app_context():
+            known = db_operations.retrieve_known_openlib_documents(["/authors/STUBAUTHOR1A", "/works/STUBWORK2W"])
+            self.assertEqual(sorted(known), ["/authors/STUBAUTHOR1A", "/works/STUBWORK2W"])
+            self.assertFalse(db.session().in_transaction())
+
+    def wait_for_import_job(self, status_url):
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            job = self.app.get(status_url, query_string={"details": "true"}).get_json()
+            if job["status"] == "completed":
+                return job
+            time.sleep(0.1)
+        self.fail("Import job did not complete")
+
+    def test_async_import_job(self):
+        codes = ["STUBBOOK1M", "STUBBOOK2M", "STUBBOOK3M", "STUBBOOK1M"]
+        response = self.app.post("/store_openlib_books", json={"codes": codes, "async": True})
+
+        self.assertEqual(response.status_code, 202)
+        status_url = response.get_json()["status_url"]
+        self.assertEqual(response.headers["Location"], status_url)
+
+        job = self.wait_for_import_job(status_url)
+        self.assertEqual((job["total"], job["processed"], job["added"]), (4, 4, 2))
+        self.assertEqual(job["added_books"], ["STUBBOOK1M", "STUBBOOK2M"])
+        self.assertEqual(
+            job["skipped_books"],
+            [
+                {"STUBBOOK3M": "Skipped because of: Missing fields"},
+                {"STUBBOOK1M": "Skipped because of: Book STUBBOOK1M already in the database"},
+            ],
+        )
+
+        # The stream of a completed job ends after its final status
+        events = self.app.get(status_url, query_string={"stream": "true"}).data.decode()
+        self.assertEqual(json.loads(events.split("data: ")[-1])["status"], "completed")
+        self.assertEqual(self.app.get("/imports/missing").status_code, 404)
+
+    @unittest.skipIf(
+        any(importlib.util.find_spec(name) is None for name in ("starlette", "httpx", "aiosqlite", "a2wsgi")),
+        "requires the packages of requirements-async.txt",
+    )
+    def test_async_serving_mode_matches_sync_app(self):
+        from starlette.testclient import TestClient
+        from asgi import create_asgi_app
+
+        codes = ["STUBBOOK1M", "STUBBOOK2M", "STUBBOOK3M", "STUBMISSING4M"]
+        sync_response = self.app.post("/store_openlib_books", json={"codes": codes})
+        self.tearDown()
+        get_cache().clear()
+
+        url_base = app.config["OPENLIB_URL_BASE"]
+        app.config["OPENLIB_URL_BASE"] = get_client().url_base
+        try:
+            with TestClient(create_asgi_app(app)) as client:
+                # Same body as the sync app, with each shared author still fetched once
+                StubOpenLibraryHandler.requested.clear()
+                get_client().reset_stats()
+                response = client.post("/store_openlib_books", json={"codes": codes})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content, sync_response.data)
+                self.assertEqual(StubOpenLibraryHandler.requested.count("/authors/STUBAUTHOR1A"), 1)
+                # The requests of the async client are counted with those of the sync client
+                stats = client.get("/openlib/stats").json()["client"]
+                self.assertEqual(stats["requests"], len(StubOpenLibraryHandler.requested))
+                self.assertEqual(stats["failures"], 1)
+                self.assertIn(
+                    "books_openlib_request_seconds_count {}".format(stats["requests"]),
+                    client.get("/metrics").text,
+                )
+                self.assertEqual(
+                    client.post("/store_openlib_books", json={}).json(),
+                    [{"error": "Invalid code list provided."}, 400],
+                )
+
+                # Background jobs and their progress
+                response = client.post("/store_openlib_books", json={"codes": codes[:2], "async": True})
+                self.assertEqual(response.status_code, 202)
+                status_url = response.json()["status_url"]
+                self.assertEqual(response.headers["Location"], status_url)
+                job = self.wait_for_import_job(status_url)
+                self.assertEqual(client.get(status_url, params={"details": "true"}).json(), job)
+                events = client.get(status_url, params={"stream": "true"}).text
+                self.assertEqual(json.loads(events.split("data: ")[-1])["status"], "completed")
+                self.assertEqual(client.get("/imports/missing").status_code, 404)
+
+                # The other routes are served by the Flask application
+                self.assertEqual(
+                    client.get("/books/search", params={"author": "Stub Author"}).content,
+                    self.app.get("/books/search", query_string={"author": "Stub Author"}).data,
+                )
+        finally:
+            app.config["OPENLIB_URL_BASE"] = url_base
+
+    def test_import_job_survives_crashed_worker(self):
+        with app.app_context():
+            job_id = db_operations.enqueue_import_job(["STUBBOOK1M", "STUBBOOK2M"])
+            # A worker claims the items and crashes, its lease expires right away
+            items = db_operations.claim_import_items("crashed-worker", 10, -1, 3)
+            self.assertEqual([code for _, _, code in items], ["STUBBOOK1M", "STUBBOOK2M"])
+
+        # Another worker picks the items up again
+        ImportWorkerPool(app, 1).run_once("recovering-worker")
+        job = self.wait_for_import_job("/imports/" + job_id)
+        self.assertEqual(job["added_books"], ["STUBBOOK1M", "STUBBOOK2M"])
+        self.assertEqual(job["skipped_books"], [])
+
+        # The late result of the crashed worker is discarded
+        with app.app_context():
+            books = {code: None for _, _, code in items}
+            self.assertFalse(db_operations.store_import_items("crashed-worker", items, books))
+            self.assertEqual(db_operations.retrieve_import_job(job_id)["skipped"], 0)
+
+
+class OpenLibraryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_persistent_tier_survives_restart(self):
+        OpenLibraryCache(self.path).set("/authors/OL1A", {"name": "A"})
+        cache = OpenLibraryCache(self.path)
+
+        self.assertEqual(cache.get("/authors/OL1A"), {"name": "A"})
+        self.assertEqual(cache.get("/authors/OL1A"), {"name": "A"})
+        self.assertIsNone(cache.get("/authors/OL2A"))
+        stats = cache.stats()
+        self.assertEqual((stats["disk_hits"], stats["hot_hits"], stats["misses"]), (1, 1, 1))
+
+    def test_ttl_and_lru_eviction(self):
+        cache = OpenLibraryCache(self.path, ttl=0)
+        cache.set("/works/OL1W", {"title": "W"})
+        self.assertIsNone(cache.get("/works/OL1W"))
+
+        cache = OpenLibraryCache(self.path, max_entries=2, hot_max_entries=1)
+        for i in range(3):
+            cache.set("/works/OL{}W".format(i), {"title": i})
+        cache.hot.clear()
+
+        self.assertIsNone(cache.get("/works/OL0W"))
+        self.assertEqual(cache.get("/works/OL2W"), {"title": 2})
+        self.assertEqual(cache.stats()["disk_entries"], 2)
+
+    def test_concurrent_misses_fetch_once(self):
+        cache = OpenLibraryCache(self.path)
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            time.sleep(0.2)
+            return {"name": "A"}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get_or_fetch("/authors/OL1A", fetch)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual((len(fetches), results), (1, [{"name": "A"}] * 5))
+        self.assertEqual(cache.stats()["coalesced"], 4)
+
+    def test_fetch_lock_shared_by_processes(self):
+        # Two caches on the same file stand for two worker processes
+        fetching, waiting = OpenLibraryCache(self.path), OpenLibraryCache(self.path, poll_interval=0.01)
+        self.assertTrue(fetching.claim_fetch("/works/OL1W"))
+
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(waiting.get_or_fetch("/works/OL1W", lambda: {"title": "Refetched"}))
+        )
+        thread.start()
+        time.sleep(0.1)
+        fetching.set("/works/OL1W", {"title": "W"})
+        fetching.release_fetch("/works/OL1W")
+        thread.join()
+
+        self.assertEqual(results, [{"title": "W"}])
+        self.assertGreater(waiting.stats()["lock_waits"], 0)
+
+        # The expired lock of a crashed process is taken over
+        self.assertTrue(OpenLibraryCache(self.path, lock_timeout=-1).claim_fetch("/works/OL2W"))
+        self.assertEqual(waiting.get_or_fetch("/works/OL2W", lambda: {"title": "W2"}), {"title": "W2"})
+
+        # A lock is only released by its owner, even in the same process
+        self.assertTrue(fetching.claim_fetch("/works/OL3W"))
+        waiting.release_fetch("/works/OL3W")
+        self.assertFalse(waiting.claim_fetch("/works/OL3W"))
+
+
+class MigrationsTestCase(unittest.TestCase):
+    def test_migrate_legacy_association_tables(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = create_engine("sqlite:///" + os.path.join(tmpdir, "legacy.db"))
+            with engine.begin() as conn:
+                conn.execute(text("CREATE TABLE books (id VARCHAR PRIMARY KEY, title VARCHAR, number_of_pages INTEGER)"))
+                conn.execute(text("CREATE TABLE book_author_association (book_id VARCHAR, author_id VARCHAR)"))
+                conn.execute(text("CREATE TABLE book_work_association (book_id VARCHAR, work_id VARCHAR)"))
+                conn.execute(text("CREATE TABLE authors (id VARCHAR PRIMARY KEY, name VARCHAR)"))
+                conn.execute(text("CREATE TABLE works (id VARCHAR PRIMARY KEY, title VARCHAR)"))
+                conn.execute(text("INSERT INTO books VALUES ('B1', 'Legacy Book', NULL)"))
+                conn.execute(text("INSERT INTO authors VALUES ('A1', 'Legacy Author')"))
+                conn.execute(text("INSERT INTO book_author_association VALUES ('B1', 'A1'), ('B1', 'A1'), ('B1', NULL)"))
+
+            self.assertEqual(
+                run_migrations(engine),
+                [
+                    "0001_association_keys_and_indexes",
+                    "0002_book_documents",
+                    "0003_book_document_titles",
+                    "0004_catalog_version",
+                    "0005_book_changes",
+                    "0006_rerender_book_documents",
+                ],
+            )
+            self.assertEqual(run_migrations(engine), [])
+
+            inspector = inspect(engine)
+            self.assertEqual(
+                inspector.get_pk_constraint("book_author_association")["constrained_columns"],
+                ["book_id", "author_id"],
+            )
+            self.assertIn(
+                "ix_book_work_association_work_id",
+                [index["name"] for index in inspector.get_indexes("book_work_association")],
+            )
+            with engine.connect() as conn:
+                self.assertEqual(
+                    conn.execute(text("SELECT * FROM book_author_association")).all(),
+                    [("B1", "A1")],
+                )
+                # The books stored before the read model existed are rendered by the migration
+                self.assertEqual(
+                    json.loads(conn.execute(text("SELECT document FROM book_documents")).scalar()),
+                    {"id": "B1", "title": "Legacy Book", "authors": [{"id": "A1", "name": "Legacy Author"}], "works": []},
+                )
+                # The books stored before the change log are only available to a full read
+                self.assertEqual(
+                    conn.execute(text("SELECT version, compacted_seq FROM catalog_version")).all(), [(1, 1)]
+                )
+            engine.dispose()
+
+    def test_search_index_keys_survive_vacuum(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = create_engine("sqlite:///" + os.path.join(tmpdir, "search.db"))
+            db.metadata.create_all(engine)
+            with engine.begin() as conn:
+                # The external content index of earlier versions, keyed by the implicit rowids
+                conn.execute(
+                    text("CREATE VIRTUAL TABLE authors_fts USING fts5(name, content='authors', content_rowid='rowid')")
+                )
+                conn.execute(text("INSERT INTO authors VALUES ('A1', 'Legacy Author'), ('A2', 'Other Author')"))
+            setup_search_indexes(engine)
+
+            with engine.begin() as conn:
+                conn.execute(text("INSERT INTO authors VALUES ('A3', 'Third Author')"))
+                conn.execute(text("DELETE FROM authors WHERE id = 'A1'"))
+                conn.execute(text("UPDATE authors SET name = 'Renamed Writer' WHERE id = 'A2'"))
+            with engine.connect() as conn:
+                conn.execute(text("VACUUM"))
+
+            with Session(engine) as session:
+                def matches(term):
+                    return sorted(session.execute(select(match_authors(session, term).subquery().c.id)).scalars())
+
+                self.assertEqual(matches("author"), ["A3"])
+                self.assertEqual(matches("writer"), ["A2"])
+                self.assertEqual(matches("legacy"), [])
+            engine.dispose()
+
+
+class DumpLoaderTestCase(unittest.TestCase):
+    def write_dump(self, path, records):
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            for record in records:
+                f.write("\t".join([record["type"]["key"], record["key"], "1", "2023-01-01", json.dumps(record)]) + "\n")
+
+    def test_load_dumps_and_resume(self):
+        def edition(i, **fields):
+            return dict(
+                {
+                    "type": {"key": "/type/edition"},
+                    "key": "/books/DUMP{}M".format(i),
+                    "title": "Dump\tBook {}".format(i),
+                    "authors": [{"key": "/authors/DUMP1A"}],
+                    "works": [{"key": "/works/DUMP{}W".format(i)}],
+                    "languages": [{"key": "/languages/eng"}],
+                },
+                **fields
+            )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = {name: os.path.join(tmpdir, name + ".txt.gz") for name in ["editions", "authors", "works"]}
+            self.write_dump(
+                paths["editions"],
+                [
+                    edition(1, number_of_pages=100),
+                    edition(2),
+                    edition(3, languages=[{"key": "/languages/fre"}]),
+                    {key: value for key, value in edition(4).items() if key != "works"},
+                    {"type": {"key": "/type/redirect"}, "key": "/books/DUMP5M"},
+                ],
+            )
+            self.write_dump(
+                paths["authors"],
+                [
+                    {"type": {"key": "/type/author"}, "key": "/authors/DUMP1A", "name": "Dump Author"},
+                    {"type": {"key": "/type/author"}, "key": "/authors/DUMP9A", "name": "Unreferenced"},
+                ],
+            )
+
+            engine = create_engine("sqlite:///" + os.path.join(tmpdir, "dump.db"))
+            db.metadata.create_all(engine)
+
+            # The works dump is missing, so the load stops after staging the editions and authors
+            with self.assertRaises(FileNotFoundError):
+                load_dumps(engine, paths["editions"], paths["authors"], paths["works"], languages=["eng"], batch_size=1, progress=False)
+
+            # The resumed load doesn't read the staged dumps again
+            os.remove(paths["editions"])
+            self.write_dump(
+                paths["works"],
+                [{"type": {"key": "/type/work"}, "key": "/works/DUMP{}W".format(i), "title": "Dump Work"} for i in range(1, 4)],
+            )
+            stats = load_dumps(engine, paths["editions"], paths["authors"], paths["works"], progress=False)
+            self.assertTrue(stats["editions"]["resumed"])
+            self.assertEqual(stats["works"]["rows"], 2)
+
+            with engine.connect() as conn:
+                self.assertEqual(
+                    conn.execute(text("SELECT id, title, number_of_pages FROM books ORDER BY id")).all(),
+                    [("DUMP1M", "Dump\tBook 1", 100), ("DUMP2M", "Dump\tBook 2", None)],
+                )
+                self.assertEqual(conn.execute(text("SELECT id FROM authors")).all(), [("DUMP1A",)])
+                self.assertEqual(conn.execute(text("SELECT count(*) FROM book_work_association")).scalar(), 2)
+                self.assertEqual(
+                    json.loads(conn.execute(text("SELECT document FROM book_documents WHERE book_id = 'DUMP1M'")).scalar()),
+                    {
+                        "id": "DUMP1M",
+                        "title": "Dump\tBook 1",
+                        "number_of_pages": 100,
+                        "authors": [{"id": "DUMP1A", "name": "Dump Author"}],
+                        "works": [{"id": "DUMP1W", "title": "Dump Work"}],
+                    },
+                )
+                self.assertNotIn("dump_books", inspect(conn).get_table_names())
+                self.assertNotIn("dump_load_checkpoints", inspect(conn).get_table_names())
+
+            # A later load of new dumps starts from scratch, and the authors of the existing books it skips aren't stored
+            self.write_dump(
+                paths["editions"],
+                [edition(1, authors=[{"key": "/authors/DUMP2A"}]), edition(6, authors=[{"key": "/authors/DUMP3A"}])],
+            )
+            self.write_dump(
+                paths["authors"],
+                [
+                    {"type": {"key": "/type/author"}, "key": "/authors/DUMP{}A".format(i), "name": "Dump Author"}
+                    for i in [2, 3]
+                ],
+            )
+            self.write_dump(
+                paths["works"], [{"type": {"key": "/type/work"}, "key": "/works/DUMP6W", "title": "Dump Work"}]
+            )
+            # An existing book is skipped even without a document
+            with engine.begin() as conn:
+                conn.execute(text("DELETE FROM book_documents WHERE book_id = 'DUMP1M'"))
+                conn.execute(text("INSERT INTO catalog_version (id, version, compacted_seq) VALUES (1, 0, 0)"))
+            stats = load_dumps(engine, paths["editions"], paths["authors"], paths["works"], progress=False)
+            self.assertFalse(stats["editions"]["resumed"])
+            self.assertEqual(stats["inserted"]["books"], 1)
+            with engine.connect() as conn:
+                self.assertEqual(
+                    conn.execute(text("SELECT id FROM authors ORDER BY id")).all(), [("DUMP1A",), ("DUMP3A",)]
+                )
+                self.assertEqual(conn.execute(text("SELECT count(*) FROM works")).scalar(), 3)
+                self.assertEqual(
+                    conn.execute(text("SELECT book_id FROM book_documents ORDER BY book_id")).all(),
+                    [("DUMP2M",), ("DUMP6M",)],
+                )
+                self.assertEqual(conn.execute(text("SELECT seq, op, book_id FROM book_changes")).all(), [(1, "insert", "DUMP6M")])
+            engine.dispose()
+
+
 if __name__ == "__main__":
     unittest.main()
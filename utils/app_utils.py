@@ -1,26 +1,160 @@
 """
 Utility functions for the application.
 
-- fetch_data(code): Fetches data from the specified code using an API request.
+- fetch_data(code): Fetches data from the specified code using the shared OpenLibrary client and the local
+  author/work document cache, sharing the fetches in progress between the concurrent imports.
+- fetch_openlib_books(codes, max_workers, lookup_known): Concurrently fetches books and their authors and works from OpenLibrary.
+- summarize_import(codes, books, messages): Splits the outcome of an import into the added and skipped books.
 - validate_create_book_req_data(request_data): Validates if the required fields are present in the request data.
+- book_validation_error(book): Returns the reason a book of a batch is invalid, or None.
+- stream_json_array(key, items): Yields a JSON object holding a single array, one item at a time.
+- BookJSONProvider: The JSON provider of the application, writing the pre-rendered documents of the read model
+  into the responses as they are.
 """
 
-import requests
+import contextvars
+import itertools
+from flask import json
+from flask.json.provider import DefaultJSONProvider
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from utils.instrumentation import timed_phase
+from utils.openlib_client import get_client
+from utils.openlib_cache import SingleFlight, get_cache, is_cacheable
+from utils.db_utils import RenderedBook
 
-URL_BASE = "https://openlibrary.org{}.json"
+# Book lookups in progress, shared by the concurrent imports of the process
+_book_flights = SingleFlight()
 
+@timed_phase("openlib")
 def fetch_data(code):
-    url = URL_BASE.format(code)
-    response = requests.get(url)
-    response.raise_for_status()  # Raise an exception for non-2xx status codes
+    if not is_cacheable(code):
+        # Use the shared pooled client, which handles timeouts, retries and rate limiting
+        return _book_flights.do(code, lambda: get_client().get_json(code))
 
-    return response.json()
+    # Serve author and work documents from the local cache when possible, fetching every
+    # missing one once for all the concurrent imports of the host
+    return get_cache().get_or_fetch(code, lambda: get_client().get_json(code))
+
+def fetch_openlib_books(codes, max_workers=8, lookup_known=None):
+    """Fetches books from OpenLibrary together with their authors and works.
+
+    Book lookups are fanned out over a thread pool. As soon as a book arrives,
+    its author and work keys are submitted to the same pool, so every distinct
+    key is requested at most once and the total wall time follows the slowest
+    chain of requests instead of their sum.
+
+    Args:
+        codes (list): The OpenLibrary book codes to fetch.
+        max_workers (int, optional): The maximum number of concurrent requests. Defaults to 8.
+        lookup_known (callable, optional): A function that takes a list of author/work keys and
+            returns a dictionary with the documents of the keys that can be resolved without
+            a request (e.g. from the database). It is called from the calling thread.
+
+    Returns:
+        dict: A dictionary mapping every code to either the book data with its
+            'authors' and 'works' replaced by the fetched documents, None if the
+            book is missing the 'authors' or 'works' fields, or the exception
+            raised while fetching it.
+    """
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # Fan out the book lookups, once per distinct code
+        # (every task runs in a copy of the caller's context, so its time is accounted to the request)
+        book_futures = {
+            executor.submit(contextvars.copy_context().run, fetch_data, "/books/" + code): code
+            for code in dict.fromkeys(codes)
+        }
+        books = {}
+        ref_futures = {}  # Shared author/work lookups keyed by OpenLibrary key
+
+        for future in as_completed(book_futures):
+            code = book_futures[future]
+            try:
+                book = future.result()
+                if "authors" in book and "works" in book:
+                    new_keys = [
+                        key
+                        for key in dict.fromkeys(
+                            ref["key"] for ref in book["authors"] + book["works"]
+                        )
+                        if key not in ref_futures
+                    ]
+                    known = lookup_known(new_keys) if lookup_known and new_keys else {}
+                    get_cache().record_db_hits(len(known))
+
+                    for key in new_keys:
+                        if key in known:
+                            # Resolve the known keys without a request
+                            ref_futures[key] = Future()
+                            ref_futures[key].set_result(known[key])
+                        else:
+                            # Submit the author and work keys that are not already in flight
+                            ref_futures[key] = executor.submit(
+                                contextvars.copy_context().run, fetch_data, key
+                            )
+                    books[code] = book
+                else:
+                    results[code] = None
+            except Exception as e:
+                results[code] = e
+
+        for code, book in books.items():
+            try:
+                # Replace the author and work references with the fetched data
+                results[code] = dict(
+                    book,
+                    authors=[
+                        ref_futures[author["key"]].result()
+                        for author in book["authors"]
+                    ],
+                    works=[ref_futures[work["key"]].result() for work in book["works"]],
+                )
+            except Exception as e:
+                results[code] = e
+
+    return results
+
+def summarize_import(codes, books, messages):
+    """Splits the outcome of an import into the added and skipped books of the response.
+
+    Args:
+        codes (list): The imported OpenLibrary book codes.
+        books (dict): The result of fetch_openlib_books for the codes.
+        messages (iterable): The messages of store_books for the fetched books, in the order of the codes.
+
+    Returns:
+        tuple: The list of added codes and the list of {code: reason} of the skipped ones.
+    """
+    skipped_books = []  # List to store skipped books
+    added_books = []  # List to store successfully added books
+    messages = iter(messages)
+
+    for code in codes:
+        book = books[code]
+
+        if isinstance(book, Exception):
+            skipped_books.append({code: "Skipped because of: {}".format(book)})
+        elif book is None:
+            skipped_books.append({code: "Skipped because of: Missing fields"})
+        else:
+            msg = next(messages)
+
+            if "error" in msg:
+                skipped_books.append(
+                    {code: "Skipped because of: {}".format(msg["error"])}
+                )
+            else:
+                added_books.append(code)
+
+    return added_books, skipped_books
 
 def validate_create_book_req_data(request_data):
     
     # Check if all the required fields are present in the request data
     if (
-        "id" in request_data
+        isinstance(request_data, dict)
+        and "id" in request_data
         and "title" in request_data
         and "authors" in request_data
         and "works" in request_data
@@ -33,4 +167,58 @@ def validate_create_book_req_data(request_data):
                 return False
         return True
     else:
-        return False
\ No newline at end of file
+        return False
+
+
+def book_validation_error(book):
+    # The reason a book of a batch can't be stored, or None. Unlike validate_create_book_req_data,
+    # this also checks the types of the fields, so a malformed item doesn't fail the whole batch.
+    if not isinstance(book, dict):
+        return "Invalid book"
+    if not isinstance(book.get("authors", []), list) or not isinstance(book.get("works", []), list):
+        return "Invalid authors or works"
+    if not all(isinstance(ref, dict) for ref in book.get("authors", []) + book.get("works", [])):
+        return "Invalid authors or works"
+    if not validate_create_book_req_data(book):
+        return "Missing required fields"
+    if not isinstance(book["id"], str) or not isinstance(book["title"], str):
+        return "Invalid id or title"
+    pages = book.get("number_of_pages")
+    if pages is not None and (not isinstance(pages, int) or isinstance(pages, bool)):
+        return "Invalid number of pages"
+    return None
+
+
+def stream_json_array(key, items):
+    # Yield a {key: [...]} document in chunks, so the full array is never built in memory
+    yield '{{{}:['.format(json.dumps(key))
+    for i, item in enumerate(items):
+        yield ("," if i else "") + json.dumps(item, separators=(",", ":"))
+    yield "]}\n"
+
+
+# Stands for a pre-rendered document in the encoded JSON, until it is replaced by the document
+_RENDERED_MARKER = "\x00rendered-book\x00"
+_RENDERED_TOKEN = json.dumps(_RENDERED_MARKER)
+
+
+class BookJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        # A single book (e.g. a line of the NDJSON stream) is its document
+        if isinstance(obj, RenderedBook):
+            return obj.document
+
+        documents = []
+
+        def default(o):
+            if isinstance(o, RenderedBook):
+                documents.append(o.document)
+                return _RENDERED_MARKER
+            return self.default(o)
+
+        # The encoder visits the values in output order, so the markers are replaced in the same order
+        encoded = super().dumps(obj, default=default, **kwargs)
+        if not documents:
+            return encoded
+        parts = encoded.split(_RENDERED_TOKEN)
+        return "".join(itertools.chain.from_iterable(zip(parts, documents + [""])))
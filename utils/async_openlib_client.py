@@ -0,0 +1,279 @@
+"""
+Asynchronous OpenLibrary client of the async serving mode (asgi.py).
+
+The asyncio counterpart of utils/openlib_client.py and of fetch_openlib_books: the same timeouts, retries with
+exponential backoff, rate limiting, author/work document cache and sharing of the fetches in progress, on top
+of a pooled httpx.AsyncClient (requires the optional 'httpx' package). A request waiting on OpenLibrary holds a
+coroutine instead of a thread, so a single process can keep thousands of them in flight.
+
+- AsyncTokenBucket: An asyncio token-bucket rate limiter.
+- AsyncOpenLibraryClient: A client with the same settings, behaviour and counters as OpenLibraryClient.
+- create_async_client(settings): Returns a new client configured from the config of an application, counting its
+  requests in the counters of the shared sync client, which /openlib/stats and /metrics report.
+- fetch_openlib_books_async(client, codes, max_concurrency, lookup_known): Concurrently fetches books and their
+  authors and works from OpenLibrary, with the same result as fetch_openlib_books.
+"""
+
+import asyncio
+import time
+from utils.openlib_cache import get_cache, is_cacheable
+from utils.openlib_client import RequestStats, get_client
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - optional dependency
+    httpx = None
+
+
+class AsyncTokenBucket:
+    def __init__(self, rate, capacity=1):
+        # Tokens added per second and the maximum burst size
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # A non-positive rate disables rate limiting
+        if self.rate <= 0:
+            return
+
+        # The waiters are served one at a time, in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                # Refill the bucket with the tokens earned since the last update
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncOpenLibraryClient:
+    # Status codes that are worth retrying
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        url_base="https://openlibrary.org",
+        max_connections=100,
+        connect_timeout=3.05,
+        read_timeout=10,
+        max_retries=3,
+        backoff_factor=0.5,
+        backoff_max=30,
+        rate_limit=0,
+        rate_burst=1,
+        counters=None,
+    ):
+        if httpx is None:
+            raise RuntimeError("The async serving mode requires the 'httpx' package.")
+
+        self.url_base = url_base
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.rate_limiter = AsyncTokenBucket(rate_limit, rate_burst)
+        self.flights = {}  # OpenLibrary key -> task of the fetch in progress
+        # Counters for monitoring, thread-safe as they are read by the Flask routes from their threads
+        self.counters = counters if counters is not None else RequestStats()
+
+        # Keep-alive pool shared by every request of the process; the requests over the limit wait
+        # for a free connection without a timeout, like the blocking pools of the sync client
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=None),
+            limits=httpx.Limits(
+                max_connections=max_connections, max_keepalive_connections=max_connections
+            ),
+        )
+
+    def _backoff(self, attempt, response):
+        # Honour the Retry-After header of rate limited or unavailable responses
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(self.backoff_max, int(retry_after))
+
+        return min(self.backoff_max, self.backoff_factor * (2**attempt))
+
+    async def get_json(self, path):
+        """Fetches an OpenLibrary document.
+
+        Args:
+            path (str): The path of the document without the '.json' suffix (e.g. '/books/OL1M').
+
+        Returns:
+            dict: The decoded JSON document.
+
+        Raises:
+            httpx.HTTPStatusError: If the final response has a non-2xx status code.
+            httpx.TransportError: If the request could not be completed after all retries.
+        """
+        url = "{}{}.json".format(self.url_base, path)
+
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            response = None
+            start = time.perf_counter()
+            try:
+                response = await self.client.get(url)
+            except httpx.TransportError as e:
+                error = e
+            finally:
+                self.counters.record_latency(time.perf_counter() - start)
+
+            if response is not None and response.status_code not in self.RETRY_STATUSES:
+                break
+
+            if attempt == self.max_retries:
+                if response is None:
+                    self.counters.record("failures")
+                    raise error
+                break
+
+            self.counters.record("retries")
+            await asyncio.sleep(self._backoff(attempt, response))
+
+        if response.is_error:
+            # Raise an exception for non-2xx status codes, with the message of requests' raise_for_status
+            # so that the skipped books of the response read the same as with the sync client
+            self.counters.record("failures")
+            raise httpx.HTTPStatusError(
+                "{} {} Error: {} for url: {}".format(
+                    response.status_code,
+                    "Client" if response.status_code < 500 else "Server",
+                    response.reason_phrase,
+                    url,
+                ),
+                request=response.request,
+                response=response,
+            )
+
+        return response.json()
+
+    def stats(self):
+        """Returns the request, retry and latency counters of the client."""
+        return self.counters.stats()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def create_async_client(settings):
+    # One client per event loop, created by the lifespan of the ASGI application
+    return AsyncOpenLibraryClient(
+        url_base=settings["OPENLIB_URL_BASE"],
+        max_connections=settings["OPENLIB_ASYNC_MAX_CONNECTIONS"],
+        connect_timeout=settings["OPENLIB_CONNECT_TIMEOUT"],
+        read_timeout=settings["OPENLIB_READ_TIMEOUT"],
+        max_retries=settings["OPENLIB_MAX_RETRIES"],
+        backoff_factor=settings["OPENLIB_BACKOFF_FACTOR"],
+        rate_limit=settings["OPENLIB_RATE_LIMIT"],
+        rate_burst=settings["OPENLIB_RATE_BURST"],
+        # The requests of both serving modes of the process are reported together
+        counters=get_client().counters,
+    )
+
+
+async def _fetch_once(client, code):
+    if not is_cacheable(code):
+        return await client.get_json(code)
+
+    # Serve author and work documents from the local cache when possible (a SQLite file, so it is
+    # used from a thread), waiting for the worker process fetching the key, as in get_or_fetch
+    cache = get_cache()
+    document = await asyncio.to_thread(cache.get, code)
+    if document is not None:
+        return document
+
+    while not await asyncio.to_thread(cache.claim_fetch, code):
+        await asyncio.sleep(cache.poll_interval)
+        document = await asyncio.to_thread(cache.peek, code)
+        if document is not None:
+            return document
+
+    try:
+        document = await asyncio.to_thread(cache.peek, code)
+        if document is None:
+            document = await client.get_json(code)
+            await asyncio.to_thread(cache.set, code, document)
+        return document
+    finally:
+        await asyncio.to_thread(cache.release_fetch, code)
+
+
+async def _fetch_data(client, code):
+    # The concurrent lookups of a key by the requests of the process share a single fetch
+    flight = client.flights.get(code)
+    if flight is None:
+        flight = client.flights[code] = asyncio.ensure_future(_fetch_once(client, code))
+        flight.add_done_callback(lambda _: client.flights.pop(code, None))
+    # A cancelled request doesn't cancel the fetch the other requests wait for
+    return await asyncio.shield(flight)
+
+
+async def fetch_openlib_books_async(client, codes, max_concurrency=8, lookup_known=None):
+    """Fetches books from OpenLibrary together with their authors and works.
+
+    Every book is fetched by its own task. As soon as a book arrives, the tasks of its author and
+    work keys are started, so every distinct key is requested at most once and the total wall time
+    follows the slowest chain of requests instead of their sum.
+
+    Args:
+        client (AsyncOpenLibraryClient): The client.
+        codes (list): The OpenLibrary book codes to fetch.
+        max_concurrency (int, optional): The maximum number of concurrent requests. Defaults to 8.
+        lookup_known (coroutine function, optional): A function that takes a list of author/work keys
+            and returns a dictionary with the documents of the keys that can be resolved without
+            a request (e.g. from the database).
+
+    Returns:
+        dict: A dictionary mapping every code to either the book data with its 'authors' and 'works'
+            replaced by the fetched documents, None if the book is missing the 'authors' or 'works'
+            fields, or the exception raised while fetching it.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    ref_tasks = {}  # Shared author/work lookups keyed by OpenLibrary key
+
+    async def fetch(key):
+        async with semaphore:
+            return await _fetch_data(client, key)
+
+    async def fetch_book(code):
+        book = await fetch("/books/" + code)
+        if "authors" not in book or "works" not in book:
+            return None
+
+        keys = dict.fromkeys(ref["key"] for ref in book["authors"] + book["works"])
+        new_keys = [key for key in keys if key not in ref_tasks]
+        known = await lookup_known(new_keys) if lookup_known and new_keys else {}
+        get_cache().record_db_hits(len(known))
+
+        for key in new_keys:
+            # Another book may have started the lookup during the await
+            if key in ref_tasks:
+                continue
+            if key in known:
+                # Resolve the known keys without a request
+                ref_tasks[key] = asyncio.get_running_loop().create_future()
+                ref_tasks[key].set_result(known[key])
+            else:
+                ref_tasks[key] = asyncio.ensure_future(fetch(key))
+
+        # Replace the author and work references with the fetched data
+        return dict(
+            book,
+            authors=[await ref_tasks[author["key"]] for author in book["authors"]],
+            works=[await ref_tasks[work["key"]] for work in book["works"]],
+        )
+
+    codes = list(dict.fromkeys(codes))
+    outcomes = await asyncio.gather(*(fetch_book(code) for code in codes), return_exceptions=True)
+    # Wait for the lookups left behind by the books that failed, so none of their errors goes unretrieved
+    await asyncio.gather(*ref_tasks.values(), return_exceptions=True)
+    return dict(zip(codes, outcomes))
@@ -0,0 +1,553 @@
+"""
+In-process columnar snapshot of the catalog, serving /books/search without the database.
+
+The books are stored column by column: their ids and titles in lists, their numbers of pages in an int64
+array and their liveness in a byte mask. The author names and work titles are interned, stored once however
+many books link them, and the links are CSR adjacency arrays: the authors of the book at position i are
+author_indices[author_offsets[i]:author_offsets[i + 1]], and reverse arrays give the books of every author.
+Substring matches scan a single precomputed lowercase string of all the names. With NumPy installed
+(optional), the page range filters are vectorized comparisons over the arrays.
+
+Names are matched case-insensitively with str.lower(), like the text search of the database (see
+utils/search_utils.py, which folds the non-ASCII letters on SQLite too).
+
+The snapshot records the catalog version it reflects (see utils/response_cache.py). Before serving a search, it
+catches up with the writes committed since that version, by every process, from the change log of the catalog
+(book_changes): inserted books are loaded from the database and appended to the columns, linked through small
+overflow lists, and removed books are masked out. So a response built from the snapshot is always as recent as the
+catalog version of its ETag. When the changes to catch up with were already compacted, the searches fall back to
+the database until the snapshot is rebuilt.
+
+- CatalogSnapshot: The snapshot, built from the database with CatalogSnapshot.build(session).
+- start_catalog_snapshot(app): Builds the snapshot of the process in a background thread.
+- get_catalog_snapshot(): Returns the snapshot of the process once built and caught up with the catalog version,
+  or None.
+"""
+
+import bisect
+import sys
+import threading
+import time
+from array import array
+from itertools import chain
+from flask import current_app
+from sqlalchemy import select
+from db import db
+from models.Book import Book
+from models.Author import Author
+from models.Work import Work
+from models.BookChange import BookChange
+from models.CatalogVersion import CatalogVersion
+from models.associations.book_author_association import book_author_assoc_table
+from models.associations.book_work_association import book_work_assoc_table
+from utils.db_utils import IN_QUERY_CHUNK_SIZE, iterate_book_documents, read_catalog_version
+from utils.response_cache import catalog_version
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - optional dependency
+    numpy = None
+
+# Number of pages of the books without one
+NO_PAGES = -(2**63)
+
+# Separator of the names in the lowercase index, which never occurs in a search term
+NAME_SEPARATOR = "\0"
+
+
+class _NameIndex:
+    """Interned ids and names of the authors or works, with a lowercase substring index of the names."""
+
+    def __init__(self):
+        self.ids = []
+        self.names = []
+        self.positions = {}  # id -> index
+        self.text = ""  # Lowercase names of the first len(starts) entries, separated by NAME_SEPARATOR
+        self.starts = array("Q")  # Offset of every indexed name in text
+        self.unindexed = []  # Lowercase names added since the index was built
+
+    def add(self, name_id, name):
+        index = self.positions.get(name_id)
+        if index is None:
+            index = len(self.ids)
+            self.ids.append(name_id)
+            self.names.append(name)
+            self.positions[name_id] = index
+            self.unindexed.append((name or "").lower())
+            # Rebuild the index once the linearly scanned names are no longer few
+            if len(self.unindexed) > max(1024, len(self.starts) // 4):
+                self.reindex()
+        return index
+
+    def reindex(self):
+        lowered = [(name or "").lower() for name in self.names]
+        starts = array("Q")
+        offset = 0
+        for name in lowered:
+            starts.append(offset)
+            offset += len(name) + 1
+        self.text = NAME_SEPARATOR.join(lowered)
+        self.starts = starts
+        self.unindexed = []
+
+    def match(self, term):
+        """Returns the indexes of the names containing the term, ignoring case."""
+        term = term.lower()
+        if not term or NAME_SEPARATOR in term:
+            return []
+
+        found = []
+        start = self.text.find(term)
+        while start != -1:
+            index = bisect.bisect_right(self.starts, start) - 1
+            found.append(index)
+            # Continue with the next name
+            if index + 1 == len(self.starts):
+                break
+            start = self.text.find(term, self.starts[index + 1])
+
+        indexed = len(self.starts)
+        found.extend(indexed + i for i, name in enumerate(self.unindexed) if term in name)
+        return found
+
+    def nbytes(self):
+        return (
+            sum(sys.getsizeof(value) for value in chain(self.ids, self.names))
+            + sys.getsizeof(self.ids)
+            + sys.getsizeof(self.names)
+            + sys.getsizeof(self.positions)
+            + sys.getsizeof(self.text)
+            + sys.getsizeof(self.starts)
+        )
+
+
+def _csr(pairs, rows):
+    # Offsets and indices of (row, column) pairs sorted by row
+    offsets = array("Q", bytes(8 * (rows + 1)))
+    for row, _ in pairs:
+        offsets[row + 1] += 1
+    for row in range(rows):
+        offsets[row + 1] += offsets[row]
+    return offsets, array("Q", (column for _, column in pairs))
+
+
+class _Links:
+    """Links between the books and their authors or works, in both directions."""
+
+    def __init__(self, pairs, books, names):
+        # pairs: (book position, name index), sorted by book and name index
+        self.offsets, self.indices = _csr(pairs, books)
+        self.reverse_offsets, self.reverse_indices = _csr(
+            sorted((index, position) for position, index in pairs), names
+        )
+        # Links of the books and names added after the build
+        self.extra = {}
+        self.extra_reverse = {}
+
+    def of_book(self, position):
+        if position + 1 < len(self.offsets):
+            return self.indices[self.offsets[position] : self.offsets[position + 1]]
+        return self.extra.get(position, ())
+
+    def books_of(self, index):
+        books = ()
+        if index + 1 < len(self.reverse_offsets):
+            books = self.reverse_indices[
+                self.reverse_offsets[index] : self.reverse_offsets[index + 1]
+            ]
+        return chain(books, self.extra_reverse.get(index, ()))
+
+    def append(self, position, indices):
+        self.extra[position] = indices
+        for index in indices:
+            self.extra_reverse.setdefault(index, []).append(position)
+
+    def nbytes(self):
+        return (
+            sys.getsizeof(self.offsets)
+            + sys.getsizeof(self.indices)
+            + sys.getsizeof(self.reverse_offsets)
+            + sys.getsizeof(self.reverse_indices)
+            + sum(sys.getsizeof(value) for value in chain(self.extra.values(), self.extra_reverse.values()))
+        )
+
+
+class CatalogSnapshot:
+    def __init__(self, ids, titles, pages, authors, works, author_pairs, work_pairs, version=0):
+        # Updated by the catch-up of a request thread while others search
+        self.lock = threading.Lock()
+        self.built_at = time.monotonic()
+        # Catalog version whose writes the snapshot reflects, and whether it can no longer catch up
+        self.version = version
+        self.stale = False
+        self.ids = ids
+        self.titles = titles
+        self.pages = pages
+        self.alive = bytearray(b"\x01" * len(ids))
+        self.positions = {book_id: position for position, book_id in enumerate(ids)}
+        self.authors = authors
+        self.works = works
+        self.author_links = _Links(author_pairs, len(ids), len(authors.ids))
+        self.work_links = _Links(work_pairs, len(ids), len(works.ids))
+        # The positions of the books built, sorted by number of pages, for the page ranges without NumPy
+        self.pages_order = array("Q", sorted(range(len(ids)), key=pages.__getitem__))
+        self.sorted_pages = array("q", (pages[position] for position in self.pages_order))
+        # Whether the positions are in id order, so sorting them sorts the books by id
+        self.id_ordered = all(ids[i] < ids[i + 1] for i in range(len(ids) - 1))
+
+    @classmethod
+    def build(cls, session):
+        """Builds the snapshot of the books, authors and works of the database.
+
+        Args:
+            session (Session): The database session.
+
+        Returns:
+            CatalogSnapshot: The snapshot.
+        """
+        # Read first: the writes committed while the tables are read are applied again by the catch-up
+        version = read_catalog_version(session)
+
+        names = {}
+        for key, model, column in [("authors", Author, Author.name), ("works", Work, Work.title)]:
+            # Interned in id order, so sorting the indexes of a book sorts its authors/works by id
+            index = _NameIndex()
+            for name_id, name in session.execute(select(model.id, column).order_by(model.id)):
+                index.add(name_id, name)
+            index.reindex()
+            names[key] = index
+
+        ids, titles, pages = [], [], array("q")
+        for book_id, title, number_of_pages in session.execute(
+            select(Book.id, Book.title, Book.number_of_pages).order_by(Book.id)
+        ):
+            ids.append(book_id)
+            titles.append(title)
+            pages.append(NO_PAGES if number_of_pages is None else number_of_pages)
+        positions = {book_id: position for position, book_id in enumerate(ids)}
+
+        pairs = {}
+        for key, assoc_column in [
+            ("authors", book_author_assoc_table.c.author_id),
+            ("works", book_work_assoc_table.c.work_id),
+        ]:
+            pairs[key] = sorted(
+                (positions[book_id], names[key].positions[name_id])
+                for book_id, name_id in session.execute(
+                    select(assoc_column.table.c.book_id, assoc_column)
+                )
+                # Skip the links written after the books or names were read
+                if book_id in positions and name_id in names[key].positions
+            )
+
+        return cls(
+            ids, titles, pages, names["authors"], names["works"], pairs["authors"], pairs["works"], version
+        )
+
+    def apply_changes(self, inserted, removed, version):
+        """Applies committed writes and moves the snapshot to their catalog version.
+
+        Args:
+            inserted (list): The current state of the inserted books, as returned by the read path. They replace
+                the books of the snapshot with the same ids, which may have been read half-written by the build.
+            removed (iterable): The IDs of the removed books.
+            version (int): The catalog version of the writes.
+        """
+        with self.lock:
+            for book_id in chain((book["id"] for book in inserted), removed):
+                position = self.positions.pop(book_id, None)
+                if position is not None:
+                    self.alive[position] = 0
+
+            for book in inserted:
+                position = len(self.ids)
+                self.id_ordered = self.id_ordered and (not self.ids or self.ids[-1] < book["id"])
+                self.ids.append(book["id"])
+                self.titles.append(book["title"])
+                self.pages.append(book.get("number_of_pages", NO_PAGES))
+                self.alive.append(1)
+                self.positions[book["id"]] = position
+                self.author_links.append(
+                    position, [self.authors.add(a["id"], a["name"]) for a in book["authors"]]
+                )
+                self.work_links.append(
+                    position, [self.works.add(w["id"], w["title"]) for w in book["works"]]
+                )
+
+            self.version = max(self.version, version)
+
+    def catch_up(self, session):
+        """Applies the writes committed since the version of the snapshot, from the change log.
+
+        Args:
+            session (Session): The database session.
+
+        Returns:
+            bool: False if some of the changes were already compacted, so the snapshot must be rebuilt.
+        """
+        row = session.execute(
+            select(CatalogVersion.__table__.c.version, CatalogVersion.__table__.c.compacted_seq).where(
+                CatalogVersion.__table__.c.id == 1
+            )
+        ).first()
+        if row is None:
+            return True
+        version, compacted = row
+        if compacted and compacted > self.version:
+            return False
+
+        # The changes up to the version read, committed with it. The last change of every book wins
+        table = BookChange.__table__
+        ops = {}
+        for book_id, op in session.execute(
+            select(table.c.book_id, table.c.op)
+            .where(table.c.seq > self.version, table.c.seq <= version)
+            .order_by(table.c.seq)
+        ):
+            ops[book_id] = op
+
+        inserted_ids = [book_id for book_id, op in ops.items() if op == "insert"]
+        inserted = [
+            book
+            for i in range(0, len(inserted_ids), IN_QUERY_CHUNK_SIZE)
+            for book in iterate_book_documents(
+                session,
+                select(Book.id, Book.title, Book.number_of_pages).where(
+                    Book.id.in_(inserted_ids[i : i + IN_QUERY_CHUNK_SIZE])
+                ),
+            )
+        ]
+        # An inserted book deleted since is missing from the database, and removed
+        found = {book["id"] for book in inserted}
+        removed = [book_id for book_id, op in ops.items() if op == "delete" or book_id not in found]
+        self.apply_changes(inserted, removed, version)
+        return True
+
+    def _filter(
+        self,
+        author_name=None,
+        work_title=None,
+        min_pages=None,
+        max_pages=None,
+        book_ids=None,
+        author_ids=None,
+        work_ids=None,
+    ):
+        # Positions of the books matching the criteria, to be called with the lock held
+        candidates = None  # Every book
+
+        def narrow(positions):
+            nonlocal candidates
+            positions = set(positions)
+            candidates = positions if candidates is None else candidates & positions
+
+        if book_ids:
+            narrow(self.positions[book_id] for book_id in book_ids if book_id in self.positions)
+        for term, names, links in [
+            (author_name, self.authors, self.author_links),
+            (work_title, self.works, self.work_links),
+        ]:
+            if term:
+                narrow(position for index in names.match(term) for position in links.books_of(index))
+        for ids, names, links in [
+            (author_ids, self.authors, self.author_links),
+            (work_ids, self.works, self.work_links),
+        ]:
+            if ids:
+                narrow(
+                    position
+                    for name_id in ids
+                    if name_id in names.positions
+                    for position in links.books_of(names.positions[name_id])
+                )
+
+        if numpy is not None and self.ids:
+            # Vectorized over zero-copy views of the columns
+            pages = numpy.frombuffer(self.pages, dtype=numpy.int64)
+            alive = numpy.frombuffer(self.alive, dtype=numpy.bool_)
+            if candidates is None:
+                selected = numpy.arange(len(self.ids))
+            else:
+                selected = numpy.fromiter(candidates, dtype=numpy.int64, count=len(candidates))
+            mask = alive[selected]
+            if min_pages is not None:
+                mask &= pages[selected] >= int(min_pages)
+            if max_pages is not None:
+                mask &= (pages[selected] != NO_PAGES) & (pages[selected] <= int(max_pages))
+            return selected[mask].tolist()
+
+        alive, pages = self.alive, self.pages
+        if candidates is None and (min_pages is not None or max_pages is not None):
+            # Range of the pages index, plus the books added since the build
+            start = bisect.bisect_left(
+                self.sorted_pages, NO_PAGES + 1 if min_pages is None else int(min_pages)
+            )
+            end = len(self.sorted_pages)
+            if max_pages is not None:
+                end = bisect.bisect_right(self.sorted_pages, int(max_pages))
+            candidates = chain(self.pages_order[start:end], range(len(self.pages_order), len(self.ids)))
+
+        return [
+            position
+            for position in (range(len(self.ids)) if candidates is None else candidates)
+            if alive[position]
+            and (min_pages is None or pages[position] >= int(min_pages))
+            and (max_pages is None or NO_PAGES != pages[position] <= int(max_pages))
+        ]
+
+    def _document(self, position):
+        # The same dictionary as the read path, with the authors and works in id order
+        authors, works = self.authors, self.works
+        book = {
+            "id": self.ids[position],
+            "title": self.titles[position],
+            "authors": [
+                {"id": authors.ids[i], "name": authors.names[i]}
+                for i in self.author_links.of_book(position)
+            ],
+            "works": [
+                {"id": works.ids[i], "title": works.names[i]}
+                for i in self.work_links.of_book(position)
+            ],
+        }
+        if self.pages[position] != NO_PAGES:
+            book["number_of_pages"] = self.pages[position]
+        return book
+
+    def search(self, author_name=None, work_title=None, min_pages=None, max_pages=None, book_ids=None,
+               author_ids=None, work_ids=None, sort="id", limit=None, offset=0):
+        """Searches the books like retrieve_books_by_criteria, except for the relevance sort.
+
+        Returns:
+            list: The matching books, in the requested order.
+        """
+        with self.lock:
+            positions = self._filter(
+                author_name, work_title, min_pages, max_pages, book_ids, author_ids, work_ids
+            )
+
+            # Sort by id first, the sorts are stable so books that tie stay in id order
+            positions.sort(key=None if self.id_ordered else self.ids.__getitem__)
+            if sort in ("title", "-title"):
+                positions.sort(key=self.titles.__getitem__, reverse=sort == "-title")
+            elif sort in ("pages", "-pages"):
+                pages = self.pages
+                sign = -1 if sort == "-pages" else 1
+                positions.sort(key=lambda p: (pages[p] == NO_PAGES, sign * pages[p]))
+
+            end = None if limit is None else offset + limit
+            return [self._document(position) for position in positions[offset:end]]
+
+    def count(self, author_name=None, work_title=None, min_pages=None, max_pages=None, book_ids=None,
+              author_ids=None, work_ids=None):
+        with self.lock:
+            return len(
+                self._filter(author_name, work_title, min_pages, max_pages, book_ids, author_ids, work_ids)
+            )
+
+    def stats(self):
+        with self.lock:
+            books = len(self.positions)
+            nbytes = (
+                sum(sys.getsizeof(value) for value in chain(self.ids, self.titles))
+                + sys.getsizeof(self.ids)
+                + sys.getsizeof(self.titles)
+                + sys.getsizeof(self.pages)
+                + sys.getsizeof(self.alive)
+                + sys.getsizeof(self.positions)
+                + sys.getsizeof(self.pages_order)
+                + sys.getsizeof(self.sorted_pages)
+                + self.authors.nbytes()
+                + self.works.nbytes()
+                + self.author_links.nbytes()
+                + self.work_links.nbytes()
+            )
+            return {
+                "books": books,
+                "removed_books": len(self.ids) - books,
+                "authors": len(self.authors.ids),
+                "works": len(self.works.ids),
+                "bytes": nbytes,
+                "bytes_per_book": nbytes / books if books else 0.0,
+                "age_seconds": time.monotonic() - self.built_at,
+                "vectorized": numpy is not None,
+            }
+
+
+_snapshot = None
+_snapshot_app = None
+_snapshot_lock = threading.Lock()
+_building = False
+# Serializes the catch-ups of the request threads
+_catch_up_lock = threading.Lock()
+
+
+def _build(app):
+    global _snapshot, _building
+
+    with app.app_context():
+        try:
+            snapshot = CatalogSnapshot.build(db.session)
+        except Exception:
+            app.logger.exception("Building the catalog snapshot failed")
+            snapshot = None
+        finally:
+            db.session.remove()
+
+    with _snapshot_lock:
+        _building = False
+        if snapshot is not None:
+            _snapshot = snapshot
+
+
+def _start_build(app):
+    # To be called with the lock held
+    global _building
+
+    if _building:
+        return
+    _building = True
+    threading.Thread(target=_build, args=(app,), name="catalog-snapshot", daemon=True).start()
+
+
+def start_catalog_snapshot(app):
+    global _snapshot_app
+
+    if _snapshot_app is not None or not app.config["CATALOG_SNAPSHOT_ENABLED"]:
+        return
+    with _snapshot_lock:
+        if _snapshot_app is None:
+            _snapshot_app = app
+            _start_build(app)
+
+
+def get_catalog_snapshot():
+    snapshot = _snapshot
+    if snapshot is None:
+        return None
+
+    app = current_app._get_current_object()
+    # Rebuild an old snapshot in the background, serving this one meanwhile, to drop the removed books
+    max_age = app.config["CATALOG_SNAPSHOT_MAX_AGE"]
+    if max_age and time.monotonic() - snapshot.built_at > max_age and not _building:
+        with _snapshot_lock:
+            _start_build(app)
+
+    # Catch up with the writes of every process up to the catalog version the response is tagged with
+    version = catalog_version()
+    if snapshot.version < version and not snapshot.stale:
+        with _catch_up_lock:
+            if snapshot.version < version and not snapshot.stale:
+                try:
+                    snapshot.stale = not snapshot.catch_up(db.session)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Catching up the catalog snapshot failed")
+                    snapshot.stale = True
+
+    if snapshot.stale:
+        # Served by the database until the snapshot is rebuilt
+        with _snapshot_lock:
+            _start_build(app)
+        return None
+    return snapshot
@@ -0,0 +1,55 @@
+"""
+Background compaction of the change log of GET /books/changes.
+
+The writes append their changes to the book_changes table (see utils/db_utils.py), which grows without bound
+unless the changes older than the retention window are deleted. Every web process runs a daemon thread deleting
+them every CHANGE_LOG_COMPACT_INTERVAL seconds; the deletion is idempotent, so the processes don't need to agree
+on which of them compacts. The consumers that fall behind the retention window get a 410 and resync.
+
+- start_change_log_compaction(app): Starts the compaction thread of the process, when enabled.
+- stop_change_log_compaction(timeout): Stops the compaction thread of the process, after its pass in progress.
+"""
+
+import threading
+import db_operations
+from db import db
+
+_compaction_thread = None
+_compaction_lock = threading.Lock()
+# Set when the process exits (see the worker_exit hook of gunicorn.conf.py)
+_stopping = threading.Event()
+
+
+def _compact(app, interval):
+    while not _stopping.wait(interval):
+        with app.app_context():
+            try:
+                deleted = db_operations.compact_book_changes(app.config["CHANGE_LOG_RETENTION"])
+                if deleted:
+                    app.logger.info("Compacted %d changes of the change log", deleted)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Compacting the change log failed")
+            finally:
+                db.session.remove()
+
+
+def start_change_log_compaction(app):
+    global _compaction_thread
+
+    interval = app.config["CHANGE_LOG_COMPACT_INTERVAL"]
+    if _compaction_thread is not None or interval <= 0 or _stopping.is_set():
+        return
+    with _compaction_lock:
+        if _compaction_thread is None:
+            _compaction_thread = threading.Thread(
+                target=_compact, args=(app, interval), name="change-log-compaction", daemon=True
+            )
+            _compaction_thread.start()
+
+
+def stop_change_log_compaction(timeout=None):
+    _stopping.set()
+    # Let the pass in progress commit its deletion, instead of leaving its connection behind
+    if _compaction_thread is not None:
+        _compaction_thread.join(timeout)
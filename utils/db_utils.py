@@ -2,101 +2,298 @@
 Utility functions for the database operations.
 
 Functions:
-- get_or_create_instance: Retrieve an instance from the session or create a new instance if not found.
-- get_instance: Retrieve an instance from the session based on the provided kwargs.
 - insert_book_to_db: Insert a book into the database with the associated authors and works if it doesn't already exist.
+- openlib_id: Extract the id of a book, author or work from its OpenLibrary key.
+- parse_book_data: Extract the book, author and work fields from book data.
+- insert_ignore_conflicts: Insert rows, skipping those that conflict with existing ones, and report the inserted keys.
+- insert_books_to_db: Insert a batch of books with their authors and works using set-based queries in a single transaction,
+  without conflicting with the concurrent inserts of the same books, authors or works.
+- delete_books_from_db: Delete a batch of books and the authors and works left without books using set-based queries.
 - create_book_list_from_query: Convert a query result of books into a list of book data dictionaries.
+- iterate_book_documents: Load books with their authors and works as plain dictionaries with Core queries, bypassing the ORM.
+- RenderedBook: A book of the read model, kept as its pre-rendered JSON document and only decoded when read.
+- sync_book_documents: Rebuild the denormalized book_documents rows of a batch of books.
+- bump_catalog_version: Increment the catalog version in the transaction of a write.
+- record_book_changes: Bump the catalog version and append the changed books to the change log.
+- delete_book_changes_before: Delete the changes older than a cutoff from the change log.
+- read_catalog_version: Read the current catalog version.
 """
 
+import json
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from sqlalchemy import delete, exists, func, insert, literal_column, select, update
+from sqlalchemy.dialects import postgresql, sqlite
 from models.Book import Book
 from models.Author import Author
 from models.Work import Work
+from models.BookDocument import BookDocument
+from models.BookChange import BookChange
+from models.CatalogVersion import CatalogVersion
+from models.associations.book_author_association import book_author_assoc_table
+from models.associations.book_work_association import book_work_assoc_table
+from utils.instrumentation import timed_phase
 
-def get_or_create_instance(session, model, **kwargs):
-    # Check if an instance with the given kwargs exists in the session
-    instance = session.query(model).filter_by(**kwargs).first()
+# Maximum number of bound parameters used in a single IN (...) query
+IN_QUERY_CHUNK_SIZE = 1000
 
-    if instance:
-        # If an instance exists, return it
-        return instance
-    else:
-        # If an instance doesn't exist, create a new instance with the given kwargs
-        instance = model(**kwargs)
-        session.add(instance)
-
-        return instance
+def openlib_id(key):
+    # '/books/OL1M' -> 'OL1M'
+    return key.split("/")[-1]
 
 
-def get_instance(session, model, **kwargs):
-    # Retrieve an instance with the given kwargs from the session
-    instance = session.query(model).filter_by(**kwargs).first()
-    return instance
+def insert_book_to_db(session, book_data, from_openlib=False):
+    # A batch of a single book, stored with the same conflict-free inserts as insert_books_to_db
+    result = insert_books_to_db(session, [book_data], from_openlib=from_openlib)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
 
 
-def insert_book_to_db(session, book_data, from_openlib=False):
+def parse_book_data(book_data, from_openlib=False):
     if from_openlib:
-        # Extract the book id from the openlib book data
-        book_id = book_data["key"].split("/")[-1]
+        # Extract the ids from the openlib keys
+        book_id = openlib_id(book_data["key"])
+        authors = [
+            (openlib_id(author["key"]), author.get("name"))
+            for author in book_data.get("authors", [])
+        ]
+        works = [
+            (openlib_id(work["key"]), work.get("title"))
+            for work in book_data.get("works", [])
+        ]
     else:
-        # Get the book id from the book data
+        # Get the ids from the book data
         book_id = book_data.get("id")
+        authors = [
+            (author.get("id"), author.get("name"))
+            for author in book_data.get("authors", [])
+        ]
+        works = [(work.get("id"), work.get("title")) for work in book_data.get("works", [])]
+
+    return (
+        book_id,
+        book_data.get("title"),
+        book_data.get("number_of_pages"),
+        authors,
+        works,
+    )
+
 
-    title = book_data.get("title")
-    number_of_pages = book_data.get("number_of_pages")
-    authors = book_data.get("authors", [])
-    works = book_data.get("works", [])
+def select_existing_ids(session, column, ids):
+    # Resolve which ids already exist with one IN (...) query per chunk of ids
+    ids = list(ids)
+    existing = set()
+    for i in range(0, len(ids), IN_QUERY_CHUNK_SIZE):
+        existing.update(
+            session.execute(
+                column.table.select()
+                .with_only_columns(column)
+                .where(column.in_(ids[i : i + IN_QUERY_CHUNK_SIZE]))
+            ).scalars()
+        )
+    return existing
 
-    existing_book = get_instance(session, Book, id=book_id)
 
-    if existing_book != None:
-        # If the book already exists in the database, return False
-        return False
+def insert_ignore_conflicts(session, table, rows, returning=None):
+    if not rows:
+        return set()
+
+    # Use INSERT ... ON CONFLICT DO NOTHING where the dialect supports it
+    dialect = session.get_bind().dialect
+    if dialect.name == "postgresql":
+        statement = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect.name == "sqlite":
+        statement = sqlite.insert(table).on_conflict_do_nothing()
     else:
-        new_book = Book(id=book_id, title=title, number_of_pages=number_of_pages)
+        statement = insert(table)
+
+    # Report which rows were inserted rather than skipped. Without ON CONFLICT a conflict raises, and without
+    # RETURNING on executemany (SQLite < 3.35) the skipped rows can't be told apart, so all rows are reported.
+    if (
+        returning is not None
+        and dialect.name in ("postgresql", "sqlite")
+        and dialect.insert_executemany_returning
+    ):
+        return set(session.execute(statement.returning(returning), rows).scalars())
+
+    # Passing a list of rows runs the statement as an executemany
+    session.execute(statement, rows)
+    return {row[returning.name] for row in rows} if returning is not None else set()
+
+
+def insert_books_to_db(session, books_data, from_openlib=False, commit=True, record_changes=True):
+    parsed = []
+    for book_data in books_data:
+        try:
+            parsed.append(parse_book_data(book_data, from_openlib))
+        except Exception as e:
+            parsed.append(e)
+
+    rows = [fields for fields in parsed if not isinstance(fields, Exception)]
+
+    # Resolve the existing books, authors and works with one query per table
+    existing_books = select_existing_ids(
+        session, Book.__table__.c.id, {fields[0] for fields in rows}
+    )
+    existing_authors = select_existing_ids(
+        session,
+        Author.__table__.c.id,
+        {author_id for fields in rows for author_id, _ in fields[3]},
+    )
+    existing_works = select_existing_ids(
+        session,
+        Work.__table__.c.id,
+        {work_id for fields in rows for work_id, _ in fields[4]},
+    )
+
+    results = []
+    queued = {}  # Book id -> index of its result
+    new_books = []
+    new_authors = {}
+    new_works = {}
+    author_links = []
+    work_links = []
+
+    for fields in parsed:
+        if isinstance(fields, Exception):
+            results.append(fields)
+            continue
+
+        book_id, title, number_of_pages, authors, works = fields
+
+        if book_id in existing_books:
+            # If the book already exists (or appeared earlier in the batch), report False
+            results.append(False)
+            continue
+
+        # Validate the book before queueing any of its rows
+        error = None
+        if book_id is None or title is None:
+            error = "Book {} is missing its id or title".format(book_id)
+        for author_id, name in authors:
+            if author_id is None or (
+                name is None
+                and author_id not in existing_authors
+                and author_id not in new_authors
+            ):
+                error = "Author {} is missing its id or name".format(author_id)
+        for work_id, work_title in works:
+            if work_id is None or (
+                work_title is None
+                and work_id not in existing_works
+                and work_id not in new_works
+            ):
+                error = "Work {} is missing its id or title".format(work_id)
+
+        if error:
+            results.append(ValueError(error))
+            continue
+
+        existing_books.add(book_id)
+        queued[book_id] = len(results)
+        new_books.append({"id": book_id, "title": title, "number_of_pages": number_of_pages})
+
+        for author_id, name in dict(authors).items():
+            if author_id not in existing_authors:
+                new_authors.setdefault(author_id, {"id": author_id, "name": name})
+            author_links.append({"book_id": book_id, "author_id": author_id})
+
+        for work_id, work_title in dict(works).items():
+            if work_id not in existing_works:
+                new_works.setdefault(work_id, {"id": work_id, "title": work_title})
+            work_links.append({"book_id": book_id, "work_id": work_id})
 
-        for author in authors:
-            if from_openlib:
-                # Extract the author id from the openlib author data
-                author_id = author["key"].split("/")[-1]
-            else:
-                # Get the author id from the author data
-                author_id = author.get("id")
+        results.append(True)
 
-            author_name = author.get("name")
+    # Insert the missing rows and the associations in a single transaction. The rows stored meanwhile by a
+    # concurrent import are skipped instead of failing the batch: its authors and works are shared, and
+    # its books are reported as existing and left as they are.
+    insert_ignore_conflicts(session, Author.__table__, list(new_authors.values()))
+    insert_ignore_conflicts(session, Work.__table__, list(new_works.values()))
+    inserted = insert_ignore_conflicts(
+        session, Book.__table__, new_books, returning=Book.__table__.c.id
+    )
+    for book in new_books:
+        if book["id"] not in inserted:
+            results[queued[book["id"]]] = False
 
-            # Get or create an author instance with the given data
-            new_author = get_or_create_instance(
-                session, Author, id=author_id, name=author_name
+    insert_ignore_conflicts(
+        session, book_author_assoc_table, [link for link in author_links if link["book_id"] in inserted]
+    )
+    insert_ignore_conflicts(
+        session, book_work_assoc_table, [link for link in work_links if link["book_id"] in inserted]
+    )
+    inserted_ids = [book["id"] for book in new_books if book["id"] in inserted]
+    sync_book_documents(session, inserted_ids)
+    # The callers running more statements in the transaction (or storing several batches in it) record
+    # their changes themselves, right before committing
+    if inserted_ids and record_changes:
+        record_book_changes(session, inserted=inserted_ids)
+
+    if commit:
+        session.commit()
+
+    return results
+
+
+def delete_books_from_db(session, book_ids, commit=True, record_changes=True):
+    # Only the books that exist are deleted
+    deleted = select_existing_ids(session, Book.__table__.c.id, set(book_ids))
+    deleted_list = list(deleted)
+
+    for i in range(0, len(deleted_list), IN_QUERY_CHUNK_SIZE):
+        session.execute(
+            delete(BookDocument.__table__).where(
+                BookDocument.__table__.c.book_id.in_(deleted_list[i : i + IN_QUERY_CHUNK_SIZE])
             )
-            new_book.authors.append(new_author)
-
-            # Add the author to the session
-            session.add(new_author)
-
-        for work in works:
-            if from_openlib:
-                # Extract the work id from the openlib work data
-                work_id = work["key"].split("/")[-1]
-            else:
-                # Get the work id from the work data
-                work_id = work.get("id")
-            work_title = work.get("title")
-
-            # Get or create a work instance with the given data
-            new_work = get_or_create_instance(
-                session, Work, id=work_id, title=work_title
+        )
+
+    for assoc_table, model in [
+        (book_author_assoc_table, Author),
+        (book_work_assoc_table, Work),
+    ]:
+        # The column linking the association to the author or work
+        link_column = [c for c in assoc_table.columns if c.name != "book_id"][0]
+
+        for i in range(0, len(deleted_list), IN_QUERY_CHUNK_SIZE):
+            chunk = deleted_list[i : i + IN_QUERY_CHUNK_SIZE]
+
+            # Only the authors/works linked to the deleted books can become orphans
+            candidates = list(
+                session.execute(
+                    select(link_column)
+                    .where(assoc_table.c.book_id.in_(chunk))
+                    .distinct()
+                ).scalars()
             )
-            new_book.works.append(new_work)
+            session.execute(delete(assoc_table).where(assoc_table.c.book_id.in_(chunk)))
 
-            # Add the author to the session
-            session.add(new_work)
+            # Delete the candidates that have no remaining links
+            if candidates:
+                session.execute(
+                    delete(model.__table__).where(
+                        model.__table__.c.id.in_(candidates),
+                        ~exists().where(link_column == model.__table__.c.id),
+                    )
+                )
+
+    for i in range(0, len(deleted_list), IN_QUERY_CHUNK_SIZE):
+        session.execute(
+            delete(Book.__table__).where(
+                Book.__table__.c.id.in_(deleted_list[i : i + IN_QUERY_CHUNK_SIZE])
+            )
+        )
+    if deleted_list and record_changes:
+        record_book_changes(session, deleted=deleted_list)
 
-        # Add the book to the session
-        session.add(new_book)
+    if commit:
         session.commit()
-        return True
 
+    return deleted
 
+
+@timed_phase("hydrate", exclude_db=True)
 def create_book_list_from_query(books_query):
     book_list = []
     for book in books_query:
@@ -114,3 +311,275 @@ def create_book_list_from_query(books_query):
 
         book_list.append(book_data)
     return book_list
+
+
+def _links_by_book(session, assoc_column, model, name_column, book_ids):
+    # Group the (id, name/title) of the authors or works of the books, one IN (...) query per chunk
+    links = {}
+    for i in range(0, len(book_ids), IN_QUERY_CHUNK_SIZE):
+        rows = session.execute(
+            select(assoc_column.table.c.book_id, model.id, name_column)
+            .join(model, model.id == assoc_column)
+            .where(assoc_column.table.c.book_id.in_(book_ids[i : i + IN_QUERY_CHUNK_SIZE]))
+            .order_by(assoc_column.table.c.book_id, model.id)
+        )
+        for book_id, link_id, name in rows:
+            links.setdefault(book_id, []).append((link_id, name))
+    return links
+
+
+def _json_agg_links(assoc_column, model, name_column, key):
+    # Correlated subquery aggregating the authors or works of a book into a JSON array, ordered by id
+    return (
+        select(
+            func.coalesce(
+                func.json_agg(
+                    postgresql.aggregate_order_by(
+                        func.json_build_object("id", model.id, key, name_column), model.id
+                    )
+                ),
+                literal_column("'[]'::json"),
+            )
+        )
+        .select_from(assoc_column.table)
+        .join(model, model.id == assoc_column)
+        .where(assoc_column.table.c.book_id == Book.id)
+        .scalar_subquery()
+    )
+
+
+def iterate_book_documents(session, statement, batch_size=None):
+    """Yields the books selected by a statement as dictionaries, without building ORM objects.
+
+    Produces the same dictionaries as create_book_list_from_query, with the authors and works
+    ordered by id. On PostgreSQL the authors and works of every book are aggregated with json_agg
+    in the same query; on other databases they are fetched for every batch of books with one
+    query per association table and grouped by book.
+
+    Args:
+        session (Session): The database session.
+        statement (Select): A select of Book.id, Book.title and Book.number_of_pages, in the order of the result.
+        batch_size (int, optional): Stream the rows from a server-side cursor in batches of this size.
+            Defaults to None, which fetches all the rows at once.
+
+    Yields:
+        dict: A book, including the related authors and works.
+    """
+    aggregate = session.get_bind().dialect.name == "postgresql"
+    if aggregate:
+        statement = statement.add_columns(
+            _json_agg_links(book_author_assoc_table.c.author_id, Author, Author.name, "name"),
+            _json_agg_links(book_work_assoc_table.c.work_id, Work, Work.title, "title"),
+        )
+    if batch_size:
+        partitions = session.execute(statement.execution_options(yield_per=batch_size)).partitions()
+    else:
+        partitions = [session.execute(statement).all()]
+
+    for rows in partitions:
+        if aggregate:
+            book_rows = rows
+        else:
+            book_ids = [row[0] for row in rows]
+            authors = _links_by_book(
+                session, book_author_assoc_table.c.author_id, Author, Author.name, book_ids
+            )
+            works = _links_by_book(
+                session, book_work_assoc_table.c.work_id, Work, Work.title, book_ids
+            )
+            book_rows = (
+                (
+                    book_id,
+                    title,
+                    number_of_pages,
+                    [{"id": link_id, "name": name} for link_id, name in authors.get(book_id, ())],
+                    [{"id": link_id, "title": name} for link_id, name in works.get(book_id, ())],
+                )
+                for book_id, title, number_of_pages in rows
+            )
+
+        for book_id, title, number_of_pages, book_authors, book_works in book_rows:
+            book_data = {
+                "id": book_id,
+                "title": title,
+                "authors": book_authors,
+                "works": book_works,
+            }
+            if number_of_pages is not None:
+                book_data["number_of_pages"] = number_of_pages
+            yield book_data
+
+
+class RenderedBook(Mapping):
+    """A book of the read model, as its pre-rendered JSON document.
+
+    The JSON provider of the application (see utils/app_utils.py) writes the document into the
+    responses as it is, so a book that is only served is never decoded. Reading any field other
+    than the id decodes it once.
+    """
+
+    __slots__ = ("id", "document", "_book")
+
+    def __init__(self, book_id, document):
+        self.id = book_id
+        self.document = document
+        self._book = None
+
+    def _decoded(self):
+        if self._book is None:
+            self._book = json.loads(self.document)
+        return self._book
+
+    def __getitem__(self, key):
+        if key == "id":
+            return self.id
+        return self._decoded()[key]
+
+    def __iter__(self):
+        return iter(self._decoded())
+
+    def __len__(self):
+        return len(self._decoded())
+
+    def __repr__(self):
+        return "RenderedBook({!r})".format(self.document)
+
+
+def sync_book_documents(session, book_ids):
+    """Rebuilds the book_documents rows of a batch of books from the books, authors and works tables.
+
+    Called by the write paths in the transaction that inserts the books, so the read model
+    never lags behind them.
+
+    Args:
+        session (Session): The database session.
+        book_ids (list): The IDs of the books. The documents of the books that don't exist are removed.
+    """
+    book_ids = list(book_ids)
+    for i in range(0, len(book_ids), IN_QUERY_CHUNK_SIZE):
+        chunk = book_ids[i : i + IN_QUERY_CHUNK_SIZE]
+        session.execute(
+            delete(BookDocument.__table__).where(BookDocument.__table__.c.book_id.in_(chunk))
+        )
+
+        # Render the documents the same way as the Core read path
+        books = iterate_book_documents(
+            session,
+            select(Book.id, Book.title, Book.number_of_pages).where(Book.id.in_(chunk)),
+        )
+        rows = [
+            {
+                "book_id": book["id"],
+                # Encoded like the JSON responses (see utils/app_utils.py), which include it as it is
+                "document": json.dumps(book, sort_keys=True, separators=(",", ":")),
+                "title": book["title"],
+                "number_of_pages": book.get("number_of_pages"),
+                "author_names": "\n".join(author["name"] for author in book["authors"]),
+                "work_titles": "\n".join(work["title"] for work in book["works"]),
+            }
+            for book in books
+        ]
+        if rows:
+            session.execute(insert(BookDocument.__table__), rows)
+
+
+def bump_catalog_version(session):
+    """Increments the catalog version, in the transaction of the write that changes the catalog.
+
+    The version only moves when the write commits, so a response tagged with it (see
+    utils/response_cache.py) is current for as long as the version is unchanged.
+
+    The row stays locked until the write commits, so the concurrent writes get their versions in
+    commit order, and wait for each other from their bump to their commit. The bump must therefore be
+    the last statement of the write before its commit (only its change rows follow it, see
+    record_book_changes).
+
+    Args:
+        session (Session): The database session of the write.
+
+    Returns:
+        int: The new version, or 0 before the catalog_version migration.
+    """
+    table = CatalogVersion.__table__
+    statement = update(table).where(table.c.id == 1).values(version=table.c.version + 1)
+    if session.get_bind().dialect.update_returning:
+        # The new version in the same round trip
+        return session.execute(statement.returning(table.c.version)).scalar() or 0
+    session.execute(statement)
+    return read_catalog_version(session)
+
+
+def _utcnow():
+    # Naive UTC timestamps, comparable on every database
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def record_book_changes(session, inserted=(), deleted=()):
+    """Bumps the catalog version and appends the changed books to the change log, in the transaction of a write.
+
+    Every change of the write gets the new catalog version as its sequence number, so the log is
+    ordered like the commits and a consumer resuming after a sequence number never misses a write.
+    Like bump_catalog_version, to be called right before the commit, once every other statement of
+    the write ran.
+
+    Args:
+        session (Session): The database session of the write.
+        inserted (iterable, optional): The IDs of the inserted books.
+        deleted (iterable, optional): The IDs of the deleted books.
+
+    Returns:
+        int: The sequence number of the changes, or 0 before the catalog_version migration (nothing is logged).
+    """
+    seq = bump_catalog_version(session)
+    changed_at = _utcnow()
+    rows = [
+        {"seq": seq, "book_id": book_id, "op": op, "changed_at": changed_at}
+        for op, book_ids in [("insert", inserted), ("delete", deleted)]
+        for book_id in book_ids
+    ]
+    if rows and seq:
+        session.execute(insert(BookChange.__table__), rows)
+    return seq
+
+
+def delete_book_changes_before(session, before):
+    """Deletes the changes older than a cutoff from the change log.
+
+    Whole sequence numbers are deleted, and the compaction watermark of the catalog version row is
+    raised to the last one, so a consumer resuming before it is told to resync.
+
+    Args:
+        session (Session): The database session.
+        before (datetime): The naive UTC cutoff.
+
+    Returns:
+        int: The number of deleted changes.
+    """
+    table = BookChange.__table__
+    seq = session.execute(select(func.max(table.c.seq)).where(table.c.changed_at < before)).scalar()
+    if seq is None:
+        return 0
+
+    deleted = session.execute(delete(table).where(table.c.seq <= seq)).rowcount
+    session.execute(
+        update(CatalogVersion.__table__)
+        .where(CatalogVersion.__table__.c.id == 1, CatalogVersion.__table__.c.compacted_seq < seq)
+        .values(compacted_seq=seq)
+    )
+    session.commit()
+    return deleted
+
+
+def read_catalog_version(session):
+    """Reads the current catalog version.
+
+    Args:
+        session (Session): The database session.
+
+    Returns:
+        int: The version, or 0 before the catalog_version migration.
+    """
+    version = session.execute(
+        select(CatalogVersion.__table__.c.version).where(CatalogVersion.__table__.c.id == 1)
+    ).scalar()
+    return version or 0
@@ -0,0 +1,295 @@
+"""
+Request-level instrumentation.
+
+Breaks the time of every request down into phases: SQL execution, ORM hydration of the books into dictionaries,
+JSON serialization, response compression and outbound OpenLibrary requests, together with the number of queries and ORM rows loaded.
+
+- RequestProfile: The phase timings and counters of a single request.
+- phase(name, exclude_db): Context manager that adds the elapsed time to a phase of the current request.
+- timed_phase(name, exclude_db): Decorator version of phase.
+- RequestMetrics: Thread-safe per-endpoint latency histograms and phase totals, exported by /metrics.
+- request_metrics: The per-endpoint metrics of the process.
+- SamplingProfiler: Samples the stacks of the instrumented requests.
+- write_folded_stacks(directory, name, samples): Writes the samples of a request as folded stacks.
+- init_instrumentation(app): Registers the hooks that profile every request and add the Server-Timing header.
+
+The current profile lives in a context variable, so work submitted to a thread pool through
+contextvars.copy_context() is accounted to the request that submitted it.
+"""
+
+import contextvars
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+# Upper bounds (in seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Phases reported in the Server-Timing header and the metrics
+PHASES = ("db", "hydrate", "serialize", "compress", "openlib")
+
+_current_profile = contextvars.ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    def __init__(self):
+        # Updated from the request thread and the OpenLibrary worker threads
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        self.rows = 0
+
+    def add(self, name, elapsed):
+        with self.lock:
+            self.phases[name] += elapsed
+
+    def server_timing(self, total):
+        entries = [
+            'db;dur={:.2f};desc="{} queries"'.format(self.phases["db"] * 1000, self.queries),
+            'hydrate;dur={:.2f};desc="{} rows"'.format(self.phases["hydrate"] * 1000, self.rows),
+            "serialize;dur={:.2f}".format(self.phases["serialize"] * 1000),
+            "compress;dur={:.2f}".format(self.phases["compress"] * 1000),
+            "openlib;dur={:.2f}".format(self.phases["openlib"] * 1000),
+            "total;dur={:.2f}".format(total * 1000),
+        ]
+        return ", ".join(entries)
+
+
+@contextmanager
+def phase(name, exclude_db=False):
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+
+    # With exclude_db, SQL executed inside the phase (e.g. lazy loads while hydrating) only counts as db time.
+    # Only meaningful for phases of the request thread, the worker threads run concurrently with its queries.
+    db_before = profile.phases["db"]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if exclude_db:
+            elapsed -= profile.phases["db"] - db_before
+        profile.add(name, max(0.0, elapsed))
+
+
+def timed_phase(name, exclude_db=False):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with phase(name, exclude_db):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# SQL time and query count of every engine of the process
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is not None and conn.info.get("query_start"):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        with profile.lock:
+            profile.phases["db"] += elapsed
+            profile.queries += 1
+
+
+# Number of ORM instances loaded by every mapper
+@event.listens_for(Mapper, "load")
+def _on_load(target, context):
+    profile = _current_profile.get()
+    if profile is not None:
+        with profile.lock:
+            profile.rows += 1
+
+
+class InstrumentedJSONProvider(DefaultJSONProvider):
+    # Accounts jsonify (and flask.json.dumps) of the provider it replaces to the serialize phase
+    def __init__(self, app, provider):
+        super().__init__(app)
+        self.provider = provider
+
+    def dumps(self, obj, **kwargs):
+        with phase("serialize"):
+            return self.provider.dumps(obj, **kwargs)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, method, status, total, profile):
+        with self.lock:
+            metrics = self.endpoints.setdefault(
+                (endpoint, method),
+                {
+                    "requests": Counter(),
+                    "duration_sum": 0.0,
+                    "duration_buckets": [0] * len(DURATION_BUCKETS),
+                    "phases": dict.fromkeys(PHASES, 0.0),
+                    "queries": 0,
+                    "rows": 0,
+                },
+            )
+            metrics["requests"][status] += 1
+            metrics["duration_sum"] += total
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if total <= bound:
+                    metrics["duration_buckets"][i] += 1
+            for name, elapsed in profile.phases.items():
+                metrics["phases"][name] += elapsed
+            metrics["queries"] += profile.queries
+            metrics["rows"] += profile.rows
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                key: {
+                    "requests": dict(metrics["requests"]),
+                    "count": sum(metrics["requests"].values()),
+                    "duration_seconds_sum": metrics["duration_sum"],
+                    "duration_seconds_buckets": dict(
+                        zip([str(bound) for bound in DURATION_BUCKETS], metrics["duration_buckets"])
+                    ),
+                    "phase_seconds": dict(metrics["phases"]),
+                    "queries": metrics["queries"],
+                    "rows": metrics["rows"],
+                }
+                for key, metrics in self.endpoints.items()
+            }
+
+
+request_metrics = RequestMetrics()
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of the registered request threads at a fixed interval.
+
+    A single daemon thread samples every registered thread, so the profiled requests only pay for the
+    registration. The samples of a thread are folded into "frame;frame;frame count" lines, the input
+    format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.samples = {}  # Thread id -> Counter of folded stacks
+        self.thread = None
+
+    def start(self, thread_id):
+        with self.lock:
+            self.samples[thread_id] = Counter()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self.thread.start()
+
+    def stop(self, thread_id):
+        with self.lock:
+            return self.samples.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.samples:
+                    # Exit when idle, the next profiled request starts a new thread
+                    self.thread = None
+                    return
+                frames = sys._current_frames()
+                for thread_id, counter in self.samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        counter[_fold(frame)] += 1
+
+
+def _fold(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def write_folded_stacks(directory, name, samples):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name + ".folded")
+    with open(path, "w") as f:
+        for stack, count in samples.most_common():
+            f.write("{} {}\n".format(stack, count))
+    return path
+
+
+def init_instrumentation(app):
+    """Registers the request hooks of the instrumentation on the application.
+
+    Every request gets a RequestProfile, reported in the Server-Timing header and aggregated per endpoint
+    into request_metrics. With PROFILER_ENABLED, the stacks of the requests slower than
+    PROFILER_THRESHOLD_MS are written as folded stacks to PROFILER_OUTPUT_DIR.
+
+    Args:
+        app (Flask): The application to instrument.
+    """
+    if not app.config["INSTRUMENTATION_ENABLED"]:
+        return
+
+    app.json = InstrumentedJSONProvider(app, app.json)
+    profiler = SamplingProfiler(app.config["PROFILER_INTERVAL_MS"] / 1000)
+
+    @app.before_request
+    def start_profile():
+        g.profile_token = _current_profile.set(RequestProfile())
+        if app.config["PROFILER_ENABLED"]:
+            profiler.start(threading.get_ident())
+
+    @app.after_request
+    def finish_profile(response):
+        profile = _current_profile.get()
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.start
+
+        response.headers["Server-Timing"] = profile.server_timing(total)
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        request_metrics.record(endpoint, request.method, response.status_code, total, profile)
+
+        if app.config["PROFILER_ENABLED"]:
+            samples = profiler.stop(threading.get_ident())
+            if samples and total * 1000 >= app.config["PROFILER_THRESHOLD_MS"]:
+                name = "{}_{}_{}_{:.0f}ms".format(
+                    time.strftime("%Y%m%dT%H%M%S"),
+                    request.method,
+                    re.sub(r"[^A-Za-z0-9]+", "_", endpoint).strip("_") or "root",
+                    total * 1000,
+                )
+                write_folded_stacks(app.config["PROFILER_OUTPUT_DIR"], name, samples)
+        return response
+
+    @app.teardown_request
+    def clear_profile(exc):
+        token = g.pop("profile_token", None)
+        if token is not None:
+            profiler.stop(threading.get_ident())
+            _current_profile.reset(token)
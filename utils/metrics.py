@@ -0,0 +1,186 @@
+"""
+Prometheus text exposition of the application metrics.
+
+- format_family(name, metric_type, help_text, samples): Formats a metric family in the Prometheus text format.
+- histogram_samples(buckets, total, count, labels): Builds the samples of a histogram from cumulative bucket counts.
+- collect_metrics(engine): Collects the request, connection pool, OpenLibrary client/cache and response cache metrics.
+"""
+
+from utils.instrumentation import request_metrics
+from utils.openlib_cache import get_cache
+from utils.openlib_client import get_client
+from utils.pool_metrics import pool_stats
+from utils.response_cache import get_response_cache
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            )
+            for name, value in labels.items()
+        )
+    )
+
+
+def format_family(name, metric_type, help_text, samples):
+    lines = [
+        "# HELP {} {}".format(name, help_text),
+        "# TYPE {} {}".format(name, metric_type),
+    ]
+    # Every sample is a (name suffix, labels, value) tuple
+    for suffix, labels, value in samples:
+        lines.append("{}{}{} {}".format(name, suffix, _format_labels(labels), value))
+    return lines
+
+
+def histogram_samples(buckets, total, count, labels=None):
+    labels = labels or {}
+    samples = [
+        ("_bucket", dict(labels, le=bound), bucket_count)
+        for bound, bucket_count in buckets.items()
+    ]
+    samples.append(("_bucket", dict(labels, le="+Inf"), count))
+    samples.append(("_sum", labels, total))
+    samples.append(("_count", labels, count))
+    return samples
+
+
+def collect_metrics(engine):
+    lines = []
+
+    # Requests, broken down into phases by the instrumentation
+    endpoints = request_metrics.snapshot()
+    lines += format_family(
+        "books_http_requests_total",
+        "counter",
+        "HTTP requests by endpoint, method and status.",
+        [
+            ("", {"endpoint": endpoint, "method": method, "status": status}, count)
+            for (endpoint, method), metrics in endpoints.items()
+            for status, count in metrics["requests"].items()
+        ],
+    )
+    lines += format_family(
+        "books_http_request_duration_seconds",
+        "histogram",
+        "Latency of the HTTP requests until the response headers.",
+        [
+            sample
+            for (endpoint, method), metrics in endpoints.items()
+            for sample in histogram_samples(
+                metrics["duration_seconds_buckets"],
+                metrics["duration_seconds_sum"],
+                metrics["count"],
+                {"endpoint": endpoint, "method": method},
+            )
+        ],
+    )
+    lines += format_family(
+        "books_http_request_phase_seconds_total",
+        "counter",
+        "Time spent by the HTTP requests in SQL (db), ORM hydration, JSON serialization and OpenLibrary requests.",
+        [
+            ("", {"endpoint": endpoint, "method": method, "phase": name}, elapsed)
+            for (endpoint, method), metrics in endpoints.items()
+            for name, elapsed in metrics["phase_seconds"].items()
+        ],
+    )
+    for name, key, help_text in [
+        ("db_queries_total", "queries", "SQL statements executed by the HTTP requests."),
+        ("orm_rows_total", "rows", "ORM instances loaded by the HTTP requests."),
+    ]:
+        lines += format_family(
+            "books_http_" + name,
+            "counter",
+            help_text,
+            [
+                ("", {"endpoint": endpoint, "method": method}, metrics[key])
+                for (endpoint, method), metrics in endpoints.items()
+            ],
+        )
+
+    # Database connection pool
+    pool = pool_stats(engine.pool)
+    lines += format_family(
+        "books_db_pool_checkout_wait_seconds",
+        "histogram",
+        "Time spent waiting for a pooled database connection.",
+        histogram_samples(
+            pool["checkout_wait_seconds_buckets"],
+            pool["checkout_wait_seconds_sum"],
+            pool["checkouts"],
+        ),
+    )
+    for name, key, help_text in [
+        ("checkout_timeouts_total", "checkout_timeouts", "Checkouts that timed out waiting for a connection."),
+        ("overflow_checkouts_total", "overflow_checkouts", "Checkouts made while overflow connections were open."),
+        ("connects_total", "connects", "New database connections opened."),
+        ("closes_total", "closes", "Database connections closed."),
+        ("invalidations_total", "invalidations", "Database connections invalidated."),
+    ]:
+        lines += format_family(
+            "books_db_pool_" + name, "counter", help_text, [("", {}, pool[key])]
+        )
+    for name, help_text in [
+        ("pool_size", "Configured size of the connection pool."),
+        ("checked_out", "Connections currently checked out."),
+        ("overflow", "Overflow connections currently open."),
+    ]:
+        if name in pool:
+            lines += format_family(
+                "books_db_pool_" + name, "gauge", help_text, [("", {}, pool[name])]
+            )
+
+    # OpenLibrary client
+    client = get_client().stats()
+    lines += format_family(
+        "books_openlib_request_seconds",
+        "histogram",
+        "Latency of the OpenLibrary requests, including retries.",
+        histogram_samples(
+            client["latency_seconds_buckets"],
+            client["latency_seconds_sum"],
+            client["requests"],
+        ),
+    )
+    for name in ["retries", "failures"]:
+        lines += format_family(
+            "books_openlib_{}_total".format(name),
+            "counter",
+            "OpenLibrary request {}.".format(name),
+            [("", {}, client[name])],
+        )
+
+    # OpenLibrary author/work document cache
+    cache = get_cache().stats()
+    lines += format_family(
+        "books_openlib_cache_lookups_total",
+        "counter",
+        "OpenLibrary document cache lookups by result.",
+        [
+            ("", {"result": result}, cache[result])
+            for result in ["hot_hits", "disk_hits", "db_hits", "misses"]
+        ],
+    )
+
+    # Response cache
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        stats = response_cache.stats()
+        lines += format_family(
+            "books_response_cache_requests_total",
+            "counter",
+            "Cacheable requests by result.",
+            [
+                ("", {"result": result}, stats[result])
+                for result in ["hits", "not_modified", "misses"]
+            ],
+        )
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,373 @@
+"""
+Local cache for OpenLibrary author and work documents.
+
+- SingleFlight: Runs a single call per key at a time, sharing its outcome with the concurrent callers.
+- OpenLibraryCache: A two-tier cache keyed by OpenLibrary key, made of an in-process LRU hot tier in front of
+  a persistent SQLite store, with TTL expiry, size-bounded LRU eviction and hit/miss statistics. Concurrent
+  misses of a key are fetched once: by one thread per process, and by one process among those sharing the
+  store, which hold a fetch lock in its fetch_locks table while the others wait for the document.
+- is_cacheable(key): Checks if an OpenLibrary key refers to an author or work document.
+- get_cache(): Returns the cache shared by the whole process, configured from the config of the application
+  creating it.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from flask import current_app, has_app_context
+from utils.openlib_client import get_client
+from config.config import config
+
+# Prefixes of the OpenLibrary keys that are cached
+CACHEABLE_PREFIXES = ("/authors/", "/works/")
+
+
+def is_cacheable(key):
+    return key.startswith(CACHEABLE_PREFIXES)
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}  # key -> Future of the call in progress
+        self.lock = threading.Lock()
+        self.shared = 0  # Calls answered by the call of another thread
+
+    def do(self, key, function):
+        """Calls the function, unless a call for the same key is already in progress.
+
+        Args:
+            key (str): The key of the call.
+            function (callable): The function, called without arguments.
+
+        Returns:
+            The result of the function, or of the call in progress for the key.
+
+        Raises:
+            Exception: The exception raised by the function, or by the call in progress for the key.
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = function()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class OpenLibraryCache:
+    def __init__(
+        self,
+        path=None,
+        ttl=7 * 24 * 3600,
+        max_entries=100000,
+        hot_max_entries=1000,
+        lock_timeout=30,
+        poll_interval=0.05,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hot_max_entries = hot_max_entries
+        # Lifetime of the fetch locks, after which the lock of a crashed process is taken over,
+        # and the interval at which the waiters check for the document
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        # Owner of the fetch locks taken by the process, see _owner
+        self.owner = None
+        self.owner_pid = None
+        self.flights = SingleFlight()
+        self.hot = OrderedDict()  # key -> (document, fetched_at)
+        # Counting the store is a scan, so the size bound is enforced every few writes
+        self.evict_interval = max(1, min(100, max_entries // 10))
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+        self.conn = None
+        if path:
+            # The store may be shared by several worker processes, so use WAL and wait on locks
+            self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "key TEXT PRIMARY KEY, document TEXT NOT NULL, "
+                "fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_documents_accessed_at ON documents (accessed_at)"
+            )
+            # Key being fetched by a process, until it stores the document or the lock expires
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS fetch_locks ("
+                "key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self.conn.commit()
+
+    def reset_stats(self):
+        with self.lock:
+            self.hot_hits = 0
+            self.disk_hits = 0
+            self.db_hits = 0  # Documents resolved from the authors/works tables
+            self.misses = 0
+            self.expirations = 0
+            self.evictions = 0
+            self.lock_waits = 0  # Claims of a key whose fetch lock was held by another process
+
+    def _remember(self, key, document, fetched_at):
+        # Insert into the hot tier as most recently used, dropping the least recently used entry
+        self.hot[key] = (document, fetched_at)
+        self.hot.move_to_end(key)
+        while len(self.hot) > self.hot_max_entries:
+            self.hot.popitem(last=False)
+
+    def get(self, key):
+        """Returns the cached document of an OpenLibrary key, or None on a miss."""
+        now = time.time()
+
+        with self.lock:
+            entry = self.hot.get(key)
+            if entry is not None:
+                if now - entry[1] < self.ttl:
+                    self.hot.move_to_end(key)
+                    self.hot_hits += 1
+                    return entry[0]
+                del self.hot[key]
+
+            if self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT document, fetched_at FROM documents WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    if now - row[1] < self.ttl:
+                        # Refresh the LRU position of the entry and promote it to the hot tier
+                        self.conn.execute(
+                            "UPDATE documents SET accessed_at = ? WHERE key = ?", (now, key)
+                        )
+                        self.conn.commit()
+                        document = json.loads(row[0])
+                        self._remember(key, document, row[1])
+                        self.disk_hits += 1
+                        return document
+
+                    self.conn.execute("DELETE FROM documents WHERE key = ?", (key,))
+                    self.conn.commit()
+                    self.expirations += 1
+
+            self.misses += 1
+            return None
+
+    def set(self, key, document):
+        """Stores the document of an OpenLibrary key in both tiers."""
+        now = time.time()
+
+        with self.lock:
+            self._remember(key, document, now)
+
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO documents (key, document, fetched_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(document), now, now),
+                )
+                self.writes += 1
+                if self.writes % self.evict_interval == 0:
+                    self._evict()
+                self.conn.commit()
+
+    def _evict(self):
+        # Drop the least recently used entries beyond the size bound
+        excess = (
+            self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            - self.max_entries
+        )
+        if excess > 0:
+            self.conn.execute(
+                "DELETE FROM documents WHERE key IN "
+                "(SELECT key FROM documents ORDER BY accessed_at LIMIT ?)",
+                (excess,),
+            )
+            self.evictions += excess
+
+    def peek(self, key):
+        """Returns the cached document of a key without counting a lookup, or None."""
+        now = time.time()
+
+        with self.lock:
+            entry = self.hot.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                return entry[0]
+
+            if self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT document, fetched_at FROM documents WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] < self.ttl:
+                    document = json.loads(row[0])
+                    self._remember(key, document, row[1])
+                    return document
+
+        return None
+
+    def _owner(self):
+        # Unique among the processes of every host sharing the store, and never reused by a later process
+        # with the same pid, which must not release the locks of a crashed one. A forked process gets its own
+        pid = os.getpid()
+        if self.owner_pid != pid:
+            self.owner = "{}:{}:{}".format(socket.gethostname(), pid, uuid.uuid4())
+            self.owner_pid = pid
+        return self.owner
+
+    def claim_fetch(self, key):
+        """Takes the fetch lock of a key for the current process.
+
+        Returns:
+            bool: False if another process holds a lock on the key that hasn't expired.
+        """
+        if self.conn is None:
+            return True
+
+        now = time.time()
+        with self.lock:
+            # Insert the lock, or take over an expired one, in a single statement
+            claimed = self.conn.execute(
+                "INSERT INTO fetch_locks (key, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE fetch_locks.expires_at < ?",
+                (key, self._owner(), now + self.lock_timeout, now),
+            ).rowcount
+            self.conn.commit()
+            if not claimed:
+                self.lock_waits += 1
+            return bool(claimed)
+
+    def release_fetch(self, key):
+        """Releases the fetch lock of a key held by the current process."""
+        if self.conn is None:
+            return
+
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM fetch_locks WHERE key = ? AND owner = ?", (key, self._owner())
+            )
+            self.conn.commit()
+
+    def _fetch_once(self, key, fetch):
+        # Wait for the process fetching the key, if any, then fetch it unless it was stored meanwhile
+        while not self.claim_fetch(key):
+            time.sleep(self.poll_interval)
+            document = self.peek(key)
+            if document is not None:
+                return document
+
+        try:
+            document = self.peek(key)
+            if document is None:
+                document = fetch()
+                self.set(key, document)
+            return document
+        finally:
+            self.release_fetch(key)
+
+    def get_or_fetch(self, key, fetch):
+        """Returns the cached document of a key, fetching it on a miss.
+
+        The concurrent misses of a key are fetched once: the threads of the process share the fetch of the
+        first one, and the processes sharing the store wait for the one holding the fetch lock of the key.
+        Failed fetches are not cached, the next caller fetches again.
+
+        Args:
+            key (str): The OpenLibrary key.
+            fetch (callable): The function returning the document of the key.
+
+        Returns:
+            dict: The document.
+        """
+        document = self.get(key)
+        if document is not None:
+            return document
+        return self.flights.do(key, lambda: self._fetch_once(key, fetch))
+
+    def record_db_hits(self, count):
+        with self.lock:
+            self.db_hits += count
+
+    def clear(self):
+        with self.lock:
+            self.hot.clear()
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM documents")
+                self.conn.execute("DELETE FROM fetch_locks")
+                self.conn.commit()
+
+    def stats(self):
+        """Returns the hit/miss counters and the size of both tiers."""
+        with self.lock:
+            disk_entries = (
+                self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+                if self.conn is not None
+                else 0
+            )
+            lookups = self.hot_hits + self.disk_hits + self.misses
+            return {
+                "hot_hits": self.hot_hits,
+                "disk_hits": self.disk_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "coalesced": self.flights.shared,
+                "lock_waits": self.lock_waits,
+                "hit_ratio": (self.hot_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "hot_entries": len(self.hot),
+                "disk_entries": disk_entries,
+                "max_entries": self.max_entries,
+                "hot_max_entries": self.hot_max_entries,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+
+    # Lazily open the shared cache on first use, with the settings of the application creating it
+    # (like get_client)
+    with _cache_lock:
+        if _cache is None:
+            settings = current_app.config if has_app_context() else config
+            path = settings["OPENLIB_CACHE_PATH"]
+            if path and has_app_context():
+                # A relative path is in the instance folder of the application, wherever the process was started
+                path = os.path.join(current_app.instance_path, path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            _cache = OpenLibraryCache(
+                path=path,
+                ttl=settings["OPENLIB_CACHE_TTL"],
+                max_entries=settings["OPENLIB_CACHE_MAX_ENTRIES"],
+                hot_max_entries=settings["OPENLIB_CACHE_HOT_ENTRIES"],
+                # By default, held for as long as the worst-case fetch of the client may take
+                lock_timeout=settings["OPENLIB_FETCH_LOCK_TIMEOUT"] or get_client().max_fetch_seconds(),
+            )
+        return _cache
@@ -0,0 +1,225 @@
+"""
+OpenLibrary HTTP client.
+
+- TokenBucket: A thread-safe token-bucket rate limiter.
+- RequestStats: Thread-safe request, retry, failure and latency counters of an OpenLibrary client.
+- OpenLibraryClient: A client built around a pooled keep-alive session, with connect/read timeouts,
+  exponential backoff on 429/5xx responses, rate limiting and counters for monitoring.
+- get_client(): Returns the client shared by the whole process, configured from the config of the application
+  creating it.
+"""
+
+import threading
+import time
+import requests
+from flask import current_app, has_app_context
+from requests.adapters import HTTPAdapter
+from config.config import config
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        # Tokens added per second and the maximum burst size
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # A non-positive rate disables rate limiting
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # Refill the bucket with the tokens earned since the last update
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class RequestStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0  # Requests sent, including retries
+            self.retries = 0
+            self.failures = 0  # Calls that gave up with an error
+            self.latency_sum = 0.0
+            self.latency_max = 0.0
+            self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    def record(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_latency(self, latency):
+        with self.lock:
+            self.requests += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    self.latency_buckets[i] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "failures": self.failures,
+                "latency_seconds_sum": self.latency_sum,
+                "latency_seconds_max": self.latency_max,
+                "latency_seconds_avg": self.latency_sum / self.requests
+                if self.requests
+                else 0.0,
+                "latency_seconds_buckets": dict(
+                    zip([str(bound) for bound in LATENCY_BUCKETS], self.latency_buckets)
+                ),
+            }
+
+
+class OpenLibraryClient:
+    # Status codes that are worth retrying
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        url_base="https://openlibrary.org",
+        pool_maxsize=10,
+        connect_timeout=3.05,
+        read_timeout=10,
+        max_retries=3,
+        backoff_factor=0.5,
+        backoff_max=30,
+        rate_limit=0,
+        rate_burst=1,
+    ):
+        self.url_base = url_base
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.rate_limiter = TokenBucket(rate_limit, rate_burst)
+
+        # Keep-alive session whose per-host pools block instead of opening extra connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Counters for monitoring, also fed by the async client of the process (see utils/async_openlib_client.py)
+        self.counters = RequestStats()
+
+    def reset_stats(self):
+        self.counters.reset()
+
+    def _backoff(self, attempt, response):
+        # Honour the Retry-After header of rate limited or unavailable responses
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(self.backoff_max, int(retry_after))
+
+        return min(self.backoff_max, self.backoff_factor * (2**attempt))
+
+    def max_fetch_seconds(self):
+        """Returns the longest a get_json call can take, with every attempt timing out and the longest backoffs.
+
+        The waits on the rate limiter and the connection pool are not included.
+        """
+        connect_timeout, read_timeout = self.timeout
+        # A Retry-After header may ask for up to backoff_max seconds before every retry
+        return (self.max_retries + 1) * (connect_timeout + read_timeout) + self.max_retries * self.backoff_max
+
+    def get_json(self, path):
+        """Fetches an OpenLibrary document.
+
+        Args:
+            path (str): The path of the document without the '.json' suffix (e.g. '/books/OL1M').
+
+        Returns:
+            dict: The decoded JSON document.
+
+        Raises:
+            requests.HTTPError: If the final response has a non-2xx status code.
+            requests.RequestException: If the request could not be completed after all retries.
+        """
+        url = "{}{}.json".format(self.url_base, path)
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            response = None
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self.counters.record_latency(time.perf_counter() - start)
+
+            if response is not None and response.status_code not in self.RETRY_STATUSES:
+                break
+
+            if attempt == self.max_retries:
+                if response is None:
+                    self.counters.record("failures")
+                    raise error
+                break
+
+            self.counters.record("retries")
+            time.sleep(self._backoff(attempt, response))
+
+        try:
+            response.raise_for_status()  # Raise an exception for non-2xx status codes
+        except requests.HTTPError:
+            self.counters.record("failures")
+            raise
+
+        return response.json()
+
+    def stats(self):
+        """Returns the request, retry and latency counters of the client."""
+        return self.counters.stats()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+
+    # Lazily create the shared client so that every thread reuses the same pools, with the settings of the
+    # application creating it (including the overrides of create_app), or the defaults outside of one
+    with _client_lock:
+        if _client is None:
+            settings = current_app.config if has_app_context() else config
+            _client = OpenLibraryClient(
+                url_base=settings["OPENLIB_URL_BASE"],
+                pool_maxsize=settings["OPENLIB_POOL_MAXSIZE"],
+                connect_timeout=settings["OPENLIB_CONNECT_TIMEOUT"],
+                read_timeout=settings["OPENLIB_READ_TIMEOUT"],
+                max_retries=settings["OPENLIB_MAX_RETRIES"],
+                backoff_factor=settings["OPENLIB_BACKOFF_FACTOR"],
+                rate_limit=settings["OPENLIB_RATE_LIMIT"],
+                rate_burst=settings["OPENLIB_RATE_BURST"],
+            )
+        return _client
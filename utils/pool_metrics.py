@@ -0,0 +1,107 @@
+"""
+Connection pool instrumentation.
+
+- InstrumentedQueuePool: A QueuePool that measures how long every checkout waits for a connection.
+- PoolMetrics: Thread-safe counters of checkouts, wait time, timeouts and connection churn.
+- pool_metrics: The counters shared by every InstrumentedQueuePool of the process.
+- pool_stats(pool): Returns the counters together with the current size, checked out and overflow gauges of a pool.
+"""
+
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds (in seconds) of the checkout wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * len(WAIT_BUCKETS)
+        self.overflow_checkouts = 0  # Checkouts served by a connection beyond pool_size
+        self.connects = 0  # New DBAPI connections (churn)
+        self.closes = 0
+        self.invalidations = 0
+
+    def record_checkout(self, wait, overflow):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_sum += wait
+            self.wait_max = max(self.wait_max, wait)
+            for i, bound in enumerate(WAIT_BUCKETS):
+                if wait <= bound:
+                    self.wait_buckets[i] += 1
+            if overflow:
+                self.overflow_checkouts += 1
+
+    def increment(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_timeouts": self.checkout_timeouts,
+                "checkout_wait_seconds_sum": self.wait_sum,
+                "checkout_wait_seconds_max": self.wait_max,
+                "checkout_wait_seconds_buckets": dict(
+                    zip([str(bound) for bound in WAIT_BUCKETS], self.wait_buckets)
+                ),
+                "overflow_checkouts": self.overflow_checkouts,
+                "connects": self.connects,
+                "closes": self.closes,
+                "invalidations": self.invalidations,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.increment("checkout_timeouts")
+            raise
+
+        # The overflow counter is positive while connections beyond pool_size are open
+        pool_metrics.record_checkout(time.perf_counter() - start, self.overflow() > 0)
+        return connection
+
+
+@event.listens_for(InstrumentedQueuePool, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    pool_metrics.increment("connects")
+
+
+@event.listens_for(InstrumentedQueuePool, "close")
+def _on_close(dbapi_connection, connection_record):
+    pool_metrics.increment("closes")
+
+
+@event.listens_for(InstrumentedQueuePool, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    pool_metrics.increment("invalidations")
+
+
+def pool_stats(pool):
+    stats = pool_metrics.snapshot()
+    if isinstance(pool, QueuePool):
+        stats.update(
+            {
+                "pool_size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": max(0, pool.overflow()),
+            }
+        )
+    return stats
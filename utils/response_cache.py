@@ -0,0 +1,316 @@
+"""
+Read-through cache of the JSON responses of the book listing and search endpoints.
+
+- InProcessBackend: A size-bounded LRU store with per-entry TTL living in the worker process.
+- RedisBackend: A store in a local Redis-compatible server shared by all the worker processes
+  (requires the optional 'redis' package; size it with the server's maxmemory and allkeys-lru policy).
+- ResponseCache: The cache keyed by endpoint and normalized query parameters.
+- cached_response: A decorator serving a GET endpoint from the cache, with ETag/If-None-Match support and
+  precompressed variants of the entries.
+- mark_cacheable(): Marks the response of the current request as cacheable.
+- get_response_cache(): Returns the cache shared by the whole process, configured from the config of the
+  application creating it.
+- catalog_version(): Returns the catalog version, read from the database at most every CATALOG_VERSION_TTL seconds.
+- expire_catalog_version(): Forces the next catalog_version() call to read the database (after a write).
+
+ETags:
+The strong ETag of a response is "<catalog version>-<hash of the key>", with the catalog version read before
+building the response (and "-<encoding>" appended for the compressed representations). While the version is
+unchanged nothing was written since, so a matching If-None-Match gets a 304 without any cache lookup or query.
+
+Validity:
+Every entry records the catalog version read before its response was built, and is only served while that version
+is current. The version is shared by all the worker processes, so the writes of any of them (and of the import
+workers and dump loads) retire the entries within CATALOG_VERSION_TTL seconds, whatever the backend. A response
+built while a write committed is tagged with the version before it, so it is never served after the write.
+The retired entries are replaced when their response is built again, or dropped by the LRU bound or their TTL;
+the writes don't look the entries up, so their cost doesn't grow with the size of the cache.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, current_app, g, has_app_context, make_response, request
+from db import db
+from utils.compression import compress, negotiate_encoding, representation_etag
+from utils.db_utils import read_catalog_version
+from utils.instrumentation import phase
+from config.config import config
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - optional dependency
+    redis = None
+
+
+class InProcessBackend:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (entry, expires_at)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return item[0]
+
+    def set(self, key, entry, ttl):
+        with self.lock:
+            self.entries[key] = (entry, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            # Drop the least recently used entries beyond the size bound
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def set_variant(self, key, entry, encoding, body):
+        with self.lock:
+            entry["variants"][encoding] = body
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisBackend:
+    PREFIX = "books-api:response:"
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("The 'redis' package is required for the redis response cache backend.")
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        fields = self.client.hgetall(self.PREFIX + key)
+        if not fields:
+            return None
+        return {
+            "body": fields[b"body"],
+            "etag": fields[b"etag"].decode(),
+            "version": int(fields[b"version"]),
+            "mimetype": fields[b"mimetype"].decode(),
+            "variants": {
+                name.decode()[len("variant:") :]: value
+                for name, value in fields.items()
+                if name.startswith(b"variant:")
+            },
+        }
+
+    def set(self, key, entry, ttl):
+        pipe = self.client.pipeline()
+        # Replaces the entry of an older catalog version together with its compressed variants
+        pipe.delete(self.PREFIX + key)
+        pipe.hset(
+            self.PREFIX + key,
+            mapping={
+                "body": entry["body"],
+                "etag": entry["etag"],
+                "version": entry["version"],
+                "mimetype": entry["mimetype"],
+            },
+        )
+        pipe.expire(self.PREFIX + key, int(ttl))
+        pipe.execute()
+
+    def set_variant(self, key, entry, encoding, body):
+        # Only if the entry still exists, the variant expires with it
+        if self.client.exists(self.PREFIX + key):
+            self.client.hset(self.PREFIX + key, "variant:" + encoding, body)
+
+    def _keys(self):
+        return self.client.scan_iter(match=self.PREFIX + "*", count=1000)
+
+    def clear(self):
+        # Only on demand (tests and operators), the requests never scan the keys
+        pipe = self.client.pipeline()
+        for key in self._keys():
+            pipe.delete(key)
+        pipe.execute()
+
+    def __len__(self):
+        # Scans the keys, only read by the monitoring endpoints
+        return sum(1 for _ in self._keys())
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.not_modified = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(endpoint, args):
+        # Normalize the query parameters: sorted, without empty values
+        params = sorted(
+            (name, value) for name, values in args.lists() for value in values if value != ""
+        )
+        return "{}?{}".format(endpoint, json.dumps(params, separators=(",", ":")))
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, body, mimetype, etag, version):
+        entry = {
+            "body": body,
+            "etag": etag,
+            "version": version,  # Catalog version the body was read at
+            "mimetype": mimetype,
+            "variants": {},  # Encoding -> compressed body
+        }
+        self.backend.set(key, entry, self.ttl)
+        return entry
+
+    def variant(self, key, entry, encoding):
+        """Returns the body of an entry compressed with the encoding, compressing and storing it once."""
+        body = entry["variants"].get(encoding)
+        if body is None:
+            with phase("compress"):
+                body = compress(entry["body"], encoding, "cached")
+            self.backend.set_variant(key, entry, encoding, body)
+        return body
+
+    def clear(self):
+        self.backend.clear()
+
+    def record(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "not_modified": self.not_modified,
+                "misses": self.misses,
+                "entries": len(self.backend),
+            }
+
+
+def mark_cacheable():
+    """Marks the response of the current request as cacheable (the error responses are not)."""
+    g.response_cacheable = True
+
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def cached_response(view):
+    """Serves a GET endpoint from the response cache.
+
+    The view calls mark_cacheable to make its response cacheable. Clients sending a
+    matching If-None-Match header get a 304 without the body being rebuilt. An entry is
+    only served while the catalog version it was built at is current.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = get_response_cache()
+        key = ResponseCache.make_key(request.path, request.args)
+        encoding = negotiate_encoding()
+
+        # Nothing was written since the client got its copy, of the encoding it accepts or uncompressed
+        # (read before the view, so the body is at least as recent as the version)
+        version = catalog_version()
+        etag = "{}-{}".format(version, hashlib.sha1(key.encode()).hexdigest()[:16])
+        for tag in {etag, representation_etag(etag, encoding)}:
+            if request.if_none_match.contains(tag):
+                if cache is not None:
+                    cache.record("not_modified")
+                return _not_modified(tag)
+
+        entry = cache.get(key) if cache is not None else None
+        if entry is not None and entry["version"] != version:
+            # Built before a write of any worker process, rebuild it
+            entry = None
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            cacheable = g.pop("response_cacheable", False)
+            if response.status_code != 200:
+                return response
+
+            # Compressed by the after_request hook of utils/compression.py
+            response.set_etag(etag)
+            if cache is None or not cacheable or response.is_streamed:
+                return response
+
+            cache.record("misses")
+            if catalog_version() != version:
+                # A write committed while the body was built, don't keep it past the write
+                return response
+            entry = cache.set(key, response.get_data(), response.mimetype, etag, version)
+        else:
+            # The entry is of the current version, so its ETag is the one compared above
+            cache.record("hits")
+
+        if encoding is None or len(entry["body"]) < config["COMPRESSION_MIN_SIZE"]:
+            response = Response(entry["body"], mimetype=entry["mimetype"])
+            response.set_etag(entry["etag"])
+        else:
+            response = Response(cache.variant(key, entry, encoding), mimetype=entry["mimetype"])
+            response.headers["Content-Encoding"] = encoding
+            response.set_etag(representation_etag(entry["etag"], encoding))
+        response.vary.add("Accept-Encoding")
+        return response
+
+    return wrapper
+
+
+_catalog_version = (None, 0.0)  # (version, time it was read)
+
+
+def catalog_version():
+    global _catalog_version
+
+    version, read_at = _catalog_version
+    if version is None or time.monotonic() - read_at >= config["CATALOG_VERSION_TTL"]:
+        version = read_catalog_version(db.session)
+        _catalog_version = (version, time.monotonic())
+    return version
+
+
+def expire_catalog_version():
+    global _catalog_version
+
+    _catalog_version = (None, 0.0)
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _response_cache
+
+    settings = current_app.config if has_app_context() else config
+    backend_name = settings["RESPONSE_CACHE_BACKEND"]
+    if backend_name == "none":
+        return None
+
+    # Lazily create the shared cache on first use, with the settings of the application creating it
+    # (including the overrides of create_app)
+    with _response_cache_lock:
+        if _response_cache is None:
+            if backend_name == "redis":
+                backend = RedisBackend(settings["RESPONSE_CACHE_URL"])
+            else:
+                backend = InProcessBackend(settings["RESPONSE_CACHE_MAX_ENTRIES"])
+            _response_cache = ResponseCache(backend, ttl=settings["RESPONSE_CACHE_TTL"])
+        return _response_cache
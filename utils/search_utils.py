@@ -0,0 +1,205 @@
+"""
+Utility functions for the indexed book search.
+
+Functions:
+- setup_search_indexes: Create the text search indexes of author names and work titles for the database dialect.
+- get_search_backend: Detect which text search backend is available in the database.
+- match_authors: Build a query of the ids and relevance scores of the authors whose name contains a term.
+- match_works: Build a query of the ids and relevance scores of the works whose title contains a term.
+- is_indexed: Check if the matches of a term are served by a text index.
+- like_filter: Build an unindexed case-insensitive substring filter of a column.
+
+On PostgreSQL the matches are served by pg_trgm GIN indexes and ranked by word similarity.
+On SQLite they are served by FTS5 trigram tables, keyed by the stable integer keys of a side table of the ids of the
+indexed rows, kept in sync with triggers, and ranked by bm25.
+Other databases fall back to an unindexed ILIKE scan.
+
+The SQLite builtin lower(), which ILIKE compiles to, only folds the ASCII letters, unlike the FTS5 trigram
+tokenizer and the catalog snapshot (see utils/catalog_snapshot.py): it is replaced by str.lower() on every SQLite
+connection, so the terms too short for the index match the same names.
+"""
+
+from sqlalchemy import event, func, literal, literal_column, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import column as column_clause, table as table_clause
+from models.Author import Author
+from models.Work import Work
+
+# Indexed columns, keyed by table name
+SEARCH_COLUMNS = {"authors": "name", "works": "title"}
+
+# Minimum term length the trigram indexes can serve
+MIN_TRIGRAM_TERM_LENGTH = 3
+
+_search_backends = {}
+
+
+def _lower(value):
+    return value.lower() if isinstance(value, str) else value
+
+
+@event.listens_for(Engine, "connect")
+def _fold_unicode_case(dbapi_connection, connection_record):
+    # Only the SQLite drivers (sqlite3 and aiosqlite) can define SQL functions
+    create_function = getattr(dbapi_connection, "create_function", None)
+    if create_function is not None:
+        create_function("lower", 1, _lower, deterministic=True)
+
+
+def setup_search_indexes(engine):
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            for table, column in SEARCH_COLUMNS.items():
+                conn.execute(
+                    text(
+                        "CREATE INDEX IF NOT EXISTS ix_{0}_{1}_trgm "
+                        "ON {0} USING gin ({1} gin_trgm_ops)".format(table, column)
+                    )
+                )
+
+        elif engine.dialect.name == "sqlite":
+            for table, column in SEARCH_COLUMNS.items():
+                exists = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                    {"name": table + "_fts_keys"},
+                ).first()
+                if exists:
+                    continue
+
+                # Drop the external content index of earlier versions, keyed by the implicit rowid of the
+                # base table, which VACUUM may renumber since its primary key is text
+                for trigger in ["insert", "delete", "update"]:
+                    conn.execute(text("DROP TRIGGER IF EXISTS {}_fts_{}".format(table, trigger)))
+                conn.execute(text("DROP TABLE IF EXISTS {}_fts".format(table)))
+
+                # Stable integer keys of the indexed rows (an INTEGER PRIMARY KEY is never renumbered),
+                # and the index of the column by key
+                conn.execute(
+                    text(
+                        "CREATE TABLE {0}_fts_keys (fts_rowid INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE)".format(
+                            table
+                        )
+                    )
+                )
+                conn.execute(
+                    text("CREATE VIRTUAL TABLE {0}_fts USING fts5({1}, tokenize='trigram')".format(table, column))
+                )
+                # Keep the index in sync with the base table
+                key = "(SELECT fts_rowid FROM {0}_fts_keys WHERE id = {1}.id)"
+                conn.execute(
+                    text(
+                        "CREATE TRIGGER {0}_fts_insert AFTER INSERT ON {0} BEGIN "
+                        "INSERT INTO {0}_fts_keys (id) VALUES (new.id); "
+                        "INSERT INTO {0}_fts (rowid, {1}) VALUES ({2}, new.{1}); "
+                        "END".format(table, column, key.format(table, "new"))
+                    )
+                )
+                conn.execute(
+                    text(
+                        "CREATE TRIGGER {0}_fts_delete AFTER DELETE ON {0} BEGIN "
+                        "DELETE FROM {0}_fts WHERE rowid = {1}; "
+                        "DELETE FROM {0}_fts_keys WHERE id = old.id; "
+                        "END".format(table, key.format(table, "old"))
+                    )
+                )
+                conn.execute(
+                    text(
+                        "CREATE TRIGGER {0}_fts_update AFTER UPDATE ON {0} BEGIN "
+                        "UPDATE {0}_fts_keys SET id = new.id WHERE id = old.id; "
+                        "UPDATE {0}_fts SET {1} = new.{1} WHERE rowid = {2}; "
+                        "END".format(table, column, key.format(table, "new"))
+                    )
+                )
+                # Index the rows that already exist
+                conn.execute(text("INSERT INTO {0}_fts_keys (id) SELECT id FROM {0}".format(table)))
+                conn.execute(
+                    text(
+                        "INSERT INTO {0}_fts (rowid, {1}) SELECT k.fts_rowid, t.{1} "
+                        "FROM {0} t JOIN {0}_fts_keys k ON k.id = t.id".format(table, column)
+                    )
+                )
+
+    _search_backends.pop(engine.url, None)
+
+
+def get_search_backend(session):
+    engine = session.get_bind()
+
+    # Detect the backend once per engine
+    if engine.url not in _search_backends:
+        backend = "like"
+        if engine.dialect.name == "postgresql":
+            if session.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            ).first():
+                backend = "trigram"
+        elif engine.dialect.name == "sqlite":
+            fts_tables = session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE name IN ('authors_fts', 'works_fts')")
+            ).all()
+            if len(fts_tables) == 2:
+                backend = "fts5"
+        _search_backends[engine.url] = backend
+
+    return _search_backends[engine.url]
+
+
+def _like_pattern(term):
+    # Match the term as a literal substring
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return "%{}%".format(escaped)
+
+
+def _match(session, model, column, term):
+    backend = get_search_backend(session)
+    table = model.__tablename__
+
+    if backend == "trigram":
+        # ILIKE is served by the trigram index and word similarity ranks the matches
+        return select(
+            model.id.label("id"), func.word_similarity(term, column).label("score")
+        ).where(column.ilike(_like_pattern(term), escape="\\"))
+
+    if backend == "fts5" and len(term) >= MIN_TRIGRAM_TERM_LENGTH:
+        # Match the term as a phrase, so it is looked up as a substring. The LIMIT
+        # keeps SQLite from flattening bm25() into the aggregating outer query
+        fts = table_clause(table + "_fts", column_clause("rowid"))
+        keys = table_clause(table + "_fts_keys", column_clause("fts_rowid"), column_clause("id"))
+        return (
+            select(
+                keys.c.id.label("id"),
+                (-literal_column("bm25({}_fts)".format(table))).label("score"),
+            )
+            .select_from(fts)
+            .join(keys, keys.c.fts_rowid == fts.c.rowid)
+            .where(
+                literal_column(table + "_fts").op("MATCH")(
+                    '"{}"'.format(term.replace('"', '""'))
+                )
+            )
+            .limit(-1)
+        )
+
+    # Terms too short for the trigram index, or no index at all
+    return select(model.id.label("id"), literal(0.0).label("score")).where(
+        like_filter(column, term)
+    )
+
+
+def is_indexed(session, term):
+    # Whether match_authors and match_works look the term up in a text index rather than scanning
+    backend = get_search_backend(session)
+    return backend == "trigram" or (backend == "fts5" and len(term) >= MIN_TRIGRAM_TERM_LENGTH)
+
+
+def like_filter(column, term):
+    return column.ilike(_like_pattern(term), escape="\\")
+
+
+def match_authors(session, author_name):
+    return _match(session, Author, Author.name, author_name)
+
+
+def match_works(session, work_title):
+    return _match(session, Work, Work.title, work_title)